@@ -48,6 +48,9 @@ from .const import (
     CONF_MIN_P,
     CONF_TYPICAL_P,
     CONF_REQUEST_TIMEOUT,
+    CONF_REMOTE_KEEP_WARM_INTERVAL,
+    CONF_REMOTE_ADDITIONAL_ENDPOINTS,
+    CONF_REMOTE_HEDGE_PERCENTILE,
     CONF_BACKEND_TYPE,
     CONF_SELECTED_LANGUAGE,
     CONF_SELECTED_LANGUAGE_OPTIONS,
@@ -57,19 +60,35 @@ from .const import (
     CONF_PROMPT_TEMPLATE,
     CONF_TOOL_FORMAT,
     CONF_TOOL_MULTI_TURN_CHAT,
+    CONF_MAX_PARALLEL_TOOL_CALLS,
+    CONF_TOOL_CALL_TIMEOUT,
     CONF_ENABLE_FLASH_ATTENTION,
     CONF_USE_GBNF_GRAMMAR,
     CONF_GBNF_GRAMMAR_FILE,
+    CONF_GBNF_BATCH_FORCED_TOKENS,
+    CONF_GBNF_DYNAMIC_GRAMMAR,
     CONF_EXTRA_ATTRIBUTES_TO_EXPOSE,
+    CONF_DEVICE_ENCODING,
     CONF_TEXT_GEN_WEBUI_PRESET,
     CONF_REFRESH_SYSTEM_PROMPT,
+    CONF_OPTIMIZE_PROMPT_LAYOUT,
+    CONF_DEVICE_RETRIEVAL,
+    CONF_DEVICE_RETRIEVAL_TOP_K,
+    CONF_RESPONSE_CACHE,
+    CONF_RESPONSE_CACHE_TTL,
     CONF_REMEMBER_CONVERSATION,
     CONF_REMEMBER_NUM_INTERACTIONS,
     CONF_PROMPT_CACHING_ENABLED,
     CONF_PROMPT_CACHING_INTERVAL,
+    CONF_PROMPT_CACHING_POOL_SIZE,
+    CONF_PROMPT_CACHING_DISK_SIZE,
+    CONF_SPECULATIVE_DECODING,
+    CONF_SPECULATIVE_NUM_TOKENS,
+    CONF_DRAFT_MODEL_FILE,
     CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES,
     CONF_IN_CONTEXT_EXAMPLES_FILE,
     CONF_NUM_IN_CONTEXT_EXAMPLES,
+    CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
     CONF_OPENAI_API_KEY,
     CONF_TEXT_GEN_WEBUI_ADMIN_KEY,
     CONF_SERVICE_CALL_REGEX,
@@ -77,9 +96,11 @@ from .const import (
     CONF_TEXT_GEN_WEBUI_CHAT_MODE,
     CONF_OLLAMA_KEEP_ALIVE_MIN,
     CONF_OLLAMA_JSON_MODE,
+    CONF_OLLAMA_REUSE_CONTEXT,
     CONF_GENERIC_OPENAI_PATH,
     CONF_GENERIC_OPENAI_VALIDATE_MODEL,
     CONF_CONTEXT_LENGTH,
+    CONF_FIT_DEVICES_TO_CONTEXT,
     CONF_BATCH_SIZE,
     CONF_THREAD_COUNT,
     CONF_BATCH_THREAD_COUNT,
@@ -101,31 +122,52 @@ from .const import (
     DEFAULT_MIN_P,
     DEFAULT_TYPICAL_P,
     DEFAULT_REQUEST_TIMEOUT,
+    DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+    DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS,
+    DEFAULT_REMOTE_HEDGE_PERCENTILE,
     DEFAULT_BACKEND_TYPE,
     DEFAULT_DOWNLOADED_MODEL_QUANTIZATION,
     DEFAULT_PROMPT_TEMPLATE,
     DEFAULT_TOOL_FORMAT,
     DEFAULT_TOOL_MULTI_TURN_CHAT,
+    DEFAULT_MAX_PARALLEL_TOOL_CALLS,
+    DEFAULT_TOOL_CALL_TIMEOUT,
     DEFAULT_ENABLE_FLASH_ATTENTION,
     DEFAULT_USE_GBNF_GRAMMAR,
     DEFAULT_GBNF_GRAMMAR_FILE,
+    DEFAULT_GBNF_BATCH_FORCED_TOKENS,
+    DEFAULT_GBNF_DYNAMIC_GRAMMAR,
     DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE,
+    DEFAULT_DEVICE_ENCODING,
     DEFAULT_REFRESH_SYSTEM_PROMPT,
+    DEFAULT_OPTIMIZE_PROMPT_LAYOUT,
+    DEFAULT_DEVICE_RETRIEVAL,
+    DEFAULT_DEVICE_RETRIEVAL_TOP_K,
+    DEFAULT_RESPONSE_CACHE,
+    DEFAULT_RESPONSE_CACHE_TTL,
     DEFAULT_REMEMBER_CONVERSATION,
     DEFAULT_REMEMBER_NUM_INTERACTIONS,
     DEFAULT_PROMPT_CACHING_ENABLED,
     DEFAULT_PROMPT_CACHING_INTERVAL,
+    DEFAULT_PROMPT_CACHING_POOL_SIZE,
+    DEFAULT_PROMPT_CACHING_DISK_SIZE,
+    DEFAULT_SPECULATIVE_DECODING,
+    DEFAULT_SPECULATIVE_NUM_TOKENS,
+    DEFAULT_DRAFT_MODEL_FILE,
     DEFAULT_USE_IN_CONTEXT_LEARNING_EXAMPLES,
     DEFAULT_IN_CONTEXT_EXAMPLES_FILE,
     DEFAULT_NUM_IN_CONTEXT_EXAMPLES,
+    DEFAULT_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
     DEFAULT_SERVICE_CALL_REGEX,
     DEFAULT_REMOTE_USE_CHAT_ENDPOINT,
     DEFAULT_TEXT_GEN_WEBUI_CHAT_MODE,
     DEFAULT_OLLAMA_KEEP_ALIVE_MIN,
     DEFAULT_OLLAMA_JSON_MODE,
+    DEFAULT_OLLAMA_REUSE_CONTEXT,
     DEFAULT_GENERIC_OPENAI_PATH,
     DEFAULT_GENERIC_OPENAI_VALIDATE_MODEL,
     DEFAULT_CONTEXT_LENGTH,
+    DEFAULT_FIT_DEVICES_TO_CONTEXT,
     DEFAULT_BATCH_SIZE,
     DEFAULT_THREAD_COUNT,
     DEFAULT_BATCH_THREAD_COUNT,
@@ -139,9 +181,14 @@ from .const import (
     TOOL_FORMAT_FULL,
     TOOL_FORMAT_REDUCED,
     TOOL_FORMAT_MINIMAL,
+    DEVICE_ENCODING_FULL,
+    DEVICE_ENCODING_COMPACT,
     TEXT_GEN_WEBUI_CHAT_MODE_CHAT,
     TEXT_GEN_WEBUI_CHAT_MODE_INSTRUCT,
     TEXT_GEN_WEBUI_CHAT_MODE_CHAT_INSTRUCT,
+    SPECULATIVE_DECODING_NONE,
+    SPECULATIVE_DECODING_PROMPT_LOOKUP,
+    SPECULATIVE_DECODING_DRAFT_MODEL,
     DOMAIN,
     HOME_LLM_API_ID,
     DEFAULT_OPTIONS,
@@ -885,6 +932,16 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
             description={"suggested_value": options.get(CONF_TOOL_MULTI_TURN_CHAT)},
             default=DEFAULT_TOOL_MULTI_TURN_CHAT,
         ): BooleanSelector(BooleanSelectorConfig()),
+        vol.Required(
+            CONF_MAX_PARALLEL_TOOL_CALLS,
+            description={"suggested_value": options.get(CONF_MAX_PARALLEL_TOOL_CALLS)},
+            default=DEFAULT_MAX_PARALLEL_TOOL_CALLS,
+        ): NumberSelector(NumberSelectorConfig(min=1, max=16, step=1)),
+        vol.Required(
+            CONF_TOOL_CALL_TIMEOUT,
+            description={"suggested_value": options.get(CONF_TOOL_CALL_TIMEOUT)},
+            default=DEFAULT_TOOL_CALL_TIMEOUT,
+        ): NumberSelector(NumberSelectorConfig(min=1, max=300, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
         vol.Required(
             CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES,
             description={"suggested_value": options.get(CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES)},
@@ -900,6 +957,11 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
             description={"suggested_value": options.get(CONF_NUM_IN_CONTEXT_EXAMPLES)},
             default=DEFAULT_NUM_IN_CONTEXT_EXAMPLES,
         ): NumberSelector(NumberSelectorConfig(min=1, max=16, step=1)),
+        vol.Required(
+            CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
+            description={"suggested_value": options.get(CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES)},
+            default=DEFAULT_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
+        ): BooleanSelector(BooleanSelectorConfig()),
         vol.Required(
             CONF_MAX_TOKENS,
             description={"suggested_value": options.get(CONF_MAX_TOKENS)},
@@ -910,6 +972,16 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
             description={"suggested_value": options.get(CONF_EXTRA_ATTRIBUTES_TO_EXPOSE)},
             default=DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE,
         ): TextSelector(TextSelectorConfig(multiple=True)),
+        vol.Required(
+            CONF_DEVICE_ENCODING,
+            description={"suggested_value": options.get(CONF_DEVICE_ENCODING)},
+            default=DEFAULT_DEVICE_ENCODING,
+        ): SelectSelector(SelectSelectorConfig(
+            options=[DEVICE_ENCODING_FULL, DEVICE_ENCODING_COMPACT],
+            translation_key=CONF_DEVICE_ENCODING,
+            multiple=False,
+            mode=SelectSelectorMode.DROPDOWN,
+        )),
         vol.Required(
             CONF_SERVICE_CALL_REGEX,
             description={"suggested_value": options.get(CONF_SERVICE_CALL_REGEX)},
@@ -920,6 +992,31 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
             description={"suggested_value": options.get(CONF_REFRESH_SYSTEM_PROMPT)},
             default=DEFAULT_REFRESH_SYSTEM_PROMPT,
         ): BooleanSelector(BooleanSelectorConfig()),
+        vol.Required(
+            CONF_OPTIMIZE_PROMPT_LAYOUT,
+            description={"suggested_value": options.get(CONF_OPTIMIZE_PROMPT_LAYOUT)},
+            default=DEFAULT_OPTIMIZE_PROMPT_LAYOUT,
+        ): BooleanSelector(BooleanSelectorConfig()),
+        vol.Required(
+            CONF_DEVICE_RETRIEVAL,
+            description={"suggested_value": options.get(CONF_DEVICE_RETRIEVAL)},
+            default=DEFAULT_DEVICE_RETRIEVAL,
+        ): BooleanSelector(BooleanSelectorConfig()),
+        vol.Required(
+            CONF_DEVICE_RETRIEVAL_TOP_K,
+            description={"suggested_value": options.get(CONF_DEVICE_RETRIEVAL_TOP_K)},
+            default=DEFAULT_DEVICE_RETRIEVAL_TOP_K,
+        ): NumberSelector(NumberSelectorConfig(min=1, max=256, step=1)),
+        vol.Required(
+            CONF_RESPONSE_CACHE,
+            description={"suggested_value": options.get(CONF_RESPONSE_CACHE)},
+            default=DEFAULT_RESPONSE_CACHE,
+        ): BooleanSelector(BooleanSelectorConfig()),
+        vol.Required(
+            CONF_RESPONSE_CACHE_TTL,
+            description={"suggested_value": options.get(CONF_RESPONSE_CACHE_TTL)},
+            default=DEFAULT_RESPONSE_CACHE_TTL,
+        ): NumberSelector(NumberSelectorConfig(min=1, max=86400, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
         vol.Required(
             CONF_REMEMBER_CONVERSATION,
             description={"suggested_value": options.get(CONF_REMEMBER_CONVERSATION)},
@@ -969,12 +1066,27 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_PROMPT_CACHING_INTERVAL)},
                 default=DEFAULT_PROMPT_CACHING_INTERVAL,
             ): NumberSelector(NumberSelectorConfig(min=1, max=60, step=1)),
+            vol.Required(
+                CONF_PROMPT_CACHING_POOL_SIZE,
+                description={"suggested_value": options.get(CONF_PROMPT_CACHING_POOL_SIZE)},
+                default=DEFAULT_PROMPT_CACHING_POOL_SIZE,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=16384, step=1)),
+            vol.Required(
+                CONF_PROMPT_CACHING_DISK_SIZE,
+                description={"suggested_value": options.get(CONF_PROMPT_CACHING_DISK_SIZE)},
+                default=DEFAULT_PROMPT_CACHING_DISK_SIZE,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=65536, step=1)),
             # TODO: add rope_scaling_type
             vol.Required(
                 CONF_CONTEXT_LENGTH,
                 description={"suggested_value": options.get(CONF_CONTEXT_LENGTH)},
                 default=DEFAULT_CONTEXT_LENGTH,
             ): NumberSelector(NumberSelectorConfig(min=512, max=32768, step=1)),
+            vol.Required(
+                CONF_FIT_DEVICES_TO_CONTEXT,
+                description={"suggested_value": options.get(CONF_FIT_DEVICES_TO_CONTEXT)},
+                default=DEFAULT_FIT_DEVICES_TO_CONTEXT,
+            ): BooleanSelector(BooleanSelectorConfig()),
             vol.Required(
                 CONF_BATCH_SIZE,
                 description={"suggested_value": options.get(CONF_BATCH_SIZE)},
@@ -995,6 +1107,26 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_ENABLE_FLASH_ATTENTION)},
                 default=DEFAULT_ENABLE_FLASH_ATTENTION,
             ): BooleanSelector(BooleanSelectorConfig()),
+            vol.Required(
+                CONF_SPECULATIVE_DECODING,
+                description={"suggested_value": options.get(CONF_SPECULATIVE_DECODING)},
+                default=DEFAULT_SPECULATIVE_DECODING,
+            ): SelectSelector(SelectSelectorConfig(
+                options=[SPECULATIVE_DECODING_NONE, SPECULATIVE_DECODING_PROMPT_LOOKUP, SPECULATIVE_DECODING_DRAFT_MODEL],
+                translation_key=CONF_SPECULATIVE_DECODING,
+                multiple=False,
+                mode=SelectSelectorMode.DROPDOWN,
+            )),
+            vol.Required(
+                CONF_SPECULATIVE_NUM_TOKENS,
+                description={"suggested_value": options.get(CONF_SPECULATIVE_NUM_TOKENS)},
+                default=DEFAULT_SPECULATIVE_NUM_TOKENS,
+            ): NumberSelector(NumberSelectorConfig(min=1, max=64, step=1)),
+            vol.Optional(
+                CONF_DRAFT_MODEL_FILE,
+                description={"suggested_value": options.get(CONF_DRAFT_MODEL_FILE)},
+                default=DEFAULT_DRAFT_MODEL_FILE,
+            ): str,
             vol.Required(
                 CONF_USE_GBNF_GRAMMAR,
                 description={"suggested_value": options.get(CONF_USE_GBNF_GRAMMAR)},
@@ -1004,7 +1136,17 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 CONF_GBNF_GRAMMAR_FILE,
                 description={"suggested_value": options.get(CONF_GBNF_GRAMMAR_FILE)},
                 default=DEFAULT_GBNF_GRAMMAR_FILE,
-            ): str
+            ): str,
+            vol.Required(
+                CONF_GBNF_DYNAMIC_GRAMMAR,
+                description={"suggested_value": options.get(CONF_GBNF_DYNAMIC_GRAMMAR)},
+                default=DEFAULT_GBNF_DYNAMIC_GRAMMAR,
+            ): BooleanSelector(BooleanSelectorConfig()),
+            vol.Required(
+                CONF_GBNF_BATCH_FORCED_TOKENS,
+                description={"suggested_value": options.get(CONF_GBNF_BATCH_FORCED_TOKENS)},
+                default=DEFAULT_GBNF_BATCH_FORCED_TOKENS,
+            ): BooleanSelector(BooleanSelectorConfig()),
         })
     elif backend_type == BACKEND_TYPE_TEXT_GEN_WEBUI:
         result = insert_after_key(result, CONF_MAX_TOKENS, {
@@ -1013,6 +1155,11 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_CONTEXT_LENGTH)},
                 default=DEFAULT_CONTEXT_LENGTH,
             ): NumberSelector(NumberSelectorConfig(min=512, max=32768, step=1)),
+            vol.Required(
+                CONF_FIT_DEVICES_TO_CONTEXT,
+                description={"suggested_value": options.get(CONF_FIT_DEVICES_TO_CONTEXT)},
+                default=DEFAULT_FIT_DEVICES_TO_CONTEXT,
+            ): BooleanSelector(BooleanSelectorConfig()),
             vol.Required(
                 CONF_TOP_K,
                 description={"suggested_value": options.get(CONF_TOP_K)},
@@ -1043,6 +1190,11 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_REQUEST_TIMEOUT)},
                 default=DEFAULT_REQUEST_TIMEOUT,
             ): NumberSelector(NumberSelectorConfig(min=5, max=900, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_KEEP_WARM_INTERVAL,
+                description={"suggested_value": options.get(CONF_REMOTE_KEEP_WARM_INTERVAL)},
+                default=DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=3600, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
             vol.Required(
                 CONF_REMOTE_USE_CHAT_ENDPOINT,
                 description={"suggested_value": options.get(CONF_REMOTE_USE_CHAT_ENDPOINT)},
@@ -1080,6 +1232,21 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_REQUEST_TIMEOUT)},
                 default=DEFAULT_REQUEST_TIMEOUT,
             ): NumberSelector(NumberSelectorConfig(min=5, max=900, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_KEEP_WARM_INTERVAL,
+                description={"suggested_value": options.get(CONF_REMOTE_KEEP_WARM_INTERVAL)},
+                default=DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=3600, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_ADDITIONAL_ENDPOINTS,
+                description={"suggested_value": options.get(CONF_REMOTE_ADDITIONAL_ENDPOINTS)},
+                default=DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS,
+            ): TextSelector(TextSelectorConfig(multiple=True)),
+            vol.Required(
+                CONF_REMOTE_HEDGE_PERCENTILE,
+                description={"suggested_value": options.get(CONF_REMOTE_HEDGE_PERCENTILE)},
+                default=DEFAULT_REMOTE_HEDGE_PERCENTILE,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=99, step=1, mode=NumberSelectorMode.BOX)),
             vol.Required(
                 CONF_REMOTE_USE_CHAT_ENDPOINT,
                 description={"suggested_value": options.get(CONF_REMOTE_USE_CHAT_ENDPOINT)},
@@ -1113,11 +1280,21 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_GBNF_GRAMMAR_FILE)},
                 default=DEFAULT_GBNF_GRAMMAR_FILE,
             ): str,
+            vol.Required(
+                CONF_GBNF_DYNAMIC_GRAMMAR,
+                description={"suggested_value": options.get(CONF_GBNF_DYNAMIC_GRAMMAR)},
+                default=DEFAULT_GBNF_DYNAMIC_GRAMMAR,
+            ): BooleanSelector(BooleanSelectorConfig()),
             vol.Required(
                 CONF_REQUEST_TIMEOUT,
                 description={"suggested_value": options.get(CONF_REQUEST_TIMEOUT)},
                 default=DEFAULT_REQUEST_TIMEOUT,
             ): NumberSelector(NumberSelectorConfig(min=5, max=900, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_KEEP_WARM_INTERVAL,
+                description={"suggested_value": options.get(CONF_REMOTE_KEEP_WARM_INTERVAL)},
+                default=DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=3600, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
             vol.Required(
                 CONF_REMOTE_USE_CHAT_ENDPOINT,
                 description={"suggested_value": options.get(CONF_REMOTE_USE_CHAT_ENDPOINT)},
@@ -1131,6 +1308,11 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_CONTEXT_LENGTH)},
                 default=DEFAULT_CONTEXT_LENGTH,
             ): NumberSelector(NumberSelectorConfig(min=512, max=32768, step=1)),
+            vol.Required(
+                CONF_FIT_DEVICES_TO_CONTEXT,
+                description={"suggested_value": options.get(CONF_FIT_DEVICES_TO_CONTEXT)},
+                default=DEFAULT_FIT_DEVICES_TO_CONTEXT,
+            ): BooleanSelector(BooleanSelectorConfig()),
             vol.Required(
                 CONF_TOP_K,
                 description={"suggested_value": options.get(CONF_TOP_K)},
@@ -1156,11 +1338,31 @@ def local_llama_config_option_schema(hass: HomeAssistant, options: MappingProxyT
                 description={"suggested_value": options.get(CONF_OLLAMA_JSON_MODE)},
                 default=DEFAULT_OLLAMA_JSON_MODE,
             ): BooleanSelector(BooleanSelectorConfig()),
+            vol.Required(
+                CONF_OLLAMA_REUSE_CONTEXT,
+                description={"suggested_value": options.get(CONF_OLLAMA_REUSE_CONTEXT)},
+                default=DEFAULT_OLLAMA_REUSE_CONTEXT,
+            ): BooleanSelector(BooleanSelectorConfig()),
             vol.Required(
                 CONF_REQUEST_TIMEOUT,
                 description={"suggested_value": options.get(CONF_REQUEST_TIMEOUT)},
                 default=DEFAULT_REQUEST_TIMEOUT,
             ): NumberSelector(NumberSelectorConfig(min=5, max=900, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_KEEP_WARM_INTERVAL,
+                description={"suggested_value": options.get(CONF_REMOTE_KEEP_WARM_INTERVAL)},
+                default=DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=3600, step=1, unit_of_measurement=UnitOfTime.SECONDS, mode=NumberSelectorMode.BOX)),
+            vol.Required(
+                CONF_REMOTE_ADDITIONAL_ENDPOINTS,
+                description={"suggested_value": options.get(CONF_REMOTE_ADDITIONAL_ENDPOINTS)},
+                default=DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS,
+            ): TextSelector(TextSelectorConfig(multiple=True)),
+            vol.Required(
+                CONF_REMOTE_HEDGE_PERCENTILE,
+                description={"suggested_value": options.get(CONF_REMOTE_HEDGE_PERCENTILE)},
+                default=DEFAULT_REMOTE_HEDGE_PERCENTILE,
+            ): NumberSelector(NumberSelectorConfig(min=0, max=99, step=1, mode=NumberSelectorMode.BOX)),
             vol.Required(
                 CONF_OLLAMA_KEEP_ALIVE_MIN,
                 description={"suggested_value": options.get(CONF_OLLAMA_KEEP_ALIVE_MIN)},
@@ -105,6 +105,26 @@ CONF_TEMPERATURE = "temperature"
 DEFAULT_TEMPERATURE = 0.1
 CONF_REQUEST_TIMEOUT = "request_timeout"
 DEFAULT_REQUEST_TIMEOUT = 90
+CONF_REMOTE_KEEP_WARM_INTERVAL = "remote_keep_warm_interval"
+DEFAULT_REMOTE_KEEP_WARM_INTERVAL = 0
+# connection settings for the remote backends; idle connections are kept open for longer than the aiohttp default
+REMOTE_CONNECTION_LIMIT = 8
+REMOTE_CONNECTION_KEEPALIVE_TIMEOUT = 120
+REMOTE_DNS_CACHE_TTL = 300
+# how often to check if keeping the connection warm was turned on while it is off
+REMOTE_KEEP_WARM_RECHECK_INTERVAL = 60
+CONF_REMOTE_ADDITIONAL_ENDPOINTS = "remote_additional_endpoints"
+DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS = []
+CONF_REMOTE_HEDGE_PERCENTILE = "remote_hedge_percentile"
+DEFAULT_REMOTE_HEDGE_PERCENTILE = 0
+# how often the endpoints are checked when there is more than one, and how long a check may take (in seconds)
+REMOTE_HEALTH_CHECK_INTERVAL = 30
+REMOTE_HEALTH_CHECK_TIMEOUT = 5
+# how many of the most recent response times of each endpoint are kept, and how many are needed before hedging
+REMOTE_LATENCY_WINDOW = 100
+REMOTE_HEDGE_MIN_SAMPLES = 10
+# upper bounds (in seconds) of the buckets of the time to first response histograms
+REMOTE_LATENCY_HISTOGRAM_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 CONF_BACKEND_TYPE = "model_backend"
 BACKEND_TYPE_LLAMA_HF = "llama_cpp_hf"
 BACKEND_TYPE_LLAMA_EXISTING = "llama_cpp_existing"
@@ -129,7 +149,17 @@ DEFAULT_PORT = "5000"
 DEFAULT_SSL = False
 CONF_EXTRA_ATTRIBUTES_TO_EXPOSE = "extra_attributes_to_expose"
 DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE = ["rgb_color", "brightness", "temperature", "humidity", "fan_mode", "media_title", "volume_level", "item", "wind_speed"]
+CONF_DEVICE_ENCODING = "device_encoding"
+DEVICE_ENCODING_FULL = "full"
+DEVICE_ENCODING_COMPACT = "compact"
+DEFAULT_DEVICE_ENCODING = DEVICE_ENCODING_FULL
+# attribute values that the compact device encoding leaves out because they are what the model would assume anyway
+COMPACT_DEVICE_DEFAULT_ATTRIBUTE_VALUES = {
+    "brightness": 255,
+    "rgb_color": (255, 255, 255),
+}
 ALLOWED_SERVICE_CALL_ARGUMENTS = ["rgb_color", "brightness", "temperature", "humidity", "fan_mode", "hvac_mode", "preset_mode", "item", "duration" ]
+NUMERIC_SERVICE_CALL_ARGUMENTS = ["brightness", "temperature", "humidity"]
 CONF_PROMPT_TEMPLATE = "prompt_template"
 PROMPT_TEMPLATE_CHATML = "chatml"
 PROMPT_TEMPLATE_COMMAND_R = "command-r"
@@ -221,23 +251,46 @@ TOOL_FORMAT_MINIMAL = "min_tool_format"
 DEFAULT_TOOL_FORMAT = TOOL_FORMAT_FULL
 CONF_TOOL_MULTI_TURN_CHAT = "tool_multi_turn_chat"
 DEFAULT_TOOL_MULTI_TURN_CHAT = False
+CONF_MAX_PARALLEL_TOOL_CALLS = "max_parallel_tool_calls"
+DEFAULT_MAX_PARALLEL_TOOL_CALLS = 4
+CONF_TOOL_CALL_TIMEOUT = "tool_call_timeout"
+DEFAULT_TOOL_CALL_TIMEOUT = 10
 CONF_ENABLE_FLASH_ATTENTION = "enable_flash_attention"
 DEFAULT_ENABLE_FLASH_ATTENTION = False
 CONF_USE_GBNF_GRAMMAR = "gbnf_grammar"
 DEFAULT_USE_GBNF_GRAMMAR = False
 CONF_GBNF_GRAMMAR_FILE = "gbnf_grammar_file"
 DEFAULT_GBNF_GRAMMAR_FILE = "output.gbnf"
+CONF_GBNF_BATCH_FORCED_TOKENS = "gbnf_batch_forced_tokens"
+DEFAULT_GBNF_BATCH_FORCED_TOKENS = False
+CONF_GBNF_DYNAMIC_GRAMMAR = "gbnf_dynamic_grammar"
+DEFAULT_GBNF_DYNAMIC_GRAMMAR = False
 CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES = "in_context_examples"
 DEFAULT_USE_IN_CONTEXT_LEARNING_EXAMPLES = True
 CONF_IN_CONTEXT_EXAMPLES_FILE = "in_context_examples_file"
 DEFAULT_IN_CONTEXT_EXAMPLES_FILE = "in_context_examples.csv"
 CONF_NUM_IN_CONTEXT_EXAMPLES = "num_in_context_examples"
 DEFAULT_NUM_IN_CONTEXT_EXAMPLES = 4
+CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES = "deterministic_in_context_examples"
+DEFAULT_DETERMINISTIC_IN_CONTEXT_EXAMPLES = False
 CONF_TEXT_GEN_WEBUI_PRESET = "text_generation_webui_preset"
 CONF_OPENAI_API_KEY = "openai_api_key"
 CONF_TEXT_GEN_WEBUI_ADMIN_KEY = "text_generation_webui_admin_key"
 CONF_REFRESH_SYSTEM_PROMPT = "refresh_prompt_per_turn"
 DEFAULT_REFRESH_SYSTEM_PROMPT = True
+CONF_OPTIMIZE_PROMPT_LAYOUT = "optimize_prompt_layout"
+DEFAULT_OPTIMIZE_PROMPT_LAYOUT = False
+CONF_DEVICE_RETRIEVAL = "device_retrieval"
+DEFAULT_DEVICE_RETRIEVAL = False
+CONF_DEVICE_RETRIEVAL_TOP_K = "device_retrieval_top_k"
+DEFAULT_DEVICE_RETRIEVAL_TOP_K = 20
+CONF_RESPONSE_CACHE = "response_cache"
+DEFAULT_RESPONSE_CACHE = False
+CONF_RESPONSE_CACHE_TTL = "response_cache_ttl"
+DEFAULT_RESPONSE_CACHE_TTL = 300
+# how many responses are kept, and the temperature above which the model is expected to answer differently every time
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.5
 CONF_REMEMBER_CONVERSATION = "remember_conversation"
 DEFAULT_REMEMBER_CONVERSATION = True
 CONF_REMEMBER_NUM_INTERACTIONS = "remember_num_interactions"
@@ -246,6 +299,19 @@ CONF_PROMPT_CACHING_ENABLED = "prompt_caching"
 DEFAULT_PROMPT_CACHING_ENABLED = False
 CONF_PROMPT_CACHING_INTERVAL = "prompt_caching_interval"
 DEFAULT_PROMPT_CACHING_INTERVAL = 30
+CONF_PROMPT_CACHING_POOL_SIZE = "prompt_caching_pool_size"
+DEFAULT_PROMPT_CACHING_POOL_SIZE = 0
+CONF_PROMPT_CACHING_DISK_SIZE = "prompt_caching_disk_size"
+DEFAULT_PROMPT_CACHING_DISK_SIZE = 0
+CONF_SPECULATIVE_DECODING = "speculative_decoding"
+SPECULATIVE_DECODING_NONE = "none"
+SPECULATIVE_DECODING_PROMPT_LOOKUP = "prompt_lookup"
+SPECULATIVE_DECODING_DRAFT_MODEL = "draft_model"
+DEFAULT_SPECULATIVE_DECODING = SPECULATIVE_DECODING_NONE
+CONF_SPECULATIVE_NUM_TOKENS = "speculative_num_tokens"
+DEFAULT_SPECULATIVE_NUM_TOKENS = 10
+CONF_DRAFT_MODEL_FILE = "draft_model_file"
+DEFAULT_DRAFT_MODEL_FILE = ""
 CONF_SERVICE_CALL_REGEX = "service_call_regex"
 DEFAULT_SERVICE_CALL_REGEX = r"<functioncall> ({[\S \t]*})"
 FINE_TUNED_SERVICE_CALL_REGEX = r"```homeassistant\n([\S \t\n]*?)```"
@@ -260,6 +326,10 @@ CONF_OLLAMA_KEEP_ALIVE_MIN = "ollama_keep_alive"
 DEFAULT_OLLAMA_KEEP_ALIVE_MIN = 30
 CONF_OLLAMA_JSON_MODE = "ollama_json_mode"
 DEFAULT_OLLAMA_JSON_MODE = False
+CONF_OLLAMA_REUSE_CONTEXT = "ollama_reuse_context"
+DEFAULT_OLLAMA_REUSE_CONTEXT = False
+# how many conversations to keep the returned context of
+OLLAMA_CONTEXT_CACHE_SIZE = 16
 CONF_GENERIC_OPENAI_PATH = "openai_path"
 DEFAULT_GENERIC_OPENAI_PATH = "v1"
 CONF_GENERIC_OPENAI_VALIDATE_MODEL = "openai_validate_model"
@@ -267,6 +337,8 @@ DEFAULT_GENERIC_OPENAI_VALIDATE_MODEL = True
 
 CONF_CONTEXT_LENGTH = "context_length"
 DEFAULT_CONTEXT_LENGTH = 2048
+CONF_FIT_DEVICES_TO_CONTEXT = "fit_devices_to_context"
+DEFAULT_FIT_DEVICES_TO_CONTEXT = False
 CONF_BATCH_SIZE = "batch_size"
 DEFAULT_BATCH_SIZE = 512
 CONF_THREAD_COUNT = "n_threads"
@@ -303,6 +375,7 @@ DEFAULT_OPTIONS = types.MappingProxyType(
         CONF_PROMPT_CACHING_ENABLED: DEFAULT_PROMPT_CACHING_ENABLED,
         CONF_OLLAMA_KEEP_ALIVE_MIN: DEFAULT_OLLAMA_KEEP_ALIVE_MIN,
         CONF_OLLAMA_JSON_MODE: DEFAULT_OLLAMA_JSON_MODE,
+        CONF_OLLAMA_REUSE_CONTEXT: DEFAULT_OLLAMA_REUSE_CONTEXT,
         CONF_TEXT_GEN_WEBUI_CHAT_MODE: DEFAULT_TEXT_GEN_WEBUI_CHAT_MODE,
         CONF_TEXT_GEN_WEBUI_PRESET: ""
     }
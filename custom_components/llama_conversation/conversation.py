@@ -3,7 +3,9 @@ from __future__ import annotations
 
 import aiohttp
 import asyncio
+import codecs
 import csv
+import hashlib
 import importlib
 import json
 import logging
@@ -13,20 +15,23 @@ import re
 import threading
 import time
 import voluptuous as vol
-from typing import Literal, Any, Callable
+from typing import Literal, Any, Callable, AsyncGenerator, Generator
+from collections import OrderedDict
+from dataclasses import replace
+from contextlib import aclosing
 
 from homeassistant.components.conversation import ConversationInput, ConversationResult, AbstractConversationAgent, ConversationEntity
 from homeassistant.components import assist_pipeline, conversation as conversation
 from homeassistant.components.conversation.const import DOMAIN as CONVERSATION_DOMAIN
-from homeassistant.components.homeassistant.exposed_entities import async_should_expose
+from homeassistant.components.homeassistant.exposed_entities import async_should_expose, async_listen_entity_updates
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import ATTR_ENTITY_ID, CONF_HOST, CONF_PORT, CONF_SSL, MATCH_ALL, CONF_LLM_HASS_API
-from homeassistant.core import HomeAssistant, callback
+from homeassistant.const import ATTR_ENTITY_ID, CONF_HOST, CONF_PORT, CONF_SSL, MATCH_ALL, CONF_LLM_HASS_API, EVENT_STATE_CHANGED, \
+    EVENT_SERVICE_REGISTERED, EVENT_SERVICE_REMOVED, STATE_UNAVAILABLE, STATE_UNKNOWN
+from homeassistant.core import HomeAssistant, Event, EventStateChangedData, callback
 from homeassistant.exceptions import ConfigEntryNotReady, ConfigEntryError, TemplateError, HomeAssistantError
 from homeassistant.helpers import config_validation as cv, intent, template, entity_registry as er, llm, \
     area_registry as ar, device_registry as dr, chat_session
 from homeassistant.helpers.entity_platform import AddConfigEntryEntitiesCallback
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.event import async_track_state_change, async_call_later
 from homeassistant.components.sensor import SensorEntity
 from homeassistant.util import ulid, color
@@ -35,7 +40,19 @@ from homeassistant.util import ulid, color
 import voluptuous_serialize
 
 from .utils import closest_color, flatten_vol_schema, custom_custom_serializer, install_llama_cpp_python, \
-    validate_llama_cpp_python_installation, format_url
+    validate_llama_cpp_python_installation, format_url, ToolCallStreamSplitter, order_prompt_by_volatility, \
+    validate_home_llm_tool_call, validate_llm_api_tool_call, replace_default_device_section, render_default_device_section, \
+    NATIVE_DEVICE_SECTION_VARIABLE, async_iterate_json_stream
+from .scheduler import ModelScheduler, JobCancelledException, ModelJob, PRIORITY_USER, PRIORITY_PRIME
+from .speculative import SmallModelDraft, GrammarForcedDraft, ChainedDraft, DraftAcceptanceCounter
+from .grammar import GbnfGrammar, GrammarParseException, home_llm_tool_call_rules, api_tool_call_rules, with_tool_call_rules
+from .tool_dispatch import ToolCallDispatcher
+from .token_budget import TokenCounter, plan_device_budget, PROMPT_FORMAT_RESERVED_TOKENS
+from .device_index import DeviceIndex
+from .response_cache import ResponseCache, async_replay_response, response_cache_key
+from .http_pool import BackendConnectionPool, async_get_connection_pool, async_release_connection_pool
+from .endpoint_pool import BackendEndpoint, EndpointPool, parse_endpoint_urls
+from .kv_cache import LlamaStatePool, LlamaDiskStateCache, common_prefix_length, model_fingerprint
 from .const import (
     CONF_CHAT_MODEL,
     CONF_MAX_TOKENS,
@@ -46,33 +63,54 @@ from .const import (
     CONF_TYPICAL_P,
     CONF_MIN_P,
     CONF_REQUEST_TIMEOUT,
+    CONF_REMOTE_KEEP_WARM_INTERVAL,
+    CONF_REMOTE_ADDITIONAL_ENDPOINTS,
+    CONF_REMOTE_HEDGE_PERCENTILE,
     CONF_BACKEND_TYPE,
     CONF_DOWNLOADED_MODEL_FILE,
     CONF_EXTRA_ATTRIBUTES_TO_EXPOSE,
+    CONF_DEVICE_ENCODING,
     CONF_PROMPT_TEMPLATE,
     CONF_TOOL_FORMAT,
     CONF_TOOL_MULTI_TURN_CHAT,
+    CONF_MAX_PARALLEL_TOOL_CALLS,
+    CONF_TOOL_CALL_TIMEOUT,
     CONF_ENABLE_FLASH_ATTENTION,
     CONF_USE_GBNF_GRAMMAR,
     CONF_GBNF_GRAMMAR_FILE,
+    CONF_GBNF_BATCH_FORCED_TOKENS,
+    CONF_GBNF_DYNAMIC_GRAMMAR,
     CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES,
     CONF_IN_CONTEXT_EXAMPLES_FILE,
     CONF_NUM_IN_CONTEXT_EXAMPLES,
+    CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
     CONF_TEXT_GEN_WEBUI_PRESET,
     CONF_OPENAI_API_KEY,
     CONF_TEXT_GEN_WEBUI_ADMIN_KEY,
     CONF_REFRESH_SYSTEM_PROMPT,
+    CONF_OPTIMIZE_PROMPT_LAYOUT,
+    CONF_DEVICE_RETRIEVAL,
+    CONF_DEVICE_RETRIEVAL_TOP_K,
+    CONF_RESPONSE_CACHE,
+    CONF_RESPONSE_CACHE_TTL,
     CONF_REMEMBER_CONVERSATION,
     CONF_REMEMBER_NUM_INTERACTIONS,
     CONF_PROMPT_CACHING_ENABLED,
     CONF_PROMPT_CACHING_INTERVAL,
+    CONF_PROMPT_CACHING_POOL_SIZE,
+    CONF_PROMPT_CACHING_DISK_SIZE,
+    CONF_SPECULATIVE_DECODING,
+    CONF_SPECULATIVE_NUM_TOKENS,
+    CONF_DRAFT_MODEL_FILE,
     CONF_SERVICE_CALL_REGEX,
     CONF_REMOTE_USE_CHAT_ENDPOINT,
     CONF_TEXT_GEN_WEBUI_CHAT_MODE,
     CONF_OLLAMA_KEEP_ALIVE_MIN,
     CONF_OLLAMA_JSON_MODE,
+    CONF_OLLAMA_REUSE_CONTEXT,
     CONF_GENERIC_OPENAI_PATH,
     CONF_CONTEXT_LENGTH,
+    CONF_FIT_DEVICES_TO_CONTEXT,
     CONF_BATCH_SIZE,
     CONF_THREAD_COUNT,
     CONF_BATCH_THREAD_COUNT,
@@ -85,34 +123,63 @@ from .const import (
     DEFAULT_TYPICAL_P,
     DEFAULT_BACKEND_TYPE,
     DEFAULT_REQUEST_TIMEOUT,
+    DEFAULT_REMOTE_KEEP_WARM_INTERVAL,
+    DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS,
+    DEFAULT_REMOTE_HEDGE_PERCENTILE,
+    REMOTE_KEEP_WARM_RECHECK_INTERVAL,
+    REMOTE_HEALTH_CHECK_INTERVAL,
     DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE,
+    DEFAULT_DEVICE_ENCODING,
     DEFAULT_PROMPT_TEMPLATE,
     DEFAULT_TOOL_FORMAT,
     DEFAULT_TOOL_MULTI_TURN_CHAT,
+    DEFAULT_MAX_PARALLEL_TOOL_CALLS,
+    DEFAULT_TOOL_CALL_TIMEOUT,
     DEFAULT_ENABLE_FLASH_ATTENTION,
     DEFAULT_USE_GBNF_GRAMMAR,
     DEFAULT_GBNF_GRAMMAR_FILE,
+    DEFAULT_GBNF_BATCH_FORCED_TOKENS,
+    DEFAULT_GBNF_DYNAMIC_GRAMMAR,
     DEFAULT_USE_IN_CONTEXT_LEARNING_EXAMPLES,
     DEFAULT_IN_CONTEXT_EXAMPLES_FILE,
     DEFAULT_NUM_IN_CONTEXT_EXAMPLES,
+    DEFAULT_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
     DEFAULT_REFRESH_SYSTEM_PROMPT,
+    DEFAULT_OPTIMIZE_PROMPT_LAYOUT,
+    DEFAULT_DEVICE_RETRIEVAL,
+    DEFAULT_DEVICE_RETRIEVAL_TOP_K,
+    DEFAULT_RESPONSE_CACHE,
+    DEFAULT_RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_MAX_TEMPERATURE,
     DEFAULT_REMEMBER_CONVERSATION,
     DEFAULT_REMEMBER_NUM_INTERACTIONS,
     DEFAULT_PROMPT_CACHING_ENABLED,
     DEFAULT_PROMPT_CACHING_INTERVAL,
+    DEFAULT_PROMPT_CACHING_POOL_SIZE,
+    DEFAULT_PROMPT_CACHING_DISK_SIZE,
+    DEFAULT_SPECULATIVE_DECODING,
+    DEFAULT_SPECULATIVE_NUM_TOKENS,
+    DEFAULT_DRAFT_MODEL_FILE,
     DEFAULT_SERVICE_CALL_REGEX,
     DEFAULT_REMOTE_USE_CHAT_ENDPOINT,
     DEFAULT_TEXT_GEN_WEBUI_CHAT_MODE,
     DEFAULT_OLLAMA_KEEP_ALIVE_MIN,
     DEFAULT_OLLAMA_JSON_MODE,
+    DEFAULT_OLLAMA_REUSE_CONTEXT,
+    OLLAMA_CONTEXT_CACHE_SIZE,
     DEFAULT_GENERIC_OPENAI_PATH,
     DEFAULT_CONTEXT_LENGTH,
+    DEFAULT_FIT_DEVICES_TO_CONTEXT,
     DEFAULT_BATCH_SIZE,
     DEFAULT_THREAD_COUNT,
     DEFAULT_BATCH_THREAD_COUNT,
     TEXT_GEN_WEBUI_CHAT_MODE_CHAT,
     TEXT_GEN_WEBUI_CHAT_MODE_INSTRUCT,
     TEXT_GEN_WEBUI_CHAT_MODE_CHAT_INSTRUCT,
+    SPECULATIVE_DECODING_NONE,
+    SPECULATIVE_DECODING_PROMPT_LOOKUP,
+    SPECULATIVE_DECODING_DRAFT_MODEL,
     DOMAIN,
     HOME_LLM_API_ID,
     SERVICE_TOOL_NAME,
@@ -120,6 +187,8 @@ from .const import (
     TOOL_FORMAT_FULL,
     TOOL_FORMAT_REDUCED,
     TOOL_FORMAT_MINIMAL,
+    DEVICE_ENCODING_COMPACT,
+    COMPACT_DEVICE_DEFAULT_ATTRIBUTE_VALUES,
     ALLOWED_SERVICE_CALL_ARGUMENTS,
     SERVICE_TOOL_ALLOWED_SERVICES,
     SERVICE_TOOL_ALLOWED_DOMAINS,
@@ -179,26 +248,63 @@ def _convert_content(
 
 def _convert_content_back(
     agent_id: str,
-    message_history_entry: dict[str, str]
+    message_history_entry: dict[str, Any]
 ) -> conversation.Content:
     if message_history_entry["role"] == "tool":
         return conversation.ToolResultContent(content=message_history_entry["message"])
     if message_history_entry["role"] == "assistant":
+        # responses that were streamed into the chat log only hold the spoken part; keep the full response for the model
+        if streamed_content := message_history_entry.get("content"):
+            return replace(streamed_content, content=message_history_entry["message"])
         return conversation.AssistantContent(agent_id=agent_id, content=message_history_entry["message"])
     if message_history_entry["role"] == "user":
         return conversation.UserContent(content=message_history_entry["message"])
     if message_history_entry["role"] == "system":
         return conversation.SystemContent(content=message_history_entry["message"])
 
+class ToolCallFailedException(Exception):
+    """A tool call that the model generated could not be made. The message is said to the user"""
+
+    def __init__(self, error_code: intent.IntentResponseErrorCode, message: str) -> None:
+        super().__init__(message)
+        self.error_code = error_code
+
 class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
     """Base Local LLM conversation agent."""
 
     hass: HomeAssistant
     entry_id: str
     in_context_examples: list[dict]
+    icl_examples_cache: tuple[tuple, list[dict]] | None
+    device_line_cache: dict[str, tuple[str, list[dict]]]
+    dirty_device_lines: set[str]
+    device_line_cache_settings: tuple[str, tuple[str, ...]] | None
+    device_block_cache: tuple[tuple[str, ...], str, list[dict]] | None
+    device_line_lock: threading.Lock
+    exposed_entity_index: dict[str, dict[str, Any] | None]
+    last_updated_entities: dict[str, float]
+    dynamic_grammar_cache: tuple[tuple, str | None] | None
+    service_call_pattern: re.Pattern | None
+    service_call_regex_error: re.error | None
+    tool_call_validator: Callable[[Any], dict]
+    service_registry_generation: int
+    home_llm_services_cache: tuple[tuple, list[tuple[str, vol.Schema, str]]] | None
+    tool_description_cache: tuple[tuple, list, str] | None
+    token_counter: TokenCounter
+    device_budget_plan: tuple[int, int] | None
+    device_index: DeviceIndex
+    response_cache: ResponseCache
+    generation_failures: int
+    prompt_template_cache: tuple[tuple[str, bool], template.Template, str | None] | None
+    connection_pool: BackendConnectionPool | None
+    backend_endpoints: dict[str, BackendEndpoint]
+    endpoint_pool: tuple[tuple[str, ...], EndpointPool] | None
+    request_headers: dict[str, str]
+    keep_warm_listener: Callable | None
+    health_check_listener: Callable | None
 
     _attr_has_entity_name = True
-    _attr_supports_streaming = False # TODO: add support for backends that can stream
+    _attr_supports_streaming = True
 
     def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
         """Initialize the agent."""
@@ -218,9 +324,53 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             )
 
         self.in_context_examples = None
+        self.icl_examples_cache = None
+        self.dynamic_grammar_cache = None
         if entry.options.get(CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES, DEFAULT_USE_IN_CONTEXT_LEARNING_EXAMPLES):
             self._load_icl_examples(entry.options.get(CONF_IN_CONTEXT_EXAMPLES_FILE, DEFAULT_IN_CONTEXT_EXAMPLES_FILE))
 
+        self._update_tool_call_parsing()
+
+        # rendered device lines are kept between turns and only re-rendered when the entity changes
+        self.device_line_cache = {}
+        self.dirty_device_lines = set()
+        self.device_line_cache_settings = None
+        self.device_block_cache = None
+        self.device_line_lock = threading.Lock()
+
+        # entity id -> registry info for exposed entities (or None if the entity is not exposed)
+        self.exposed_entity_index = {}
+
+        # exposed entity id -> time of the last state change; used to put volatile devices at the end of the prompt
+        self.last_updated_entities = {}
+
+        # tool descriptions are built from the registered services and only rebuilt when a service is (un)registered
+        self.service_registry_generation = 0
+        self.home_llm_services_cache = None
+        self.tool_description_cache = None
+
+        # used to fit the exposed devices into the context size
+        self.token_counter = TokenCounter()
+        self.device_budget_plan = None
+
+        # words in the names, aliases and areas of the exposed devices; used to only expose the devices a request is about
+        self.device_index = DeviceIndex()
+
+        # model output for recent requests; the remote backends count their failures because they return them as text
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+        self.generation_failures = 0
+
+        # the system prompt template is only parsed and compiled again when the prompt option changes
+        self.prompt_template_cache = None
+
+        # set up by the remote backends when the model is loaded
+        self.connection_pool = None
+        self.backend_endpoints = {}
+        self.endpoint_pool = None
+        self.request_headers = {}
+        self.keep_warm_listener = None
+        self.health_check_listener = None
+
     async def async_added_to_hass(self) -> None:
         """When entity is added to Home Assistant."""
         await super().async_added_to_hass()
@@ -229,6 +379,152 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         )
         conversation.async_set_agent(self.hass, self.entry, self)
 
+        self.async_on_remove(
+            self.hass.bus.async_listen(EVENT_STATE_CHANGED, self._async_handle_state_changed)
+        )
+        self.async_on_remove(
+            self.hass.bus.async_listen(er.EVENT_ENTITY_REGISTRY_UPDATED, self._async_handle_entity_registry_updated)
+        )
+        self.async_on_remove(
+            self.hass.bus.async_listen(dr.EVENT_DEVICE_REGISTRY_UPDATED, self._async_handle_device_registry_updated)
+        )
+        self.async_on_remove(
+            self.hass.bus.async_listen(ar.EVENT_AREA_REGISTRY_UPDATED, self._async_handle_area_registry_updated)
+        )
+        self.async_on_remove(
+            async_listen_entity_updates(self.hass, CONVERSATION_DOMAIN, self._async_handle_exposure_updated)
+        )
+        self.async_on_remove(
+            self.hass.bus.async_listen(EVENT_SERVICE_REGISTERED, self._async_handle_services_changed)
+        )
+        self.async_on_remove(
+            self.hass.bus.async_listen(EVENT_SERVICE_REMOVED, self._async_handle_services_changed)
+        )
+
+        if self.connection_pool:
+            self._async_schedule_keep_warm()
+            self.async_on_remove(self._async_cancel_keep_warm)
+            self._async_schedule_health_check()
+            self.async_on_remove(self._async_cancel_health_check)
+
+    @callback
+    def _async_handle_state_changed(self, event: Event[EventStateChangedData]) -> None:
+        """Mark the rendered device line for a single entity as stale"""
+        entity_id = event.data["entity_id"]
+        self.dirty_device_lines.add(entity_id)
+        self.device_index.mark_changed(entity_id)
+
+        if self.exposed_entity_index.get(entity_id) is not None:
+            self.last_updated_entities[entity_id] = time.time()
+
+    @callback
+    def _async_handle_entity_registry_updated(self, event: Event[er.EventEntityRegistryUpdatedData]) -> None:
+        """Aliases, areas or units of the entity could have changed"""
+        self.exposed_entity_index.pop(event.data["entity_id"], None)
+        self.dirty_device_lines.add(event.data["entity_id"])
+        self.device_index.mark_changed(event.data["entity_id"])
+        if "old_entity_id" in event.data:
+            self.exposed_entity_index.pop(event.data["old_entity_id"], None)
+
+    @callback
+    def _async_handle_device_registry_updated(self, event: Event[dr.EventDeviceRegistryUpdatedData]) -> None:
+        """Only a change of the device's area changes what ends up in the prompt"""
+        if event.data["action"] == "update" and "area_id" not in event.data["changes"]:
+            return
+        self._async_clear_exposed_entity_index()
+
+    @callback
+    def _async_handle_area_registry_updated(self, event: Event[ar.EventAreaRegistryUpdatedData]) -> None:
+        self._async_clear_exposed_entity_index()
+
+    @callback
+    def _async_handle_exposure_updated(self) -> None:
+        self.exposed_entity_index = {}
+
+    @callback
+    def _async_handle_services_changed(self, event: Event) -> None:
+        """Invalidates the cached tool descriptions"""
+        self.service_registry_generation += 1
+
+    @callback
+    def _async_clear_exposed_entity_index(self) -> None:
+        """Device and area changes can move any number of entities so throw away every rendered line"""
+        self.exposed_entity_index = {}
+        self.device_index.mark_all_changed()
+        with self.device_line_lock:
+            self.device_line_cache = {}
+            self.device_block_cache = None
+
+    def _async_use_connection_pool(self, entry: ConfigEntry, base_url: str) -> None:
+        """Use the shared connection pool for the backend's host until the config entry is unloaded"""
+        self.connection_pool = self._async_get_backend_endpoint(entry, base_url).connection_pool
+
+    def _async_get_backend_endpoint(self, entry: ConfigEntry, base_url: str) -> BackendEndpoint:
+        """Endpoints keep their connection pool and response times until the config entry is unloaded"""
+        endpoint = self.backend_endpoints.get(base_url)
+        if not endpoint:
+            pool = async_get_connection_pool(self.hass, base_url)
+            entry.async_on_unload(lambda: async_release_connection_pool(self.hass, pool))
+            endpoint = BackendEndpoint(pool)
+            self.backend_endpoints[base_url] = endpoint
+        return endpoint
+
+    def _async_get_endpoint_pool(self) -> EndpointPool:
+        """The backend's host followed by the additional endpoints from the options"""
+        base_urls = (self.connection_pool.base_url, ) + tuple(parse_endpoint_urls(
+            self.entry.options.get(CONF_REMOTE_ADDITIONAL_ENDPOINTS, DEFAULT_REMOTE_ADDITIONAL_ENDPOINTS),
+            self.entry.data.get(CONF_SSL, False)
+        ))
+        if not self.endpoint_pool or self.endpoint_pool[0] != base_urls:
+            endpoints = [ self._async_get_backend_endpoint(self.entry, base_url) for base_url in dict.fromkeys(base_urls) ]
+            self.endpoint_pool = (base_urls, EndpointPool(endpoints))
+        return self.endpoint_pool[1]
+
+    def _async_stream_from_endpoints(self, send_request: Callable[[BackendEndpoint], AsyncGenerator[dict]]) -> AsyncGenerator[dict]:
+        """Send a request to the least loaded endpoint, hedging it on another endpoint if that is turned on"""
+        hedge_percentile = float(self.entry.options.get(CONF_REMOTE_HEDGE_PERCENTILE, DEFAULT_REMOTE_HEDGE_PERCENTILE))
+        return self._async_get_endpoint_pool().async_stream(send_request, hedge_percentile)
+
+    def _keep_warm_endpoint(self) -> str:
+        """A cheap endpoint on the backend to request to keep the connection open. Implemented by remote backends"""
+        raise NotImplementedError()
+
+    @callback
+    def _async_schedule_keep_warm(self) -> None:
+        interval = float(self.entry.options.get(CONF_REMOTE_KEEP_WARM_INTERVAL, DEFAULT_REMOTE_KEEP_WARM_INTERVAL))
+        self.keep_warm_listener = async_call_later(self.hass, interval or REMOTE_KEEP_WARM_RECHECK_INTERVAL, self._async_keep_warm)
+
+    @callback
+    def _async_cancel_keep_warm(self) -> None:
+        if self.keep_warm_listener:
+            self.keep_warm_listener()
+            self.keep_warm_listener = None
+
+    async def _async_keep_warm(self, _now) -> None:
+        """Make a request to the backend if it was idle for the keep warm interval, then check again after the interval"""
+        interval = float(self.entry.options.get(CONF_REMOTE_KEEP_WARM_INTERVAL, DEFAULT_REMOTE_KEEP_WARM_INTERVAL))
+        if interval:
+            for endpoint in self._async_get_endpoint_pool().endpoints:
+                await endpoint.connection_pool.async_keep_warm(self._keep_warm_endpoint(), self.request_headers, interval)
+        self._async_schedule_keep_warm()
+
+    @callback
+    def _async_schedule_health_check(self) -> None:
+        self.health_check_listener = async_call_later(self.hass, REMOTE_HEALTH_CHECK_INTERVAL, self._async_health_check)
+
+    @callback
+    def _async_cancel_health_check(self) -> None:
+        if self.health_check_listener:
+            self.health_check_listener()
+            self.health_check_listener = None
+
+    async def _async_health_check(self, _now) -> None:
+        """Check which endpoints are reachable; only needed if there is more than one to pick from"""
+        endpoint_pool = self._async_get_endpoint_pool()
+        if len(endpoint_pool.endpoints) > 1:
+            await endpoint_pool.async_health_check(self._keep_warm_endpoint(), self.request_headers)
+        self._async_schedule_health_check()
+
     async def async_will_remove_from_hass(self) -> None:
         """When entity will be removed from Home Assistant."""
         conversation.async_unset_agent(self.hass, self.entry)
@@ -236,6 +532,7 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
 
     def _load_icl_examples(self, filename: str):
         """Load info used for generating in context learning examples"""
+        self.icl_examples_cache = None
         try:
             icl_filename = os.path.join(os.path.dirname(__file__), filename)
 
@@ -265,6 +562,25 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         else:
             self.in_context_examples = None
 
+        self._update_tool_call_parsing()
+
+    def _update_tool_call_parsing(self) -> None:
+        """Compile the service call regex and pick the tool call validator once instead of on every turn"""
+        try:
+            self.service_call_pattern = re.compile(
+                self.entry.options.get(CONF_SERVICE_CALL_REGEX, DEFAULT_SERVICE_CALL_REGEX), flags=re.MULTILINE
+            )
+            self.service_call_regex_error = None
+        except re.error as err:
+            _LOGGER.exception("There was a problem compiling the service call regex")
+            self.service_call_pattern = None
+            self.service_call_regex_error = err
+
+        if self.entry.options.get(CONF_LLM_HASS_API) == HOME_LLM_API_ID:
+            self.tool_call_validator = validate_home_llm_tool_call
+        else:
+            self.tool_call_validator = validate_llm_api_tool_call
+
     @property
     def entry(self) -> ConfigEntry:
         try:
@@ -296,7 +612,83 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         return await self.hass.async_add_executor_job(
             self._generate, conversation
         )
+
+    async def _async_generate_stream(self, conversation: dict, conversation_id: str | None = None) -> AsyncGenerator[str]:
+        """
+        Generate a response as a series of text deltas. Backends that can't stream produce the whole response at once.
+        conversation_id lets backends keep state between the turns of a conversation.
+        """
+        yield await self._async_generate(conversation)
+
+    def _create_stream_splitter(self, service_call_pattern: re.Pattern, template_desc: dict) -> ToolCallStreamSplitter:
+        return ToolCallStreamSplitter(
+            service_call_pattern,
+            think_prefix=template_desc["chain_of_thought"]["prefix"],
+            think_suffix=template_desc["chain_of_thought"]["suffix"],
+            end_of_text=template_desc["assistant"]["suffix"],
+        )
+
+    async def _async_stream_response(
+        self,
+        message_history: list[dict],
+        chat_log: conversation.ChatLog,
+        agent_id: str,
+        splitter: ToolCallStreamSplitter,
+        on_tool_call: Callable[[str], None] | None = None,
+        cached_response: str | None = None,
+    ) -> tuple[str, conversation.AssistantContent | None]:
+        """
+        Streams the spoken part of the response into the chat log as it is generated. Returns the full response and the
+        content that was added to the chat log (None if nothing was said).
+        on_tool_call is called with each tool call block as soon as it has been generated.
+        A cached response is replayed the same way instead of generating a new one.
+        """
+        response_chunks = []
+        if cached_response is not None:
+            generated = async_replay_response(cached_response)
+        else:
+            generated = self._async_generate_stream(message_history, chat_log.conversation_id)
+
+        async def delta_stream() -> AsyncGenerator[conversation.AssistantContentDeltaDict]:
+            yield { "role": "assistant" }
+            async for chunk in generated:
+                response_chunks.append(chunk)
+                to_say, blocks = splitter.feed(chunk)
+                if on_tool_call:
+                    for block in blocks:
+                        on_tool_call(block)
+                if to_say:
+                    yield { "content": to_say }
+
+            to_say, blocks = splitter.finish()
+            if on_tool_call:
+                for block in blocks:
+                    on_tool_call(block)
+            if to_say:
+                yield { "content": to_say }
+
+        streamed_content = None
+        async for content in chat_log.async_add_delta_content_stream(agent_id, delta_stream()):
+            if isinstance(content, conversation.AssistantContent):
+                streamed_content = content
+
+        return "".join(response_chunks), streamed_content
     
+    def _response_cache_key(self, message_history: list[dict]) -> tuple | None:
+        """None if responses shouldn't be cached: it is turned off or the temperature is high enough that the model should vary its answers"""
+        if not self.entry.options.get(CONF_RESPONSE_CACHE, DEFAULT_RESPONSE_CACHE) or \
+            self.entry.options.get(CONF_TEMPERATURE, DEFAULT_TEMPERATURE) > RESPONSE_CACHE_MAX_TEMPERATURE or \
+            message_history[-1]["role"] != "user":
+            return None
+
+        model = self.entry.data.get(CONF_CHAT_MODEL) or self.entry.data.get(CONF_DOWNLOADED_MODEL_FILE)
+        return response_cache_key(message_history, model, self.entry.options)
+
+    def _store_cached_response(self, key: tuple | None, response: str, generation_failures: int) -> None:
+        """Keep the model output for identical requests, unless a backend failed while it was being generated"""
+        if key is not None and self.generation_failures == generation_failures:
+            self.response_cache.put(key, response)
+
     def _warn_context_size(self):
         num_entities = len(self._async_get_exposed_entities()[0])
         context_size = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
@@ -326,19 +718,17 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         prompt_template = self.entry.options.get(CONF_PROMPT_TEMPLATE, DEFAULT_PROMPT_TEMPLATE)
         template_desc = PROMPT_TEMPLATE_DESCRIPTIONS[prompt_template]
         refresh_system_prompt = self.entry.options.get(CONF_REFRESH_SYSTEM_PROMPT, DEFAULT_REFRESH_SYSTEM_PROMPT)
+        # the exposed devices are picked for each request, so the prompt has to be re-generated every turn
+        refresh_system_prompt = refresh_system_prompt or self.entry.options.get(CONF_DEVICE_RETRIEVAL, DEFAULT_DEVICE_RETRIEVAL)
         remember_conversation = self.entry.options.get(CONF_REMEMBER_CONVERSATION, DEFAULT_REMEMBER_CONVERSATION)
         remember_num_interactions = self.entry.options.get(CONF_REMEMBER_NUM_INTERACTIONS, DEFAULT_REMEMBER_NUM_INTERACTIONS)
-        service_call_regex = self.entry.options.get(CONF_SERVICE_CALL_REGEX, DEFAULT_SERVICE_CALL_REGEX)
+        service_call_pattern = self.service_call_pattern
 
-        try:
-            service_call_pattern = re.compile(service_call_regex, flags=re.MULTILINE)
-        except Exception as err:
-            _LOGGER.exception("There was a problem compiling the service call regex")
-            
+        if service_call_pattern is None:
             intent_response = intent.IntentResponse(language=user_input.language)
             intent_response.async_set_error(
                 intent.IntentResponseErrorCode.UNKNOWN,
-                f"Sorry, there was a problem compiling the service call regex: {err}",
+                f"Sorry, there was a problem compiling the service call regex: {self.service_call_regex_error}",
             )
             
             return ConversationResult(
@@ -372,11 +762,16 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
                 )
 
         message_history = [ _convert_content(content) for content in chat_log.content ]
+        if not remember_conversation:
+            # the chat log keeps the earlier turns; only the system prompt and the new request are sent
+            message_history = [ message for message in message_history[:1] if message["role"] == "system" ] + message_history[-1:]
         
         # re-generate prompt if necessary
         if len(message_history) == 0 or refresh_system_prompt:
             try:
-                message = self._generate_system_prompt(raw_prompt, llm_api)
+                message = await self._async_generate_system_prompt(
+                    raw_prompt, llm_api, message_history[1:], user_prompt=user_input.text,
+                )
             except TemplateError as err:
                 _LOGGER.error("Error rendering prompt: %s", err)
                 intent_response = intent.IntentResponse(language=user_input.language)
@@ -395,14 +790,51 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             else:
                 message_history[0] = system_prompt
 
+        await self._async_update_grammar(llm_api)
+
+        # tool calls are made as soon as they are generated, while the rest of the response is still being generated
+        tool_calls = ToolCallDispatcher(self.entry.options.get(CONF_MAX_PARALLEL_TOOL_CALLS, DEFAULT_MAX_PARALLEL_TOOL_CALLS))
+        tool_call_timeout = self.entry.options.get(CONF_TOOL_CALL_TIMEOUT, DEFAULT_TOOL_CALL_TIMEOUT)
+        tool_to_say = ""
+
+        def dispatch_tool_call(block: str) -> None:
+            nonlocal tool_to_say
+            try:
+                tool_input, extra_to_say = self._parse_tool_call(llm_api, block)
+            except ToolCallFailedException as err:
+                tool_calls.fail(err)
+                return
+
+            tool_to_say = tool_to_say + extra_to_say
+            tool_calls.dispatch(
+                self._tool_call_target(llm_api, tool_input),
+                lambda: self._async_call_tool(llm_api, tool_input, tool_call_timeout),
+            )
+
+        # replay the response to an identical request if there is one; its tool calls are made again
+        cache_key = self._response_cache_key(message_history)
+        cached_response = None
+        if cache_key:
+            cached_response = self.response_cache.get(cache_key, float(self.entry.options.get(CONF_RESPONSE_CACHE_TTL, DEFAULT_RESPONSE_CACHE_TTL)))
+            self.response_cache.log_metrics()
+            if cached_response is not None:
+                cache_key = None
+        generation_failures = self.generation_failures
+
         # generate a response
         try:
             _LOGGER.debug(message_history)
-            response = await self._async_generate(message_history)
+            response, streamed_content = await self._async_stream_response(
+                message_history, chat_log, user_input.agent_id, self._create_stream_splitter(service_call_pattern, template_desc),
+                on_tool_call=dispatch_tool_call if llm_api else None,
+                cached_response=cached_response,
+            )
             _LOGGER.debug(response)
+            raw_response = response
 
         except Exception as err:
             _LOGGER.exception("There was a problem talking to the backend")
+            await tool_calls.async_cancel()
             
             intent_response = intent.IntentResponse(language=user_input.language)
             intent_response.async_set_error(
@@ -419,7 +851,7 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         # remove think blocks        
         response = re.sub(rf"^.*?{template_desc["chain_of_thought"]["suffix"]}", "", response, flags=re.DOTALL)
         
-        message_history.append({"role": "assistant", "message": response})
+        message_history.append({"role": "assistant", "message": response, "content": streamed_content})
         if remember_conversation:
             if remember_num_interactions and len(message_history) > (remember_num_interactions * 2) + 1:
                 for i in range(0,2):
@@ -427,6 +859,8 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             chat_log.content = [_convert_content_back(user_input.agent_id, message_history_entry) for message_history_entry in message_history ]
 
         if llm_api is None:
+            self._store_cached_response(cache_key, raw_response, generation_failures)
+
             # return the output without messing with it if there is no API exposed to the model
             intent_response = intent.IntentResponse(language=user_input.language)
             intent_response.async_set_speech(response.strip())
@@ -434,93 +868,29 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
                 response=intent_response, conversation_id=user_input.conversation_id
             )
 
-        tool_response = None
-        # parse response
-        to_say = service_call_pattern.sub("", response.strip())
-        tool_response = None
-        for block in service_call_pattern.findall(response.strip()):
-            parsed_tool_call: dict = json.loads(block)
-
-            if llm_api.api.id == HOME_LLM_API_ID:
-                schema_to_validate = vol.Schema({
-                    vol.Required('service'): str,
-                    vol.Required('target_device'): str,
-                    vol.Optional('rgb_color'): str,
-                    vol.Optional('brightness'): vol.Coerce(float),
-                    vol.Optional('temperature'): vol.Coerce(float),
-                    vol.Optional('humidity'): vol.Coerce(float),
-                    vol.Optional('fan_mode'): str,
-                    vol.Optional('hvac_mode'): str,
-                    vol.Optional('preset_mode'): str,
-                    vol.Optional('duration'): str,
-                    vol.Optional('item'): str,
-                })
-            else:
-                schema_to_validate = vol.Schema({
-                    vol.Required("name"): str,
-                    vol.Required("arguments"): dict,
-                })
-                
-            try:
-                schema_to_validate(parsed_tool_call)
-            except vol.Error as ex:
-                _LOGGER.info(f"LLM produced an improperly formatted response: {repr(ex)}")
-
+        # wait for the tool calls that were made while the response was generated
+        to_say = service_call_pattern.sub("", response.strip()) + tool_to_say
+        try:
+            tool_responses = await tool_calls.async_results()
+        finally:
+            # every call is done unless the request itself was cancelled; don't leave them running in that case
+            await tool_calls.async_cancel()
+        for result in tool_responses:
+            if isinstance(result, ToolCallFailedException):
                 intent_response = intent.IntentResponse(language=user_input.language)
-                intent_response.async_set_error(
-                    intent.IntentResponseErrorCode.NO_INTENT_MATCH,
-                    f"I'm sorry, I didn't produce a correctly formatted tool call! Please see the logs for more info.",
-                )
+                intent_response.async_set_error(result.error_code, str(result))
                 return ConversationResult(
                     response=intent_response, conversation_id=user_input.conversation_id
                 )
+            if isinstance(result, BaseException):
+                raise result
 
-            _LOGGER.info(f"calling tool: {block}")
-
-            # try to fix certain arguments
-            args_dict = parsed_tool_call if llm_api.api.id == HOME_LLM_API_ID else parsed_tool_call["arguments"]
-
-            # make sure brightness is 0-255 and not a percentage
-            if "brightness" in args_dict and 0.0 < args_dict["brightness"] <= 1.0:
-                args_dict["brightness"] = int(args_dict["brightness"] * 255)
-
-            # convert string "tuple" to a list for RGB colors
-            if "rgb_color" in args_dict and isinstance(args_dict["rgb_color"], str):
-                args_dict["rgb_color"] = [ int(x) for x in args_dict["rgb_color"][1:-1].split(",") ]
-            
-            if llm_api.api.id == HOME_LLM_API_ID:
-                to_say = to_say + parsed_tool_call.pop("to_say", "")
-                tool_input = llm.ToolInput(
-                    tool_name=SERVICE_TOOL_NAME,
-                    tool_args=parsed_tool_call,
-                )
-            else:
-                tool_input = llm.ToolInput(
-                    tool_name=parsed_tool_call["name"],
-                    tool_args=parsed_tool_call["arguments"],
-                )
-
-            tool_response = None
-            try:
-                tool_response = await llm_api.async_call_tool(tool_input)
-                _LOGGER.debug("Tool response: %s", tool_response)
-            except (HomeAssistantError, vol.Invalid) as e:
-                tool_response = {"error": type(e).__name__}
-                if str(e):
-                    tool_response["error_text"] = str(e)
-                _LOGGER.debug("Tool response: %s", tool_response)
-
-                intent_response = intent.IntentResponse(language=user_input.language)
-                intent_response.async_set_error(
-                    intent.IntentResponseErrorCode.NO_INTENT_MATCH,
-                    f"I'm sorry! I encountered an error calling the tool. See the logs for more info.",
-                )
-                return ConversationResult(
-                    response=intent_response, conversation_id=user_input.conversation_id
-                )
+        self._store_cached_response(cache_key, raw_response, generation_failures)
 
         # handle models that generate a function call and wait for the result before providing a response
-        if self.entry.options.get(CONF_TOOL_MULTI_TURN_CHAT, DEFAULT_TOOL_MULTI_TURN_CHAT) and tool_response is not None:
+        if self.entry.options.get(CONF_TOOL_MULTI_TURN_CHAT, DEFAULT_TOOL_MULTI_TURN_CHAT) and tool_responses:
+            # a single tool response is passed on as is; several are passed as a list in the order they were called
+            tool_response = tool_responses[0] if len(tool_responses) == 1 else tool_responses
             try:
                 message_history.append({"role": "tool", "message": json.dumps(tool_response)})
             except:
@@ -529,7 +899,9 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             # generate a response based on the tool result
             try:
                 _LOGGER.debug(message_history)
-                to_say = await self._async_generate(message_history)
+                to_say, _ = await self._async_stream_response(
+                    message_history, chat_log, user_input.agent_id, self._create_stream_splitter(service_call_pattern, template_desc)
+                )
                 _LOGGER.debug(to_say)
 
             except Exception as err:
@@ -554,51 +926,176 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             response=intent_response, conversation_id=user_input.conversation_id
         )
 
+
+    def _parse_tool_call(self, llm_api: llm.APIInstance, block: str) -> tuple[llm.ToolInput, str]:
+        """Validate a tool call that the model generated. Returns the tool input and any extra text to say"""
+        try:
+            parsed_tool_call: dict = self.tool_call_validator(json.loads(block))
+        except (ValueError, vol.Error) as ex:
+            _LOGGER.info(f"LLM produced an improperly formatted response: {repr(ex)}")
+            raise ToolCallFailedException(
+                intent.IntentResponseErrorCode.NO_INTENT_MATCH,
+                f"I'm sorry, I didn't produce a correctly formatted tool call! Please see the logs for more info.",
+            ) from ex
+
+        # try to fix certain arguments
+        args_dict = parsed_tool_call if llm_api.api.id == HOME_LLM_API_ID else parsed_tool_call["arguments"]
+
+        # make sure brightness is 0-255 and not a percentage
+        if "brightness" in args_dict and 0.0 < args_dict["brightness"] <= 1.0:
+            args_dict["brightness"] = int(args_dict["brightness"] * 255)
+
+        # convert string "tuple" to a list for RGB colors
+        if "rgb_color" in args_dict and isinstance(args_dict["rgb_color"], str):
+            args_dict["rgb_color"] = [ int(x) for x in args_dict["rgb_color"][1:-1].split(",") ]
+
+        if llm_api.api.id == HOME_LLM_API_ID:
+            to_say = parsed_tool_call.pop("to_say", "")
+            tool_input = llm.ToolInput(
+                tool_name=SERVICE_TOOL_NAME,
+                tool_args=parsed_tool_call,
+            )
+        else:
+            to_say = ""
+            tool_input = llm.ToolInput(
+                tool_name=parsed_tool_call["name"],
+                tool_args=parsed_tool_call["arguments"],
+            )
+
+        return tool_input, to_say
+
+    def _tool_call_target(self, llm_api: llm.APIInstance, tool_input: llm.ToolInput) -> str | None:
+        """The device that a tool call acts on, or None if it could act on any device (e.g. everything in an area)"""
+        if llm_api.api.id == HOME_LLM_API_ID:
+            return tool_input.tool_args["target_device"]
+
+        target = tool_input.tool_args.get("name")
+        return target if isinstance(target, str) else None
+
+    async def _async_call_tool(self, llm_api: llm.APIInstance, tool_input: llm.ToolInput, timeout: float) -> Any:
+        """
+        Make a tool call and return the tool response. Calls that don't finish in time are reported to the model
+        as an error but are not treated as a failure since the device may still be processing the command.
+        """
+        _LOGGER.info(f"calling tool: {tool_input.tool_name} {tool_input.tool_args}")
+        try:
+            async with asyncio.timeout(timeout):
+                tool_response = await llm_api.async_call_tool(tool_input)
+            _LOGGER.debug("Tool response: %s", tool_response)
+        except TimeoutError:
+            _LOGGER.warning(f"Tool call {tool_input.tool_name} did not finish within {timeout} seconds")
+            tool_response = {"error": "TimeoutError", "error_text": f"The tool call did not finish within {timeout} seconds"}
+        except (HomeAssistantError, vol.Invalid) as e:
+            tool_response = {"error": type(e).__name__}
+            if str(e):
+                tool_response["error_text"] = str(e)
+            _LOGGER.debug("Tool response: %s", tool_response)
+            raise ToolCallFailedException(
+                intent.IntentResponseErrorCode.NO_INTENT_MATCH,
+                f"I'm sorry! I encountered an error calling the tool. See the logs for more info.",
+            ) from e
+
+        return tool_response
+
+    def _async_get_exposed_entity_info(self, entity_id: str) -> dict[str, Any] | None:
+        """Look up the registry info for an entity, or None if it is not exposed. Results are cached until the registries change."""
+        try:
+            return self.exposed_entity_index[entity_id]
+        except KeyError:
+            pass
+
+        if not async_should_expose(self.hass, CONVERSATION_DOMAIN, entity_id):
+            self.exposed_entity_index[entity_id] = None
+            return None
+
+        entity_registry = er.async_get(self.hass)
+        device_registry = dr.async_get(self.hass)
+        area_registry = ar.async_get(self.hass)
+
+        entity = entity_registry.async_get(entity_id)
+        device = None
+        if entity and entity.device_id:
+            device = device_registry.async_get(entity.device_id)
+
+        info = { "aliases": None, "unit_of_measurement": None, "area_id": None, "area_name": None }
+        if entity:
+            if entity.aliases:
+                info["aliases"] = entity.aliases
+            info["unit_of_measurement"] = entity.unit_of_measurement
+
+        # area could be on device or entity. prefer device area
+        area_id = None
+        if device and device.area_id:
+            area_id = device.area_id
+        if entity and entity.area_id:
+            area_id = entity.area_id
+
+        if area_id:
+            area = area_registry.async_get_area(area_id)
+            if area:
+                info["area_id"] = area.id
+                info["area_name"] = area.name
+
+        self.exposed_entity_index[entity_id] = info
+        return info
+
     def _async_get_exposed_entities(self) -> tuple[dict[str, str], list[str]]:
         """Gather exposed entity states"""
         entity_states = {}
         domains = set()
-        entity_registry = er.async_get(self.hass)
-        device_registry = dr.async_get(self.hass)
-        area_registry = ar.async_get(self.hass)
 
         for state in self.hass.states.async_all():
-            if not async_should_expose(self.hass, CONVERSATION_DOMAIN, state.entity_id):
+            info = self._async_get_exposed_entity_info(state.entity_id)
+            if info is None:
                 continue
 
-            entity = entity_registry.async_get(state.entity_id)
-            device = None
-            if entity and entity.device_id:
-                device = device_registry.async_get(entity.device_id)
-
             attributes = dict(state.attributes)
             attributes["state"] = state.state
 
-            if entity:
-                if entity.aliases:
-                    attributes["aliases"] = entity.aliases
-                    
-                if entity.unit_of_measurement:
-                    attributes["state"] = attributes["state"] + " " + entity.unit_of_measurement
-
-            # area could be on device or entity. prefer device area
-            area_id = None
-            if device and device.area_id:
-                area_id = device.area_id
-            if entity and entity.area_id:
-                area_id = entity.area_id
-            
-            if area_id:
-                area = area_registry.async_get_area(entity.area_id)
-                if area:
-                    attributes["area_id"] = area.id
-                    attributes["area_name"] = area.name
+            if info["aliases"]:
+                attributes["aliases"] = info["aliases"]
+
+            if info["unit_of_measurement"]:
+                attributes["state"] = attributes["state"] + " " + info["unit_of_measurement"]
+
+            if info["area_id"]:
+                attributes["area_id"] = info["area_id"]
+                attributes["area_name"] = info["area_name"]
             
             entity_states[state.entity_id] = attributes
             domains.add(state.domain)
 
+        if self.entry.options.get(CONF_OPTIMIZE_PROMPT_LAYOUT, DEFAULT_OPTIMIZE_PROMPT_LAYOUT):
+            entity_states = self._sort_by_last_updated(entity_states)
+
         return entity_states, list(domains)
 
+    def _sort_by_last_updated(self, entities: dict[str, dict]) -> dict[str, dict]:
+        """Sorts the entities so the ones that never changed come first and the most recently updated are at the end"""
+        entity_order = { name: None for name in entities.keys() }
+        # copied first because the event loop updates it while this runs in the executor
+        last_updated_entities = self.last_updated_entities.copy()
+        entity_order.update({ name: last_updated for name, last_updated in last_updated_entities.items() if name in entities })
+
+        def sort_key(item):
+            item_name, last_updated = item
+            # Handle cases where last updated is None
+            if last_updated is None:
+                return (False, '', item_name)
+            else:
+                return (True, last_updated, '')
+        
+        # Sort the items based on the sort_key function
+        sorted_items = sorted(list(entity_order.items()), key=sort_key)
+
+        _LOGGER.debug(f"sorted_items: {sorted_items}")
+
+        sorted_entities = {}
+        for item_name, _ in sorted_items:
+            sorted_entities[item_name] = entities[item_name]
+
+        return sorted_entities
+
     def _format_prompt(
         self, prompt: list[dict], include_generation_prompt: bool = True
     ) -> str:
@@ -628,15 +1125,7 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         _LOGGER.debug(formatted_prompt)
         return formatted_prompt
     
-    def _format_tool(self, name: str, parameters: vol.Schema, description: str):
-        style = self.entry.options.get(CONF_TOOL_FORMAT, DEFAULT_TOOL_FORMAT)
-
-        if style == TOOL_FORMAT_MINIMAL:
-            result = f"{name}({','.join(flatten_vol_schema(parameters))})"
-            if description:
-                result = result + f" - {description}"
-            return result
-        
+    def _serialize_tool_parameters(self, parameters: vol.Schema) -> list[dict]:
         raw_parameters: list = voluptuous_serialize.convert(
             parameters, custom_serializer=custom_custom_serializer)
         
@@ -652,6 +1141,19 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             else:
                 processed_parameters.append(param)
 
+        return processed_parameters
+
+    def _format_tool(self, name: str, parameters: vol.Schema, description: str):
+        style = self.entry.options.get(CONF_TOOL_FORMAT, DEFAULT_TOOL_FORMAT)
+
+        if style == TOOL_FORMAT_MINIMAL:
+            result = f"{name}({','.join(flatten_vol_schema(parameters))})"
+            if description:
+                result = result + f" - {description}"
+            return result
+        
+        processed_parameters = self._serialize_tool_parameters(parameters)
+
         if style == TOOL_FORMAT_REDUCED:
             return {
                 "name": name,
@@ -695,13 +1197,27 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         area_registry = ar.async_get(self.hass)
         all_areas = list(area_registry.async_list_areas())
 
+        if self.entry.options.get(CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES, DEFAULT_DETERMINISTIC_IN_CONTEXT_EXAMPLES):
+            # the same examples are used until the set of exposed domains changes so the prompt stays cacheable
+            cache_key = (tuple(sorted(entity_domains)), num_examples)
+            if self.icl_examples_cache and self.icl_examples_cache[0] == cache_key:
+                return self.icl_examples_cache[1]
+
+            seed = hashlib.sha256(",".join(cache_key[0]).encode()).digest()
+            rng = random.Random(int.from_bytes(seed[:8], "big"))
+            entity_names.sort()
+            all_areas.sort(key=lambda area: area.name)
+        else:
+            cache_key = None
+            rng = random
+
         in_context_examples = [
             x for x in self.in_context_examples
             if x["type"] in entity_domains
         ]
         
-        random.shuffle(in_context_examples)
-        random.shuffle(entity_names)
+        rng.shuffle(in_context_examples)
+        rng.shuffle(entity_names)
 
         num_examples_to_generate = min(num_examples, len(in_context_examples))
         if num_examples_to_generate < num_examples:
@@ -714,9 +1230,9 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             response = chosen_example["response"]
 
             random_device = [ x for x in entity_names if x.split(".")[0] == chosen_example["type"] ][0]
-            random_area = random.choice(all_areas).name
-            random_brightness = round(random.random(), 2)
-            random_color = random.choice(list(color.COLORS.keys()))
+            random_area = rng.choice(all_areas).name
+            random_brightness = round(rng.random(), 2)
+            random_color = rng.choice(list(color.COLORS.keys()))
 
             tool_arguments = {}
 
@@ -748,125 +1264,476 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
                     "arguments": tool_arguments
                 }
             })
+
+        if cache_key:
+            self.icl_examples_cache = (cache_key, examples)
             
         return examples
 
-    def _generate_system_prompt(self, prompt_template: str, llm_api: llm.APIInstance | None) -> str:
-        """Generate the system prompt with current entity states"""
-        entities_to_expose, domains = self._async_get_exposed_entities()
+    def _format_device_attributes(self, attributes: dict, extra_attributes_to_expose: list[str], compact: bool = False) -> list[str]:
+        """Format the exposed attributes. compact leaves out default values and the numbers behind color names"""
+        result = []
+        for attribute_name in extra_attributes_to_expose:
+            if attribute_name not in attributes:
+                continue
+
+            _LOGGER.debug(f"{attribute_name} = {attributes[attribute_name]}")
 
+            value = attributes[attribute_name]
+            if value is not None:
+                if compact and attribute_name in COMPACT_DEVICE_DEFAULT_ATTRIBUTE_VALUES:
+                    default_value = COMPACT_DEVICE_DEFAULT_ATTRIBUTE_VALUES[attribute_name]
+                    if (tuple(value) if isinstance(value, (list, tuple)) else value) == default_value:
+                        continue
+
+                # try to apply unit if present
+                unit_suffix = attributes.get(f"{attribute_name}_unit")
+                unit_separator = "" if compact else " "
+                if unit_suffix:
+                    value = f"{value}{unit_separator}{unit_suffix}"
+                elif attribute_name == "temperature":
+                    # try to get unit or guess otherwise
+                    suffix = "F" if value > 50 else "C"
+                    value = F"{int(value)}{unit_separator}{suffix}"
+                elif attribute_name == "rgb_color":
+                    value = closest_color(value) if compact else F"{closest_color(value)} {value}"
+                elif attribute_name == "volume_level":
+                    value = f"vol={int(value*100)}"
+                elif attribute_name == "brightness":
+                    value = f"{int(value/255*100)}%"
+                elif attribute_name == "humidity":
+                    value = f"{value}%"
+
+                result.append(str(value))
+        return result
+
+    def _format_device(
+        self, name: str, attributes: dict, extra_attributes_to_expose: list[str], encoding: str = DEFAULT_DEVICE_ENCODING
+    ) -> tuple[str, list[dict]]:
+        """
+        Render the prompt line(s) and template entries for a single entity and its aliases. The compact encoding puts
+        the aliases at the end of a single line and leaves out the domain, which is given by the group the line is in.
+        """
+        state = attributes["state"]
+        exposed_attributes = self._format_device_attributes(attributes, extra_attributes_to_expose)
+
+        if encoding == DEVICE_ENCODING_COMPACT:
+            str_attributes = ";".join([state] + self._format_device_attributes(attributes, extra_attributes_to_expose, compact=True))
+            formatted_device = f"{name.split('.', 1)[1]} '{attributes.get('friendly_name')}' {str_attributes}"
+            if "aliases" in attributes:
+                formatted_device = formatted_device + " aka " + ",".join(f"'{alias}'" for alias in attributes["aliases"])
+            formatted_device = formatted_device + "\n"
+        else:
+            str_attributes = ";".join([state] + exposed_attributes)
+            formatted_device = f"{name} '{attributes.get('friendly_name')}' = {str_attributes}\n"
+
+        devices = [{
+            "entity_id": name,
+            "name": attributes.get('friendly_name'),
+            "state": state,
+            "attributes": exposed_attributes,
+            "area_name": attributes.get("area_name"),
+            "area_id": attributes.get("area_id"),
+            "is_alias": False
+        }]
+        if "aliases" in attributes:
+            for alias in attributes["aliases"]:
+                if encoding != DEVICE_ENCODING_COMPACT:
+                    formatted_device = formatted_device + f"{name} '{alias}' = {str_attributes}\n"
+                devices.append({
+                    "entity_id": name,
+                    "name": alias,
+                    "state": state,
+                    "attributes": exposed_attributes,
+                    "area_name": attributes.get("area_name"),
+                    "area_id": attributes.get("area_id"),
+                    "is_alias": True
+                })
+
+        return formatted_device, devices
+
+    def _join_device_lines(self, entities_to_expose: dict[str, dict], device_lines: list[tuple[str, str]], encoding: str) -> str:
+        """
+        Join the (entity id, formatted device) pairs into the device block. The compact encoding groups the devices by
+        area and then by domain, in the order each group first appears, instead of repeating them on every line.
+        """
+        if encoding != DEVICE_ENCODING_COMPACT:
+            return "".join(formatted_device for _, formatted_device in device_lines)
+
+        groups: dict[str | None, dict[str, list[str]]] = {}
+        for name, formatted_device in device_lines:
+            area_name = entities_to_expose[name].get("area_name")
+            groups.setdefault(area_name, {}).setdefault(name.split(".", 1)[0], []).append(formatted_device)
+
+        result = []
+        for area_name, domains in groups.items():
+            result.append(f"## {area_name or 'No Area'}\n")
+            for domain, formatted_devices in domains.items():
+                result.append(f"{domain}:\n")
+                result.extend(formatted_devices)
+        return "".join(result)
+
+    def _render_device_section(self, formatted_devices: str, devices: list[dict], area_label: str) -> str:
+        """The device listing of the default prompt; with the compact encoding it is replaced by the compact device block"""
+        if self.entry.options.get(CONF_DEVICE_ENCODING, DEFAULT_DEVICE_ENCODING) == DEVICE_ENCODING_COMPACT:
+            return formatted_devices
+        return render_default_device_section(devices, area_label)
+
+    def _format_devices(self, entities_to_expose: dict[str, dict], relevant: set[str] | None = None) -> tuple[str, list[dict]]:
+        """
+        Build the device block for the prompt. Lines are cached per entity and only re-rendered
+        for entities that had a state or registry change since the last render. The caches always cover every exposed
+        entity; if relevant is given, only the lines of those entities are joined into the returned block.
+        """
         extra_attributes_to_expose = self.entry.options \
             .get(CONF_EXTRA_ATTRIBUTES_TO_EXPOSE, DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE)
+        encoding = self.entry.options.get(CONF_DEVICE_ENCODING, DEFAULT_DEVICE_ENCODING)
+
+        with self.device_line_lock:
+            if self.device_line_cache_settings != (encoding, tuple(extra_attributes_to_expose)):
+                self.device_line_cache = {}
+                self.device_block_cache = None
+                self.device_line_cache_settings = (encoding, tuple(extra_attributes_to_expose))
+
+            # the event loop keeps marking entities while this runs in the executor, so work on a copy and only
+            # clear the entities that were handled
+            dirty_device_lines = set(self.dirty_device_lines)
+            self.dirty_device_lines.difference_update(dirty_device_lines)
+            for name in dirty_device_lines:
+                if self.device_line_cache.pop(name, None):
+                    self.device_block_cache = None
+
+            # if nothing changed since the last render the whole block can be re-used
+            device_order = tuple(entities_to_expose.keys())
+            if not self.device_block_cache or self.device_block_cache[0] != device_order:
+                # drop lines for entities that are no longer exposed
+                if len(self.device_line_cache) > len(entities_to_expose):
+                    self.device_line_cache = {
+                        name: line for name, line in self.device_line_cache.items() if name in entities_to_expose
+                    }
+
+                formatted_devices = []
+                devices = []
+                for name, attributes in entities_to_expose.items():
+                    cached = self.device_line_cache.get(name)
+                    if not cached:
+                        cached = self._format_device(name, attributes, extra_attributes_to_expose, encoding)
+                        self.device_line_cache[name] = cached
+
+                    formatted_devices.append((name, cached[0]))
+                    devices.extend(cached[1])
+
+                formatted_block = self._join_device_lines(entities_to_expose, formatted_devices, encoding)
+                self.device_block_cache = (device_order, formatted_block, devices)
+
+            if relevant is None:
+                return self.device_block_cache[1], self.device_block_cache[2]
+
+            # every line is cached now, so the filtered block only has to be joined
+            formatted_devices = []
+            devices = []
+            for name in entities_to_expose:
+                if name in relevant:
+                    formatted_line, device_entries = self.device_line_cache[name]
+                    formatted_devices.append((name, formatted_line))
+                    devices.extend(device_entries)
+
+        return self._join_device_lines(entities_to_expose, formatted_devices, encoding), devices
+
+    async def _async_update_grammar(self, llm_api: llm.APIInstance | None) -> None:
+        """Backends that support grammars switch to the dynamic grammar for the current tools here"""
+        pass
+
+    def _async_generate_dynamic_grammar(self, base_grammar: str, llm_api: llm.APIInstance | None) -> str | None:
+        """
+        Replaces the toolcall rule of the base grammar with one that only allows the tools (or services) that are
+        available and the exposed devices. The grammar is only re-generated when any of those change.
+        Returns None if the base grammar should be used as is.
+        """
+        if not llm_api:
+            return None
+
+        entities, domains = self._async_get_exposed_entities()
+        area_names = sorted(area.name for area in ar.async_get(self.hass).async_list_areas())
+
+        if llm_api.api.id == HOME_LLM_API_ID:
+            services = {}
+            for name, schema, _ in self._async_get_home_llm_services(domains):
+                domain, service = name.split(".", 1)
+                services.setdefault(domain, {})[service] = sorted(str(argument) for argument in schema.schema.keys())
+            cache_key = (llm_api.api.id, base_grammar, json.dumps(services, sort_keys=True), tuple(sorted(entities.keys())))
+        else:
+            entity_names = sorted(set(
+                name
+                for entity_id, attributes in entities.items()
+                for name in [ attributes.get("friendly_name", entity_id), *(attributes.get("aliases") or []) ]
+            ))
+            cache_key = (llm_api.api.id, base_grammar, tuple(tool.name for tool in llm_api.tools), tuple(entity_names), tuple(area_names))
+
+        if self.dynamic_grammar_cache and self.dynamic_grammar_cache[0] == cache_key:
+            return self.dynamic_grammar_cache[1]
 
-        def expose_attributes(attributes) -> list[str]:
-            result = []
-            for attribute_name in extra_attributes_to_expose:
-                if attribute_name not in attributes:
+        if llm_api.api.id == HOME_LLM_API_ID:
+            entity_ids = {}
+            for entity_id in entities.keys():
+                entity_ids.setdefault(entity_id.split(".")[0], []).append(entity_id)
+            tool_call_rules = home_llm_tool_call_rules(services, entity_ids)
+        else:
+            # 'name' is only an entity name for the tools that target devices (they also take a domain); timers and lists name other things
+            constrained_tools = []
+            for tool in llm_api.tools:
+                parameters = self._serialize_tool_parameters(tool.parameters)
+                parameter_names = [ str(parameter["name"]) for parameter in parameters ]
+                choices = { "area": area_names }
+                if "domain" in parameter_names:
+                    choices["name"] = entity_names
+                constrained_tools.append((tool.name, parameters, choices))
+            tool_call_rules = api_tool_call_rules(constrained_tools)
+
+        grammar = with_tool_call_rules(base_grammar, tool_call_rules)
+        _LOGGER.debug(f"Generated a grammar for {len(entities)} exposed entities ({len(grammar or '')} characters)")
+        self.dynamic_grammar_cache = (cache_key, grammar)
+        return grammar
+
+    def _async_get_home_llm_services(self, domains: list[str]) -> list[tuple[str, vol.Schema, str]]:
+        """The services that the Home-LLM API allows for the exposed domains, with a schema of the arguments each one accepts"""
+        cache_key = (self.service_registry_generation, tuple(domains))
+        if self.home_llm_services_cache and self.home_llm_services_cache[0] == cache_key:
+            return self.home_llm_services_cache[1]
+
+        service_dict = self.hass.services.async_services()
+        all_services = []
+        scripts_added = False
+        for domain in domains:
+            if domain not in SERVICE_TOOL_ALLOWED_DOMAINS:
+                continue
+            
+            # scripts show up as individual services
+            if domain == "script" and not scripts_added:
+                all_services.extend([
+                    ("script.reload", vol.Schema({}), ""),
+                    ("script.turn_on", vol.Schema({}), ""),
+                    ("script.turn_off", vol.Schema({}), ""),
+                    ("script.toggle", vol.Schema({}), ""),
+                ])
+                scripts_added = True
+                continue
+            
+            for name, service in service_dict.get(domain, {}).items():
+                if name not in SERVICE_TOOL_ALLOWED_SERVICES:
                     continue
 
-                _LOGGER.debug(f"{attribute_name} = {attributes[attribute_name]}")
-
-                value = attributes[attribute_name]
-                if value is not None:
-                    # try to apply unit if present
-                    unit_suffix = attributes.get(f"{attribute_name}_unit")
-                    if unit_suffix:
-                        value = f"{value} {unit_suffix}"
-                    elif attribute_name == "temperature":
-                        # try to get unit or guess otherwise
-                        suffix = "F" if value > 50 else "C"
-                        value = F"{int(value)} {suffix}"
-                    elif attribute_name == "rgb_color":
-                        value = F"{closest_color(value)} {value}"
-                    elif attribute_name == "volume_level":
-                        value = f"vol={int(value*100)}"
-                    elif attribute_name == "brightness":
-                        value = f"{int(value/255*100)}%"
-                    elif attribute_name == "humidity":
-                        value = f"{value}%"
-
-                    result.append(str(value))
-            return result
+                args = flatten_vol_schema(service.schema)
+                args_to_expose = set(args).intersection(ALLOWED_SERVICE_CALL_ARGUMENTS)
+                service_schema = vol.Schema({
+                    vol.Optional(arg): str for arg in args_to_expose
+                })
 
-        devices = []
-        formatted_devices = ""
+                all_services.append((f"{domain}.{name}", service_schema, ""))
+
+        self.home_llm_services_cache = (cache_key, all_services)
+        return all_services
+
+    def _get_tool_descriptions(self, llm_api: llm.APIInstance, domains: list[str]) -> tuple[list, str]:
+        """
+        The tools for the prompt and the same list formatted as text. Cached until a service is registered or removed,
+        the exposed domains or the tools of the API change, or the tool format option changes.
+        """
+        tool_format = self.entry.options.get(CONF_TOOL_FORMAT, DEFAULT_TOOL_FORMAT)
+        if llm_api.api.id == HOME_LLM_API_ID:
+            available_tools = tuple(domains)
+        else:
+            available_tools = tuple((tool.name, tool.description) for tool in llm_api.tools)
+
+        cache_key = (llm_api.api.id, tool_format, self.service_registry_generation, available_tools)
+        if self.tool_description_cache and self.tool_description_cache[0] == cache_key:
+            return self.tool_description_cache[1], self.tool_description_cache[2]
+
+        if llm_api.api.id == HOME_LLM_API_ID:
+            tools = [
+                self._format_tool(*tool)
+                for tool in self._async_get_home_llm_services(domains)
+            ]
+        else:
+            tools = [
+                self._format_tool(tool.name, tool.parameters, tool.description)
+                for tool in llm_api.tools
+            ]
+
+        if tool_format == TOOL_FORMAT_MINIMAL:
+            formatted_tools = ", ".join(tools)
+        else:
+            formatted_tools = json.dumps(tools)
+
+        self.tool_description_cache = (cache_key, tools, formatted_tools)
+        return tools, formatted_tools
+
+    def _context_length(self) -> int | None:
+        """The context size of the model, or None if the backend doesn't say"""
+        return int(self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH))
+
+    def _tokens_over_context(self, system_prompt: str, conversation: list[dict]) -> int:
+        """
+        How many tokens the system prompt needs to lose to leave room for the rest of the conversation and the response.
+        Tokenizes the text, so it runs in the executor.
+        """
+        context_length = self._context_length()
+        if not context_length:
+            return 0
+
+        max_tokens = int(self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS))
+        reserved_tokens = sum(self.token_counter.count_lines(message["message"] or "") for message in conversation)
+        return self.token_counter.count_lines(system_prompt) + reserved_tokens + max_tokens + PROMPT_FORMAT_RESERVED_TOKENS - context_length
+
+    def _plan_device_budget(self, device_lines: list[tuple[str, str, str]], tokens_to_free: int) -> tuple[set[str], set[str]]:
+        """
+        Count the tokens of the (entity id, full lines, compact line) of each device, least important first, and pick
+        the devices to compact and to leave out. Tokenizes the lines, so it runs in the executor.
+        """
+        device_costs = [
+            (name, self.token_counter.count(full_line), self.token_counter.count(compact_line))
+            for name, full_line, compact_line in device_lines
+        ]
+        return plan_device_budget(device_costs, tokens_to_free)
+
+    def _async_get_requesting_area(self, llm_api: llm.APIInstance | None) -> str | None:
+        """The area of the device (e.g. a voice satellite) that the request came from"""
+        if not llm_api or not llm_api.llm_context.device_id:
+            return None
+
+        device = dr.async_get(self.hass).async_get(llm_api.llm_context.device_id)
+        return device.area_id if device else None
+
+    async def _async_fit_devices_to_context(
+        self, entities_to_expose: dict[str, dict], llm_api: llm.APIInstance | None, tokens_to_free: int
+    ) -> tuple[str, list[dict]]:
+        """
+        Build a device block that is at least tokens_to_free tokens shorter than the full one. The least important
+        devices lose their alias lines first and are then left out: unavailable devices go first, then devices outside
+        of the area the request came from, then the devices that changed least recently. Ties are broken by entity id.
+        """
+        extra_attributes_to_expose = self.entry.options \
+            .get(CONF_EXTRA_ATTRIBUTES_TO_EXPOSE, DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE)
+        encoding = self.entry.options.get(CONF_DEVICE_ENCODING, DEFAULT_DEVICE_ENCODING)
+        requesting_area = self._async_get_requesting_area(llm_api)
 
-        # expose devices and their alias as well
+        with self.device_line_lock:
+            device_lines = { name: self.device_line_cache.get(name) for name in entities_to_expose }
+        for name, attributes in entities_to_expose.items():
+            if not device_lines[name]:
+                device_lines[name] = self._format_device(name, attributes, extra_attributes_to_expose, encoding)
+
+        # the device without its aliases
+        compact_lines = {}
         for name, attributes in entities_to_expose.items():
-            state = attributes["state"]
-            exposed_attributes = expose_attributes(attributes)
-            str_attributes = ";".join([state] + exposed_attributes)
-            
-            formatted_devices = formatted_devices + f"{name} '{attributes.get('friendly_name')}' = {str_attributes}\n"
-            devices.append({
-                "entity_id": name,
-                "name": attributes.get('friendly_name'),
-                "state": state,
-                "attributes": exposed_attributes,
-                "area_name": attributes.get("area_name"),
-                "area_id": attributes.get("area_id"),
-                "is_alias": False
-            })
             if "aliases" in attributes:
-                for alias in attributes["aliases"]:
-                    formatted_devices = formatted_devices + f"{name} '{alias}' = {str_attributes}\n"
-                    devices.append({
-                        "entity_id": name,
-                        "name": alias,
-                        "state": state,
-                        "attributes": exposed_attributes,
-                        "area_name": attributes.get("area_name"),
-                        "area_id": attributes.get("area_id"),
-                        "is_alias": True
-                    })
+                attributes = { key: value for key, value in attributes.items() if key != "aliases" }
+                compact_lines[name] = self._format_device(name, attributes, extra_attributes_to_expose, encoding)[0]
+            else:
+                compact_lines[name] = device_lines[name][0]
+
+        def importance(name: str) -> tuple:
+            attributes = entities_to_expose[name]
+            return (
+                attributes["state"].split(" ", 1)[0] not in (STATE_UNAVAILABLE, STATE_UNKNOWN),
+                requesting_area is not None and attributes.get("area_id") == requesting_area,
+                self.last_updated_entities.get(name, 0.0),
+                name,
+            )
+
+        compacted, dropped = await self.hass.async_add_executor_job(
+            self._plan_device_budget,
+            [ (name, device_lines[name][0], compact_lines[name]) for name in sorted(entities_to_expose.keys(), key=importance) ],
+            tokens_to_free,
+        )
+
+        if self.device_budget_plan != (len(compacted), len(dropped)):
+            self.device_budget_plan = (len(compacted), len(dropped))
+            _LOGGER.warning(
+                f"The system prompt is {tokens_to_free} tokens too long for the context size; removed the aliases of "
+                f"{len(compacted)} and left out {len(dropped)} of the {len(entities_to_expose)} exposed devices"
+            )
+
+        formatted_devices = []
+        devices = []
+        for name in entities_to_expose.keys():
+            if name in dropped:
+                continue
+
+            formatted_device, device_entries = device_lines[name]
+            if name in compacted:
+                formatted_device = compact_lines[name]
+                device_entries = [ device for device in device_entries if not device["is_alias"] ]
+
+            formatted_devices.append((name, formatted_device))
+            devices.extend(device_entries)
+
+        return self._join_device_lines(entities_to_expose, formatted_devices, encoding), devices
+
+    def _retrieve_relevant_devices(self, entities: dict[str, dict[str, Any]], user_prompt: str) -> set[str] | None:
+        """
+        The entity ids of the devices whose name, aliases, area or entity id best match the user's request. If nothing
+        matches, None is returned and every device is kept so the model can still answer questions that don't name a
+        device or an area.
+        """
+        self.device_index.sync(entities)
+
+        top_k = int(self.entry.options.get(CONF_DEVICE_RETRIEVAL_TOP_K, DEFAULT_DEVICE_RETRIEVAL_TOP_K))
+        relevant = set(self.device_index.search(user_prompt, top_k))
+        if not relevant:
+            _LOGGER.debug("No exposed devices matched the request; exposing all %d devices", len(entities))
+            return None
+
+        _LOGGER.debug("Exposing %d of %d devices that matched the request", len(relevant), len(entities))
+        return relevant
+
+    def _get_prompt_template(self, prompt_template: str) -> tuple[template.Template, str | None]:
+        """
+        The template for the system prompt and, if it lists the devices the same way as the default prompt, the word
+        it uses for area; that listing is then rendered in Python instead of Jinja. The template is cached by the prompt
+        so it is only parsed and compiled once.
+        """
+        optimize_layout = bool(self.entry.options.get(CONF_OPTIMIZE_PROMPT_LAYOUT, DEFAULT_OPTIMIZE_PROMPT_LAYOUT))
+        cache_key = (prompt_template, optimize_layout)
+        if self.prompt_template_cache and self.prompt_template_cache[0] == cache_key:
+            return self.prompt_template_cache[1], self.prompt_template_cache[2]
+
+        if optimize_layout:
+            prompt_template = order_prompt_by_volatility(prompt_template)
+        prompt_template, area_label = replace_default_device_section(prompt_template)
+
+        compiled_template = template.Template(prompt_template, self.hass)
+        self.prompt_template_cache = (cache_key, compiled_template, area_label)
+        return compiled_template, area_label
+
+    async def _async_generate_system_prompt(
+        self, prompt_template: str, llm_api: llm.APIInstance | None, conversation: list[dict], user_prompt: str | None = None
+    ) -> str:
+        """
+        Generate the system prompt with current entity states for a request that continues the given conversation.
+        If the prompt would not fit in the context with the conversation, less important devices are compacted or left
+        out. If device retrieval is enabled, only the devices that match the words in user_prompt are exposed.
+        The entities, tools and template are all handled here on the event loop; only tokenizing the prompt to fit the
+        devices into the context is done in the executor.
+        """
+        entities_to_expose, domains = self._async_get_exposed_entities()
+
+        relevant = None
+        if user_prompt and self.entry.options.get(CONF_DEVICE_RETRIEVAL, DEFAULT_DEVICE_RETRIEVAL):
+            relevant = self._retrieve_relevant_devices(entities_to_expose, user_prompt)
+
+        compiled_template, area_label = self._get_prompt_template(prompt_template)
+
+        # expose devices and their alias as well; the line cache is kept for every exposed device, not just the
+        # relevant ones, so the next request about other devices doesn't have to format them again
+        formatted_devices, devices = self._format_devices(entities_to_expose, relevant)
+        if relevant is not None:
+            entities_to_expose = {
+                entity_id: attributes for entity_id, attributes in entities_to_expose.items() if entity_id in relevant
+            }
 
         if llm_api:
-            if llm_api.api.id == HOME_LLM_API_ID:
-                service_dict = self.hass.services.async_services()
-                all_services = []
-                scripts_added = False
-                for domain in domains:
-                    if domain not in SERVICE_TOOL_ALLOWED_DOMAINS:
-                        continue
-                    
-                    # scripts show up as individual services
-                    if domain == "script" and not scripts_added:
-                        all_services.extend([
-                            ("script.reload", vol.Schema({}), ""),
-                            ("script.turn_on", vol.Schema({}), ""),
-                            ("script.turn_off", vol.Schema({}), ""),
-                            ("script.toggle", vol.Schema({}), ""),
-                        ])
-                        scripts_added = True
-                        continue
-                    
-                    for name, service in service_dict.get(domain, {}).items():
-                        if name not in SERVICE_TOOL_ALLOWED_SERVICES:
-                            continue
-
-                        args = flatten_vol_schema(service.schema)
-                        args_to_expose = set(args).intersection(ALLOWED_SERVICE_CALL_ARGUMENTS)
-                        service_schema = vol.Schema({
-                            vol.Optional(arg): str for arg in args_to_expose
-                        })
-
-                        all_services.append((f"{domain}.{name}", service_schema, ""))
-
-                tools = [
-                    self._format_tool(*tool)
-                    for tool in all_services
-                ]
-                
-            else:
-                tools = [
-                    self._format_tool(tool.name, tool.parameters, tool.description)
-                    for tool in llm_api.tools
-                ]
-            
-            if  self.entry.options.get(CONF_TOOL_FORMAT, DEFAULT_TOOL_FORMAT) == TOOL_FORMAT_MINIMAL:
-                formatted_tools = ", ".join(tools)
-            else:
-                formatted_tools = json.dumps(tools)
+            tools, formatted_tools = self._get_tool_descriptions(llm_api, domains)
         else:
             tools = ["No tools were provided. If the user requests you interact with a device, tell them you are unable to do so."]
             formatted_tools = tools[0]
@@ -883,8 +1750,31 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
         if self.in_context_examples and llm_api:
             num_examples = int(self.entry.options.get(CONF_NUM_IN_CONTEXT_EXAMPLES, DEFAULT_NUM_IN_CONTEXT_EXAMPLES))
             render_variables["response_examples"] = self._generate_icl_examples(num_examples, list(entities_to_expose.keys()))
-        
-        return template.Template(prompt_template, self.hass).async_render(
+
+        if area_label is not None:
+            render_variables[NATIVE_DEVICE_SECTION_VARIABLE] = self._render_device_section(formatted_devices, devices, area_label)
+
+        system_prompt = compiled_template.async_render(
+            render_variables,
+            parse_result=False,
+        )
+
+        if not self.entry.options.get(CONF_FIT_DEVICES_TO_CONTEXT, DEFAULT_FIT_DEVICES_TO_CONTEXT):
+            return system_prompt
+
+        tokens_over = await self.hass.async_add_executor_job(self._tokens_over_context, system_prompt, conversation)
+        if tokens_over <= 0:
+            if self.device_budget_plan:
+                _LOGGER.info("All of the exposed devices fit in the context size again")
+                self.device_budget_plan = None
+            return system_prompt
+
+        render_variables["formatted_devices"], render_variables["devices"] = \
+            await self._async_fit_devices_to_context(entities_to_expose, llm_api, tokens_over)
+        if area_label is not None:
+            render_variables[NATIVE_DEVICE_SECTION_VARIABLE] = \
+                self._render_device_section(render_variables["formatted_devices"], render_variables["devices"], area_label)
+        return compiled_template.async_render(
             render_variables,
             parse_result=False,
         )
@@ -893,13 +1783,24 @@ class LlamaCppAgent(LocalLLMAgent):
     model_path: str
     llm: LlamaType
     grammar: Any
+    grammar_source: str | None
+    active_grammar: str | None
+    parsed_grammar: GbnfGrammar | None
     llama_cpp_module: Any
     remove_prompt_caching_listener: Callable
-    model_lock: threading.Lock
+    scheduler: ModelScheduler
     last_cache_prime: float
     last_updated_entities: dict[str, float]
     cache_refresh_after_cooldown: bool
     loaded_model_settings: dict[str, Any]
+    state_pool: LlamaStatePool | None
+    disk_state_cache: LlamaDiskStateCache | None
+    prompt_tokens_total: int
+    prompt_tokens_reused: int
+    speculative_draft: DraftAcceptanceCounter | None
+    forced_token_draft: DraftAcceptanceCounter | None
+    tokens_forced: int
+    tokens_sampled: int
 
     def _load_model(self, entry: ConfigEntry) -> None:
         self.model_path = entry.data.get(CONF_DOWNLOADED_MODEL_FILE)
@@ -934,7 +1835,12 @@ class LlamaCppAgent(LocalLLMAgent):
         self.loaded_model_settings[CONF_THREAD_COUNT] = entry.options.get(CONF_THREAD_COUNT, DEFAULT_THREAD_COUNT)
         self.loaded_model_settings[CONF_BATCH_THREAD_COUNT] = entry.options.get(CONF_BATCH_THREAD_COUNT, DEFAULT_BATCH_THREAD_COUNT)
         self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION] = entry.options.get(CONF_ENABLE_FLASH_ATTENTION, DEFAULT_ENABLE_FLASH_ATTENTION)
+        self.loaded_model_settings[CONF_SPECULATIVE_DECODING] = entry.options.get(CONF_SPECULATIVE_DECODING, DEFAULT_SPECULATIVE_DECODING)
+        self.loaded_model_settings[CONF_SPECULATIVE_NUM_TOKENS] = entry.options.get(CONF_SPECULATIVE_NUM_TOKENS, DEFAULT_SPECULATIVE_NUM_TOKENS)
+        self.loaded_model_settings[CONF_DRAFT_MODEL_FILE] = entry.options.get(CONF_DRAFT_MODEL_FILE, DEFAULT_DRAFT_MODEL_FILE)
+        self.loaded_model_settings[CONF_GBNF_BATCH_FORCED_TOKENS] = entry.options.get(CONF_GBNF_BATCH_FORCED_TOKENS, DEFAULT_GBNF_BATCH_FORCED_TOKENS)
 
+        draft_model = self._load_draft_model()
         self.llm = Llama(
             model_path=self.model_path,
             n_ctx=int(self.loaded_model_settings[CONF_CONTEXT_LENGTH]),
@@ -942,25 +1848,33 @@ class LlamaCppAgent(LocalLLMAgent):
             n_threads=int(self.loaded_model_settings[CONF_THREAD_COUNT]),
             n_threads_batch=int(self.loaded_model_settings[CONF_BATCH_THREAD_COUNT]),
             flash_attn=self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION],
+            draft_model=draft_model,
         )
         _LOGGER.debug("Model loaded")
+        self.token_counter = TokenCounter(self._count_tokens)
 
         self.grammar = None
+        self.grammar_source = None
+        self.active_grammar = None
+        self.parsed_grammar = None
         if entry.options.get(CONF_USE_GBNF_GRAMMAR, DEFAULT_USE_GBNF_GRAMMAR):
             self._load_grammar(entry.options.get(CONF_GBNF_GRAMMAR_FILE, DEFAULT_GBNF_GRAMMAR_FILE))
-            
 
-        # TODO: check about disk caching
-        # self.llm.set_cache(self.llama_cpp_module.LlamaDiskCache(
-        #     capacity_bytes=(512 * 10e8),
-        #     cache_dir=os.path.join(self.hass.config.media_dirs.get("local", self.hass.config.path("media")), "kv_cache")
-        # ))
-        
+
         self.remove_prompt_caching_listener = None
         self.last_cache_prime = None
         self.last_updated_entities = {}
         self.cache_refresh_after_cooldown = False
-        self.model_lock = threading.Lock()
+        self.scheduler = ModelScheduler()
+
+        self.state_pool = None
+        self._update_state_pool()
+
+        self.disk_state_cache = None
+        self._update_disk_state_cache()
+
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_reused = 0
 
         self.loaded_model_settings[CONF_PROMPT_CACHING_ENABLED] = entry.options.get(CONF_PROMPT_CACHING_ENABLED, DEFAULT_PROMPT_CACHING_ENABLED)
         if self.loaded_model_settings[CONF_PROMPT_CACHING_ENABLED]:
@@ -970,18 +1884,215 @@ class LlamaCppAgent(LocalLLMAgent):
                 await self._async_cache_prompt(None, None, None)
             async_call_later(self.hass, 5.0, enable_caching_after_startup)
 
+    def _count_tokens(self, text: str) -> int:
+        # only reads the vocabulary, so it doesn't wait for the model like a generation does
+        return len(self.llm.tokenize(text.encode(), add_bos=False))
+
+    def _load_draft_model(self) -> Any:
+        """Sets up the configured draft models and returns the one that should be passed to Llama (or None)"""
+        self.speculative_draft = self._load_speculative_draft()
+        self.forced_token_draft = None
+        self.tokens_forced = 0
+        self.tokens_sampled = 0
+
+        if not self.loaded_model_settings[CONF_GBNF_BATCH_FORCED_TOKENS]:
+            return self.speculative_draft
+
+        self.forced_token_draft = DraftAcceptanceCounter(GrammarForcedDraft())
+        if self.speculative_draft:
+            return ChainedDraft(self.forced_token_draft, self.speculative_draft)
+        return self.forced_token_draft
+
+    def _load_speculative_draft(self) -> DraftAcceptanceCounter | None:
+        mode = self.loaded_model_settings[CONF_SPECULATIVE_DECODING]
+        num_pred_tokens = int(self.loaded_model_settings[CONF_SPECULATIVE_NUM_TOKENS])
+
+        if mode == SPECULATIVE_DECODING_PROMPT_LOOKUP:
+            llama_speculative = importlib.import_module("llama_cpp.llama_speculative")
+            draft_model = llama_speculative.LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)
+        elif mode == SPECULATIVE_DECODING_DRAFT_MODEL:
+            draft_model_path = self.loaded_model_settings[CONF_DRAFT_MODEL_FILE]
+            if not draft_model_path or not os.path.exists(draft_model_path):
+                raise ConfigEntryError(f"Draft model was not found at '{draft_model_path}'!")
+
+            _LOGGER.debug(f"Loading draft model '{draft_model_path}'...")
+            Llama = getattr(self.llama_cpp_module, "Llama")
+            draft_model = SmallModelDraft(Llama(
+                model_path=draft_model_path,
+                n_ctx=int(self.loaded_model_settings[CONF_CONTEXT_LENGTH]),
+                n_batch=int(self.loaded_model_settings[CONF_BATCH_SIZE]),
+                n_threads=int(self.loaded_model_settings[CONF_THREAD_COUNT]),
+                n_threads_batch=int(self.loaded_model_settings[CONF_BATCH_THREAD_COUNT]),
+                flash_attn=self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION],
+            ), num_pred_tokens)
+        else:
+            return None
+
+        return DraftAcceptanceCounter(draft_model)
+
+    def _update_state_pool(self):
+        # saved states are only restored for prompt caching
+        pool_size = int(self.entry.options.get(CONF_PROMPT_CACHING_POOL_SIZE, DEFAULT_PROMPT_CACHING_POOL_SIZE)) \
+            if self.entry.options.get(CONF_PROMPT_CACHING_ENABLED, DEFAULT_PROMPT_CACHING_ENABLED) else 0
+        if self.state_pool is not None and self.loaded_model_settings.get(CONF_PROMPT_CACHING_POOL_SIZE) == pool_size:
+            return
+
+        self.loaded_model_settings[CONF_PROMPT_CACHING_POOL_SIZE] = pool_size
+        self.state_pool = LlamaStatePool(pool_size * 1024 * 1024) if pool_size > 0 else None
+
+    def _disk_state_cache_version(self) -> str:
+        """Saved states are only valid for the same model file, prompt format, context settings and llama.cpp version"""
+        version_info = [
+            model_fingerprint(self.model_path),
+            self.entry.options.get(CONF_PROMPT_TEMPLATE, DEFAULT_PROMPT_TEMPLATE),
+            self.loaded_model_settings[CONF_CONTEXT_LENGTH],
+            self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION],
+            self.loaded_model_settings[CONF_SPECULATIVE_DECODING] != SPECULATIVE_DECODING_NONE or self.loaded_model_settings[CONF_GBNF_BATCH_FORCED_TOKENS], # logits are kept for every token when drafting
+            getattr(self.llama_cpp_module, "__version__", ""),
+        ]
+        return hashlib.sha256(json.dumps(version_info).encode()).hexdigest()[:16]
+
+    def _update_disk_state_cache(self):
+        disk_size = int(self.entry.options.get(CONF_PROMPT_CACHING_DISK_SIZE, DEFAULT_PROMPT_CACHING_DISK_SIZE)) \
+            if self.entry.options.get(CONF_PROMPT_CACHING_ENABLED, DEFAULT_PROMPT_CACHING_ENABLED) else 0
+        version = self._disk_state_cache_version() if disk_size > 0 else None
+
+        if self.disk_state_cache is not None:
+            if self.disk_state_cache.version == version and self.disk_state_cache.capacity_bytes == disk_size * 1024 * 1024:
+                return
+            self.disk_state_cache.close()
+            self.disk_state_cache = None
+
+        if not version:
+            return
+
+        cache_dir = os.path.join(self.hass.config.media_dirs.get("local", self.hass.config.path("media")), "kv_cache", self.entry_id)
+        disk_state_cache = LlamaDiskStateCache(cache_dir, version, disk_size * 1024 * 1024, getattr(self.llama_cpp_module, "LlamaState"))
+        try:
+            disk_state_cache.load()
+        except OSError:
+            _LOGGER.exception(f"Failed to load the prompt cache from '{cache_dir}'")
+            return
+
+        self.disk_state_cache = disk_state_cache
+
+    def _save_current_state(self) -> None:
+        """Add the currently evaluated context to the state pool and write it to the disk cache in the background"""
+        if (self.state_pool is None and self.disk_state_cache is None) or self.llm.n_tokens == 0:
+            return
+
+        evaluated_tokens = self.llm.input_ids[:self.llm.n_tokens].tolist()
+        in_pool = self.state_pool is None or evaluated_tokens in self.state_pool
+        on_disk = self.disk_state_cache is None or evaluated_tokens in self.disk_state_cache
+        if in_pool and on_disk:
+            return
+
+        state = self.llm.save_state()
+        if not in_pool:
+            self.state_pool.add(evaluated_tokens, state)
+        if not on_disk:
+            self.hass.loop.call_soon_threadsafe(
+                self.hass.async_add_executor_job, self.disk_state_cache.add, evaluated_tokens, state
+            )
+
+    def _prepare_context(self, input_tokens: list[int]) -> None:
+        """
+        Make sure the model resumes from the longest already evaluated prefix of the prompt.
+        The current context is saved before it gets overwritten so the conversation it belongs to can pick it back up later.
+        Must be called from a scheduler job.
+        """
+        if self.state_pool is None and self.disk_state_cache is None:
+            return
+
+        evaluated_tokens = self.llm.input_ids[:self.llm.n_tokens]
+        current_prefix = common_prefix_length(evaluated_tokens, input_tokens)
+        if current_prefix < self.llm.n_tokens:
+            self._save_current_state()
+
+        best_state, best_prefix = None, current_prefix
+        for cache in (self.state_pool, self.disk_state_cache):
+            if cache is None:
+                continue
+            state, saved_prefix = cache.find(input_tokens)
+            if state is not None and saved_prefix > best_prefix:
+                best_state, best_prefix = state, saved_prefix
+
+        if best_state is not None:
+            _LOGGER.debug(f"Restoring saved state that shares {best_prefix} tokens with the prompt (current context shares {current_prefix})")
+            self.llm.load_state(best_state)
+
+    def _record_prompt_reuse(self, input_tokens: list[int]) -> None:
+        """Track how much of each prompt is already evaluated in the context and doesn't need to be processed again"""
+        reused_tokens = common_prefix_length(self.llm.input_ids[:self.llm.n_tokens], input_tokens)
+        self.prompt_tokens_total += len(input_tokens)
+        self.prompt_tokens_reused += reused_tokens
+        _LOGGER.debug(f"Reusing {reused_tokens} of {len(input_tokens)} prompt tokens (hit ratio {self.prompt_cache_hit_ratio:.2f})")
+
+    @property
+    def prompt_cache_hit_ratio(self) -> float:
+        if not self.prompt_tokens_total:
+            return 0.0
+        return self.prompt_tokens_reused / self.prompt_tokens_total
+
+    @property
+    def extra_state_attributes(self) -> dict[str, Any]:
+        attributes = {
+            "prompt_tokens_total": self.prompt_tokens_total,
+            "prompt_tokens_reused": self.prompt_tokens_reused,
+            "prompt_cache_hit_ratio": round(self.prompt_cache_hit_ratio, 3),
+            **self.scheduler.metrics(),
+        }
+        if self.speculative_draft:
+            attributes["speculative_tokens_drafted"] = self.speculative_draft.total_drafted
+            attributes["speculative_tokens_accepted"] = self.speculative_draft.total_accepted
+            attributes["speculative_acceptance_rate"] = round(self.speculative_draft.acceptance_rate, 3)
+        if self.forced_token_draft:
+            attributes["tokens_forced"] = self.tokens_forced
+            attributes["tokens_sampled"] = self.tokens_sampled
+        return attributes
+
     def _load_grammar(self, filename: str):
-        LlamaGrammar = getattr(self.llama_cpp_module, "LlamaGrammar")
         _LOGGER.debug(f"Loading grammar {filename}...")
         try:
             with open(os.path.join(os.path.dirname(__file__), filename)) as f:
                 grammar_str = "".join(f.readlines())
-            self.grammar = LlamaGrammar.from_string(grammar_str)
+            self._set_grammar(grammar_str)
+            self.grammar_source = grammar_str
             self.loaded_model_settings[CONF_GBNF_GRAMMAR_FILE] = filename
             _LOGGER.debug("Loaded grammar")
         except Exception:
             _LOGGER.exception("Failed to load grammar!")
             self.grammar = None
+            self.grammar_source = None
+            self.active_grammar = None
+            self.parsed_grammar = None
+
+    def _set_grammar(self, grammar_str: str):
+        LlamaGrammar = getattr(self.llama_cpp_module, "LlamaGrammar")
+        self.grammar = LlamaGrammar.from_string(grammar_str)
+        self.active_grammar = grammar_str
+        self.parsed_grammar = None
+        try:
+            self.parsed_grammar = GbnfGrammar(grammar_str)
+        except GrammarParseException:
+            _LOGGER.warning("Failed to parse the grammar; tokens forced by it will not be batched", exc_info=True)
+
+    async def _async_update_grammar(self, llm_api: llm.APIInstance | None) -> None:
+        if not self.grammar or not self.grammar_source:
+            return
+
+        grammar_str = self.grammar_source
+        if self.entry.options.get(CONF_GBNF_DYNAMIC_GRAMMAR, DEFAULT_GBNF_DYNAMIC_GRAMMAR):
+            grammar_str = self._async_generate_dynamic_grammar(self.grammar_source, llm_api) or self.grammar_source
+
+        if grammar_str == self.active_grammar:
+            return
+
+        try:
+            await self.hass.async_add_executor_job(self._set_grammar, grammar_str)
+        except Exception:
+            _LOGGER.exception("Failed to compile the generated grammar; using the grammar file instead")
+            await self.hass.async_add_executor_job(self._set_grammar, self.grammar_source)
 
     def _update_options(self):
         LocalLLMAgent._update_options(self)
@@ -991,7 +2102,11 @@ class LlamaCppAgent(LocalLLMAgent):
             self.loaded_model_settings[CONF_BATCH_SIZE] != self.entry.options.get(CONF_BATCH_SIZE, DEFAULT_BATCH_SIZE) or \
             self.loaded_model_settings[CONF_THREAD_COUNT] != self.entry.options.get(CONF_THREAD_COUNT, DEFAULT_THREAD_COUNT) or \
             self.loaded_model_settings[CONF_BATCH_THREAD_COUNT] != self.entry.options.get(CONF_BATCH_THREAD_COUNT, DEFAULT_BATCH_THREAD_COUNT) or \
-            self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION] != self.entry.options.get(CONF_ENABLE_FLASH_ATTENTION, DEFAULT_ENABLE_FLASH_ATTENTION):
+            self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION] != self.entry.options.get(CONF_ENABLE_FLASH_ATTENTION, DEFAULT_ENABLE_FLASH_ATTENTION) or \
+            self.loaded_model_settings[CONF_SPECULATIVE_DECODING] != self.entry.options.get(CONF_SPECULATIVE_DECODING, DEFAULT_SPECULATIVE_DECODING) or \
+            self.loaded_model_settings[CONF_SPECULATIVE_NUM_TOKENS] != self.entry.options.get(CONF_SPECULATIVE_NUM_TOKENS, DEFAULT_SPECULATIVE_NUM_TOKENS) or \
+            self.loaded_model_settings[CONF_DRAFT_MODEL_FILE] != self.entry.options.get(CONF_DRAFT_MODEL_FILE, DEFAULT_DRAFT_MODEL_FILE) or \
+            self.loaded_model_settings[CONF_GBNF_BATCH_FORCED_TOKENS] != self.entry.options.get(CONF_GBNF_BATCH_FORCED_TOKENS, DEFAULT_GBNF_BATCH_FORCED_TOKENS):
 
             _LOGGER.debug(f"Reloading model '{self.model_path}'...")
             self.loaded_model_settings[CONF_CONTEXT_LENGTH] = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
@@ -999,7 +2114,12 @@ class LlamaCppAgent(LocalLLMAgent):
             self.loaded_model_settings[CONF_THREAD_COUNT] = self.entry.options.get(CONF_THREAD_COUNT, DEFAULT_THREAD_COUNT)
             self.loaded_model_settings[CONF_BATCH_THREAD_COUNT] = self.entry.options.get(CONF_BATCH_THREAD_COUNT, DEFAULT_BATCH_THREAD_COUNT)
             self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION] = self.entry.options.get(CONF_ENABLE_FLASH_ATTENTION, DEFAULT_ENABLE_FLASH_ATTENTION)
+            self.loaded_model_settings[CONF_SPECULATIVE_DECODING] = self.entry.options.get(CONF_SPECULATIVE_DECODING, DEFAULT_SPECULATIVE_DECODING)
+            self.loaded_model_settings[CONF_SPECULATIVE_NUM_TOKENS] = self.entry.options.get(CONF_SPECULATIVE_NUM_TOKENS, DEFAULT_SPECULATIVE_NUM_TOKENS)
+            self.loaded_model_settings[CONF_DRAFT_MODEL_FILE] = self.entry.options.get(CONF_DRAFT_MODEL_FILE, DEFAULT_DRAFT_MODEL_FILE)
+            self.loaded_model_settings[CONF_GBNF_BATCH_FORCED_TOKENS] = self.entry.options.get(CONF_GBNF_BATCH_FORCED_TOKENS, DEFAULT_GBNF_BATCH_FORCED_TOKENS)
 
+            draft_model = self._load_draft_model()
             Llama = getattr(self.llama_cpp_module, "Llama")
             self.llm = Llama(
                 model_path=self.model_path,
@@ -1008,10 +2128,17 @@ class LlamaCppAgent(LocalLLMAgent):
                 n_threads=int(self.loaded_model_settings[CONF_THREAD_COUNT]),
                 n_threads_batch=int(self.loaded_model_settings[CONF_BATCH_THREAD_COUNT]),
                 flash_attn=self.loaded_model_settings[CONF_ENABLE_FLASH_ATTENTION],
+                draft_model=draft_model,
             )
             _LOGGER.debug("Model loaded")
             model_reloaded = True
 
+            # saved states belong to the old context
+            self.state_pool = None
+
+        self._update_state_pool()
+        self._update_disk_state_cache()
+
         if self.entry.options.get(CONF_USE_GBNF_GRAMMAR, DEFAULT_USE_GBNF_GRAMMAR):
             current_grammar = self.entry.options.get(CONF_GBNF_GRAMMAR_FILE, DEFAULT_GBNF_GRAMMAR_FILE)
             if not self.grammar or self.loaded_model_settings[CONF_GBNF_GRAMMAR_FILE] != current_grammar:
@@ -1036,31 +2163,12 @@ class LlamaCppAgent(LocalLLMAgent):
         """Takes the super class function results and sorts the entities with the recently updated at the end"""
         entities, domains = LocalLLMAgent._async_get_exposed_entities(self)
 
-        # ignore sorting if prompt caching is disabled
-        if not self.entry.options.get(CONF_PROMPT_CACHING_ENABLED, DEFAULT_PROMPT_CACHING_ENABLED):
+        # ignore sorting if prompt caching is disabled or if the entities were already sorted for the prompt layout
+        if not self.entry.options.get(CONF_PROMPT_CACHING_ENABLED, DEFAULT_PROMPT_CACHING_ENABLED) or \
+            self.entry.options.get(CONF_OPTIMIZE_PROMPT_LAYOUT, DEFAULT_OPTIMIZE_PROMPT_LAYOUT):
             return entities, domains
-        
-        entity_order = { name: None for name in entities.keys() }
-        entity_order.update(self.last_updated_entities)
-
-        def sort_key(item):
-            item_name, last_updated = item
-            # Handle cases where last updated is None
-            if last_updated is None:
-                return (False, '', item_name)
-            else:
-                return (True, last_updated, '')
-        
-        # Sort the items based on the sort_key function
-        sorted_items = sorted(list(entity_order.items()), key=sort_key)
-
-        _LOGGER.debug(f"sorted_items: {sorted_items}")
-
-        sorted_entities = {}
-        for item_name, _ in sorted_items:
-            sorted_entities[item_name] = entities[item_name]
 
-        return sorted_entities, domains
+        return self._sort_by_last_updated(entities), domains
 
     def _set_prompt_caching(self, *, enabled=True):
         if enabled and not self.remove_prompt_caching_listener:
@@ -1068,7 +2176,7 @@ class LlamaCppAgent(LocalLLMAgent):
 
             entity_ids = [ 
                 state.entity_id for state in self.hass.states.async_all() \
-                    if async_should_expose(self.hass, CONVERSATION_DOMAIN, state.entity_id) 
+                    if self._async_get_exposed_entity_info(state.entity_id) is not None
             ]
 
             _LOGGER.debug(f"watching entities: {entity_ids}")
@@ -1087,6 +2195,20 @@ class LlamaCppAgent(LocalLLMAgent):
         if entity:
             self.last_updated_entities[entity] = refresh_start
 
+        # the exposed devices depend on each request, so no primed prompt could be re-used
+        if self.entry.options.get(CONF_DEVICE_RETRIEVAL, DEFAULT_DEVICE_RETRIEVAL):
+            return
+
+        # if a refresh is already scheduled then exit
+        if self.cache_refresh_after_cooldown:
+            return
+        
+        # if we are inside the cooldown period, request a refresh and exit
+        fastest_prime_interval = self.entry.options.get(CONF_PROMPT_CACHING_INTERVAL, DEFAULT_PROMPT_CACHING_INTERVAL)
+        if self.last_cache_prime and refresh_start - self.last_cache_prime < fastest_prime_interval:
+            self.cache_refresh_after_cooldown = True
+            return
+
         llm_api: llm.APIInstance | None = None
         if self.entry.options.get(CONF_LLM_HASS_API):
             try:
@@ -1098,61 +2220,40 @@ class LlamaCppAgent(LocalLLMAgent):
                 return
 
         _LOGGER.debug(f"refreshing cached prompt because {entity} changed...")
-        await self.hass.async_add_executor_job(self._cache_prompt, llm_api)
+        raw_prompt = self.entry.options.get(CONF_PROMPT, DEFAULT_PROMPT)
+        system_prompt = await self._async_generate_system_prompt(raw_prompt, llm_api, [])
+        await self.hass.async_add_executor_job(self._cache_prompt, system_prompt)
 
         refresh_end = time.time()
         _LOGGER.debug(f"cache refresh took {(refresh_end - refresh_start):.2f} sec")
 
-    def _cache_prompt(self, llm_api: llm.APIInstance | None) -> None:
-        # if a refresh is already scheduled then exit
-        if self.cache_refresh_after_cooldown:
-            return
-        
-        # if we are inside the cooldown period, request a refresh and exit
-        current_time = time.time()
-        fastest_prime_interval = self.entry.options.get(CONF_PROMPT_CACHING_INTERVAL, DEFAULT_PROMPT_CACHING_INTERVAL)
-        if self.last_cache_prime and current_time - self.last_cache_prime < fastest_prime_interval:
-            self.cache_refresh_after_cooldown = True
-            return
-        
-        # try to acquire the lock, if we are still running for some reason, request a refresh and exit
-        lock_acquired = self.model_lock.acquire(False)
-        if not lock_acquired:
-            self.cache_refresh_after_cooldown = True
-            return
-        
+    def _cache_prompt(self, system_prompt: str) -> None:
+        # wait for the model; a newer priming request replaces this one since its prompt would be outdated
         try:
-            raw_prompt = self.entry.options.get(CONF_PROMPT, DEFAULT_PROMPT)
-            prompt = self._format_prompt([
-                { "role": "system", "message": self._generate_system_prompt(raw_prompt, llm_api)},
-                { "role": "user", "message": "" }
-            ], include_generation_prompt=False)
-        
-            input_tokens = self.llm.tokenize(
-                prompt.encode(), add_bos=False
-            )
-
-            temperature = self.entry.options.get(CONF_TEMPERATURE, DEFAULT_TEMPERATURE)
-            top_k = int(self.entry.options.get(CONF_TOP_K, DEFAULT_TOP_K))
-            top_p = self.entry.options.get(CONF_TOP_P, DEFAULT_TOP_P)
-            grammar = self.grammar if self.entry.options.get(CONF_USE_GBNF_GRAMMAR, DEFAULT_USE_GBNF_GRAMMAR) else None
+            with self.scheduler.job(PRIORITY_PRIME, replace_queued=True) as job:
+                prompt = self._format_prompt([
+                    { "role": "system", "message": system_prompt },
+                    { "role": "user", "message": "" }
+                ], include_generation_prompt=False)
+            
+                input_tokens = self.llm.tokenize(
+                    prompt.encode(), add_bos=False
+                )
 
-            _LOGGER.debug(f"Options: {self.entry.options}")
+                self._prepare_context(input_tokens)
 
-            _LOGGER.debug(f"Processing {len(input_tokens)} input tokens...")
-
-            # grab just one token. should prime the kv cache with the system prompt
-            next(self.llm.generate(
-                input_tokens,
-                temp=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                grammar=grammar
-            ))
+                _LOGGER.debug(f"Processing {len(input_tokens)} input tokens...")
 
-            self.last_cache_prime = time.time()
-        finally:
-            self.model_lock.release()
+                if self._evaluate_prompt(input_tokens, job):
+                    self._save_current_state()
+                    self.last_cache_prime = time.time()
+                elif not job.cancelled:
+                    # interrupted by a user request; finish priming after the cooldown
+                    _LOGGER.debug("Prompt caching was interrupted by a user request")
+                    self.cache_refresh_after_cooldown = True
+        except JobCancelledException:
+            _LOGGER.debug("Prompt caching request was replaced by a newer one")
+            return
 
         
         # schedule a refresh using async_call_later
@@ -1163,18 +2264,57 @@ class LlamaCppAgent(LocalLLMAgent):
             if self.cache_refresh_after_cooldown:
                 self.cache_refresh_after_cooldown = False
 
-                refresh_start = time.time()
                 _LOGGER.debug(f"refreshing cached prompt after cooldown...")
-                await self.hass.async_add_executor_job(self._cache_prompt)
-
-                refresh_end = time.time()
-                _LOGGER.debug(f"cache refresh took {(refresh_end - refresh_start):.2f} sec")
+                await self._async_cache_prompt(None, None, None)
 
         refresh_delay = self.entry.options.get(CONF_PROMPT_CACHING_INTERVAL, DEFAULT_PROMPT_CACHING_INTERVAL)
         async_call_later(self.hass, float(refresh_delay), refresh_if_requested)
         
     
+    def _evaluate_prompt(self, input_tokens: list[int], job: ModelJob) -> bool:
+        """
+        Evaluate the prompt into the KV cache one batch at a time so that a waiting user request can interrupt it.
+        Returns False if the evaluation was interrupted.
+        """
+        batch_size = int(self.loaded_model_settings[CONF_BATCH_SIZE])
+        self.llm.n_tokens = common_prefix_length(self.llm.input_ids[:self.llm.n_tokens], input_tokens)
+
+        for start in range(self.llm.n_tokens, len(input_tokens), batch_size):
+            if job.should_yield:
+                return False
+            self.llm.eval(input_tokens[start:start + batch_size])
+
+        return True
+
     def _generate(self, conversation: dict) -> str:
+        return "".join(self._generate_stream(conversation))
+
+    async def _async_generate_stream(self, conversation: dict, conversation_id: str | None = None) -> AsyncGenerator[str]:
+        """Runs the generation in the executor and hands each piece of text back to the event loop as soon as it is decoded"""
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def produce() -> None:
+            generator = self._generate_stream(conversation)
+            try:
+                for text in generator:
+                    if cancelled.is_set():
+                        break
+                    self.hass.loop.call_soon_threadsafe(queue.put_nowait, text)
+            finally:
+                generator.close() # lets the next job use the model
+                self.hass.loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        generation = self.hass.async_add_executor_job(produce)
+        try:
+            while (text := await queue.get()) is not None:
+                yield text
+            await generation
+        finally:
+            # stop generating if the consumer stops listening
+            cancelled.set()
+
+    def _generate_stream(self, conversation: dict) -> Generator[str]:
         prompt = self._format_prompt(conversation)
 
         max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
@@ -1186,7 +2326,7 @@ class LlamaCppAgent(LocalLLMAgent):
 
         _LOGGER.debug(f"Options: {self.entry.options}")
 
-        with self.model_lock:
+        with self.scheduler.job(PRIORITY_USER):
             input_tokens = self.llm.tokenize(
                 prompt.encode(), add_bos=False
             )
@@ -1200,6 +2340,15 @@ class LlamaCppAgent(LocalLLMAgent):
             if len(input_tokens) + max_tokens >= context_len:
                 self._warn_context_size()
 
+            self._prepare_context(input_tokens)
+            self._record_prompt_reuse(input_tokens)
+
+            if self.speculative_draft:
+                self.speculative_draft.reset()
+            if self.forced_token_draft:
+                self.forced_token_draft.reset()
+                self.forced_token_draft.draft_model.reset(self.llm, self.parsed_grammar if self.grammar else None, len(input_tokens))
+
             _LOGGER.debug(f"Processing {len(input_tokens)} input tokens...")
             output_tokens = self.llm.generate(
                 input_tokens,
@@ -1211,26 +2360,41 @@ class LlamaCppAgent(LocalLLMAgent):
                 grammar=self.grammar
             )
 
-            result_tokens = []
+            # tokens can split multi-byte characters so decode incrementally
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            num_result_tokens = 0
             for token in output_tokens:
                 if token == self.llm.token_eos():
                     break
 
-                result_tokens.append(token)
+                num_result_tokens += 1
+                if text := decoder.decode(self.llm.detokenize([token])):
+                    yield text
 
-                if len(result_tokens) >= max_tokens:
+                if num_result_tokens >= max_tokens:
                     break
 
-            result = self.llm.detokenize(result_tokens).decode()
+            if text := decoder.decode(b"", final=True):
+                yield text
 
-        return result
+            if self.speculative_draft:
+                self.speculative_draft.log_generation()
+            if self.forced_token_draft:
+                tokens_forced = min(self.forced_token_draft.accepted, num_result_tokens)
+                self.tokens_forced += tokens_forced
+                self.tokens_sampled += num_result_tokens - tokens_forced
+                _LOGGER.debug(f"Response had {tokens_forced} tokens forced by the grammar and {num_result_tokens - tokens_forced} sampled tokens")
     
 class GenericOpenAIAPIAgent(LocalLLMAgent):
     api_host: str
     api_key: str
     model_name: str
+    last_usage: dict[str, Any] | None = None
+    stream_include_usage: bool
 
     async def _async_load_model(self, entry: ConfigEntry) -> None:
+        # servers that reject stream_options are asked again without it, and not sent it again until the next reload
+        self.stream_include_usage = True
         self.api_host = format_url(
             hostname=entry.data[CONF_HOST],
             port=entry.data[CONF_PORT],
@@ -1241,6 +2405,18 @@ class GenericOpenAIAPIAgent(LocalLLMAgent):
         self.api_key = entry.data.get(CONF_OPENAI_API_KEY)
         self.model_name = entry.data.get(CONF_CHAT_MODEL)
 
+        self.request_headers = {}
+        if self.api_key:
+            self.request_headers["Authorization"] = f"Bearer {self.api_key}"
+        self._async_use_connection_pool(entry, self.api_host)
+
+    def _keep_warm_endpoint(self) -> str:
+        api_base_path = self.entry.data.get(CONF_GENERIC_OPENAI_PATH, DEFAULT_GENERIC_OPENAI_PATH)
+        return f"/{api_base_path}/models"
+
+    def _context_length(self) -> int | None:
+        """The context size is configured on the server and isn't known here"""
+        return None
 
     def _chat_completion_params(self, conversation: dict) -> (str, dict):
         request_params = {}
@@ -1260,21 +2436,27 @@ class GenericOpenAIAPIAgent(LocalLLMAgent):
 
         return endpoint, request_params
     
-    def _extract_response(self, response_json: dict) -> str:
-        choices = response_json["choices"]
-        if choices[0]["finish_reason"] != "stop":
+    def _extract_stream_response(self, chunk_json: dict) -> str:
+        if usage := chunk_json.get("usage"):
+            self.last_usage = usage
+            _LOGGER.debug("Token usage: %s", usage)
+
+        choices = chunk_json.get("choices")
+        if not choices:
+            return ""
+
+        if choices[0].get("finish_reason") not in [None, "stop"]:
             _LOGGER.warning("Model response did not end on a stop token (unfinished sentence)")
 
-        if response_json["object"] in ["chat.completion", "chat.completion.chunk"]:
-            return choices[0]["message"]["content"]
+        if "delta" in choices[0]:
+            return choices[0]["delta"].get("content") or ""
         else:
-            return choices[0]["text"]
-    
-    async def _async_generate(self, conversation: dict) -> str:
+            return choices[0].get("text") or ""
+
+    def _generate_request(self, conversation: dict) -> tuple[str, dict, dict]:
         max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
         temperature = self.entry.options.get(CONF_TEMPERATURE, DEFAULT_TEMPERATURE)
         top_p = self.entry.options.get(CONF_TOP_P, DEFAULT_TOP_P)
-        timeout = self.entry.options.get(CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT)
         use_chat_api = self.entry.options.get(CONF_REMOTE_USE_CHAT_ENDPOINT, DEFAULT_REMOTE_USE_CHAT_ENDPOINT)
         
 
@@ -1292,32 +2474,51 @@ class GenericOpenAIAPIAgent(LocalLLMAgent):
         
         request_params.update(additional_params)
 
-        headers = {}
-        if self.api_key:
-            headers["Authorization"] = f"Bearer {self.api_key}"
+        return endpoint, request_params, self.request_headers
+    
+    async def _async_generate(self, conversation: dict) -> str:
+        """The response is always streamed so the body never has to be buffered and parsed all at once"""
+        return "".join([ text async for text in self._async_generate_stream(conversation) ])
+
+    async def _async_generate_stream(self, conversation: dict, conversation_id: str | None = None) -> AsyncGenerator[str]:
+        timeout = self.entry.options.get(CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT)
+        endpoint, request_params, headers = self._generate_request(conversation)
+        request_params["stream"] = True
+
+        async def send_request(backend: BackendEndpoint) -> AsyncGenerator[dict]:
+            include_usage = self.stream_include_usage
+            while True:
+                params = { **request_params, "stream_options": { "include_usage": True } } if include_usage else request_params
+                async with backend.connection_pool.session.post(
+                    f"{backend.base_url}{endpoint}",
+                    json=params,
+                    timeout=timeout,
+                    headers=headers
+                ) as response:
+                    if include_usage and response.status in (400, 422):
+                        _LOGGER.debug("%s rejected stream_options; requesting the response without the token usage", backend.base_url)
+                        self.stream_include_usage = include_usage = False
+                        continue
+                    response.raise_for_status()
+
+                    # server sent events; the last chunk has the token usage if the server reports it
+                    async for chunk in async_iterate_json_stream(response.content.iter_any(), server_sent_events=True):
+                        yield chunk
+                    return
 
-        session = async_get_clientsession(self.hass)
-        response = None
         try:
-            async with session.post(
-                f"{self.api_host}{endpoint}",
-                json=request_params,
-                timeout=timeout,
-                headers=headers
-            ) as response:
-                response.raise_for_status()
-                result = await response.json()
+            async with aclosing(self._async_stream_from_endpoints(send_request)) as chunks:
+                async for chunk in chunks:
+                    if text := self._extract_stream_response(chunk):
+                        yield text
         except asyncio.TimeoutError:
-            return "The generation request timed out! Please check your connection settings, increase the timeout in settings, or decrease the number of exposed entities."
+            self.generation_failures += 1
+            yield "The generation request timed out! Please check your connection settings, increase the timeout in settings, or decrease the number of exposed entities."
         except aiohttp.ClientError as err:
+            self.generation_failures += 1
             _LOGGER.debug(f"Err was: {err}")
             _LOGGER.debug(f"Request was: {request_params}")
-            _LOGGER.debug(f"Result was: {response}")
-            return f"Failed to communicate with the API! {err}"
-
-        _LOGGER.debug(result)
-
-        return self._extract_response(result)
+            yield f"Failed to communicate with the API! {err}"
         
 class TextGenerationWebuiAgent(GenericOpenAIAPIAgent):
     admin_key: str
@@ -1328,7 +2529,7 @@ class TextGenerationWebuiAgent(GenericOpenAIAPIAgent):
 
         try:
             headers = {}
-            session = async_get_clientsession(self.hass)
+            session = self.connection_pool.session
 
             if self.admin_key:
                 headers["Authorization"] = f"Bearer {self.admin_key}"
@@ -1362,6 +2563,10 @@ class TextGenerationWebuiAgent(GenericOpenAIAPIAgent):
             _LOGGER.debug("Connection error was: %s", repr(ex))
             raise ConfigEntryNotReady("There was a problem connecting to the remote server") from ex
 
+    def _context_length(self) -> int | None:
+        """text-generation-webui truncates the prompt to the configured context size"""
+        return int(self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH))
+
     def _chat_completion_params(self, conversation: dict) -> (str, dict):
         preset = self.entry.options.get(CONF_TEXT_GEN_WEBUI_PRESET)
         chat_mode = self.entry.options.get(CONF_TEXT_GEN_WEBUI_CHAT_MODE, DEFAULT_TEXT_GEN_WEBUI_CHAT_MODE)
@@ -1397,25 +2602,19 @@ class TextGenerationWebuiAgent(GenericOpenAIAPIAgent):
 
         return endpoint, request_params
     
-    def _extract_response(self, response_json: dict) -> str:
-        choices = response_json["choices"]
-        if choices[0]["finish_reason"] != "stop":
-            _LOGGER.warning("Model response did not end on a stop token (unfinished sentence)")
-
-        context_len = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
-        max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
-        if response_json["usage"]["prompt_tokens"] + max_tokens > context_len:
-            self._warn_context_size()
+    def _extract_stream_response(self, chunk_json: dict) -> str:
+        if usage := chunk_json.get("usage"):
+            context_len = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
+            max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
+            if usage["prompt_tokens"] + max_tokens > context_len:
+                self._warn_context_size()
 
-        # text-gen-webui has a typo where it is 'chat.completions' not 'chat.completion'
-        if response_json["object"] == "chat.completions":
-            return choices[0]["message"]["content"]
-        else:
-            return choices[0]["text"]
+        return super()._extract_stream_response(chunk_json)
         
 class LlamaCppPythonAPIAgent(GenericOpenAIAPIAgent):
     """https://llama-cpp-python.readthedocs.io/en/latest/server/"""
     grammar: str
+    grammar_source: str
 
     async def _async_load_model(self, entry: ConfigEntry):
         await super()._async_load_model(entry)
@@ -1425,8 +2624,14 @@ class LlamaCppPythonAPIAgent(GenericOpenAIAPIAgent):
         )
 
     def _load_model(self, entry: ConfigEntry):
-        with open(os.path.join(os.path.dirname(__file__), DEFAULT_GBNF_GRAMMAR_FILE)) as f:
-            self.grammar = "".join(f.readlines())
+        with open(os.path.join(os.path.dirname(__file__), entry.options.get(CONF_GBNF_GRAMMAR_FILE, DEFAULT_GBNF_GRAMMAR_FILE))) as f:
+            self.grammar_source = "".join(f.readlines())
+        self.grammar = self.grammar_source
+
+    async def _async_update_grammar(self, llm_api: llm.APIInstance | None) -> None:
+        self.grammar = self.grammar_source
+        if self.entry.options.get(CONF_GBNF_DYNAMIC_GRAMMAR, DEFAULT_GBNF_DYNAMIC_GRAMMAR):
+            self.grammar = self._async_generate_dynamic_grammar(self.grammar_source, llm_api) or self.grammar_source
 
     def _chat_completion_params(self, conversation: dict) -> (str, dict):
         top_k = int(self.entry.options.get(CONF_TOP_K, DEFAULT_TOP_K))
@@ -1454,6 +2659,8 @@ class OllamaAPIAgent(LocalLLMAgent):
     api_host: str
     api_key: str
     model_name: str
+    last_usage: dict[str, Any] | None = None
+    conversation_contexts: OrderedDict[str, tuple[str, list[int]]]
 
     async def _async_load_model(self, entry: ConfigEntry) -> None:
         self.api_host = format_url(
@@ -1465,16 +2672,20 @@ class OllamaAPIAgent(LocalLLMAgent):
         self.api_key = entry.data.get(CONF_OPENAI_API_KEY)
         self.model_name = entry.data.get(CONF_CHAT_MODEL)
 
+        # conversation id -> (the formatted conversation that the context was returned for, the returned context)
+        self.conversation_contexts = OrderedDict()
+
+        self.request_headers = {}
+        if self.api_key:
+            self.request_headers["Authorization"] = f"Bearer {self.api_key}"
+        self._async_use_connection_pool(entry, self.api_host)
+
         # ollama handles loading for us so just make sure the model is available
         try:
-            headers = {}
-            session = async_get_clientsession(self.hass)
-            if self.api_key:
-                headers["Authorization"] = f"Bearer {self.api_key}"
-            
+            session = self.connection_pool.session
             async with session.get(
                 f"{self.api_host}/api/tags",
-                headers=headers,
+                headers=self.request_headers,
             ) as response:
                 response.raise_for_status()
                 currently_downloaded_result = await response.json()
@@ -1490,6 +2701,9 @@ class OllamaAPIAgent(LocalLLMAgent):
         elif not any([ name.split(":")[0] == self.model_name for name in model_names ]):
             raise ConfigEntryNotReady(f"Ollama server does not have the provided model: {self.model_name}")
 
+    def _keep_warm_endpoint(self) -> str:
+        return "/api/version"
+
     def _chat_completion_params(self, conversation: dict) -> (str, dict):
         request_params = {}
 
@@ -1507,36 +2721,39 @@ class OllamaAPIAgent(LocalLLMAgent):
 
         return endpoint, request_params
     
-    def _extract_response(self, response_json: dict) -> str:        
-        if response_json["done"] not in ["true", True]:
-            _LOGGER.warning("Model response did not end on a stop token (unfinished sentence)")
-        
-        # TODO: this doesn't work because ollama caches prompts and doesn't always return the full prompt length
-        # context_len = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
-        # max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
-        # if response_json["prompt_eval_count"] + max_tokens > context_len:
-        #     self._warn_context_size()
-
-        if "response" in response_json:
-            return response_json["response"]
+    def _extract_stream_usage(self, chunk_json: dict) -> dict[str, Any]:
+        """The token counts and timings (in milliseconds) from the last chunk of a response"""
+        # TODO: prompt_tokens can't be used to warn about the context size because ollama caches prompts and doesn't
+        # always report the full prompt length
+        return {
+            "prompt_tokens": chunk_json.get("prompt_eval_count", 0),
+            "completion_tokens": chunk_json.get("eval_count", 0),
+            "load_duration_ms": chunk_json.get("load_duration", 0) / 1e6,
+            "prompt_eval_duration_ms": chunk_json.get("prompt_eval_duration", 0) / 1e6,
+            "eval_duration_ms": chunk_json.get("eval_duration", 0) / 1e6,
+            "total_duration_ms": chunk_json.get("total_duration", 0) / 1e6,
+        }
+
+    def _extract_stream_response(self, chunk_json: dict) -> str:
+        if "response" in chunk_json:
+            return chunk_json["response"]
         else:
-            return response_json["message"]["content"]
-    
-    async def _async_generate(self, conversation: dict) -> str:
+            return chunk_json.get("message", {}).get("content", "")
+
+    def _generate_request(self, conversation: dict) -> tuple[str, dict, dict]:
         context_length = self.entry.options.get(CONF_CONTEXT_LENGTH, DEFAULT_CONTEXT_LENGTH)
         max_tokens = self.entry.options.get(CONF_MAX_TOKENS, DEFAULT_MAX_TOKENS)
         temperature = self.entry.options.get(CONF_TEMPERATURE, DEFAULT_TEMPERATURE)
         top_p = self.entry.options.get(CONF_TOP_P, DEFAULT_TOP_P)
         top_k = self.entry.options.get(CONF_TOP_K, DEFAULT_TOP_K)
         typical_p = self.entry.options.get(CONF_TYPICAL_P, DEFAULT_TYPICAL_P)
-        timeout = self.entry.options.get(CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT)
         keep_alive = self.entry.options.get(CONF_OLLAMA_KEEP_ALIVE_MIN, DEFAULT_OLLAMA_KEEP_ALIVE_MIN)
         use_chat_api = self.entry.options.get(CONF_REMOTE_USE_CHAT_ENDPOINT, DEFAULT_REMOTE_USE_CHAT_ENDPOINT)
         json_mode = self.entry.options.get(CONF_OLLAMA_JSON_MODE, DEFAULT_OLLAMA_JSON_MODE)
         
         request_params = {
             "model": self.model_name,
-            "stream": False,
+            "stream": True,
             "keep_alive": f"{keep_alive}m", # prevent ollama from unloading the model
             "options": {
                 "num_ctx": context_length,
@@ -1558,29 +2775,106 @@ class OllamaAPIAgent(LocalLLMAgent):
         
         request_params.update(additional_params)
 
-        headers = {}
-        if self.api_key:
-            headers["Authorization"] = f"Bearer {self.api_key}"
-        
-        session = async_get_clientsession(self.hass)
-        response = None
-        try:
-            async with session.post(
-                f"{self.api_host}{endpoint}",
+        return endpoint, request_params, self.request_headers
+    
+    async def _async_generate(self, conversation: dict) -> str:
+        """The response is always streamed so the body (and the context array at the end of it) is never buffered all at once"""
+        return "".join([ text async for text in self._async_generate_stream(conversation) ])
+
+    def _reuse_conversation_context(self, conversation_id: str | None, request_params: dict) -> str | None:
+        """
+        Send only the part of the prompt that is new since the last turn of the conversation, along with the context
+        that Ollama returned for that turn. Falls back to the full prompt if the earlier turns don't match (e.g. the
+        system prompt was refreshed). Returns the full prompt if the returned context should be kept for the next turn.
+        Ollama ignores the context for raw requests, so these are sent with a template that passes the prompt through
+        unchanged instead. The context is deprecated by Ollama and it isn't documented whether it is turned back into
+        text or re-used as tokens, so this only saves sending the earlier turns again.
+        """
+        if not conversation_id or "prompt" not in request_params or \
+            not self.entry.options.get(CONF_OLLAMA_REUSE_CONTEXT, DEFAULT_OLLAMA_REUSE_CONTEXT) or \
+            not self.entry.options.get(CONF_REMEMBER_CONVERSATION, DEFAULT_REMEMBER_CONVERSATION):
+            return None
+
+        full_prompt = request_params["prompt"]
+        previous = self.conversation_contexts.pop(conversation_id, None)
+        if previous:
+            previous_text, context = previous
+            if len(full_prompt) > len(previous_text) and full_prompt.startswith(previous_text):
+                request_params["prompt"] = full_prompt[len(previous_text):]
+                request_params["context"] = context
+                request_params["raw"] = False
+                request_params["template"] = "{{ .Prompt }}"
+            else:
+                _LOGGER.debug("The conversation changed since the last turn; sending the full prompt")
+
+        return full_prompt
+
+    def _keep_conversation_context(
+        self, conversation_id: str, full_prompt: str, response: str, context: list[int]
+    ) -> None:
+        """
+        Keep the context for the next turn along with the text of the assistant turn it stands for, formatted the way
+        the next prompt will have it: the assistant prefix and then the response. The generation prompt of some
+        templates (e.g. ChatML) leaves out the line break at the end of the assistant prefix, so the context is missing
+        it; the model still gets the conversation as it was when the response was generated. If the response is changed
+        before it is added to the conversation (e.g. a think block is removed), the next prompt won't start with this
+        text and the full prompt is sent.
+        """
+        template_desc = PROMPT_TEMPLATE_DESCRIPTIONS[self.entry.options.get(CONF_PROMPT_TEMPLATE, DEFAULT_PROMPT_TEMPLATE)]
+        generation_prompt = template_desc["generation_prompt"]
+        assistant_prefix = template_desc["assistant"]["prefix"]
+        if not full_prompt.endswith(generation_prompt) or not assistant_prefix.startswith(generation_prompt):
+            _LOGGER.debug("The assistant turn isn't formatted like the generation prompt; not keeping the context")
+            return
+
+        context_text = full_prompt[:len(full_prompt) - len(generation_prompt)] + assistant_prefix + response
+
+        self.conversation_contexts[conversation_id] = (context_text, context)
+        if len(self.conversation_contexts) > OLLAMA_CONTEXT_CACHE_SIZE:
+            self.conversation_contexts.popitem(last=False)
+
+    async def _async_generate_stream(self, conversation: dict, conversation_id: str | None = None) -> AsyncGenerator[str]:
+        timeout = self.entry.options.get(CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT)
+        endpoint, request_params, headers = self._generate_request(conversation)
+        request_params["stream"] = True
+        full_prompt = self._reuse_conversation_context(conversation_id, request_params)
+
+        async def send_request(backend: BackendEndpoint) -> AsyncGenerator[dict]:
+            async with backend.connection_pool.session.post(
+                f"{backend.base_url}{endpoint}",
                 json=request_params,
                 timeout=timeout,
                 headers=headers
             ) as response:
                 response.raise_for_status()
-                result = await response.json()
+
+                # newline delimited json; the last chunk has "done" set and the token usage
+                async for chunk in async_iterate_json_stream(response.content.iter_any(), server_sent_events=False):
+                    yield chunk
+
+        response_text = []
+        try:
+            async with aclosing(self._async_stream_from_endpoints(send_request)) as chunks:
+                async for chunk in chunks:
+                    if text := self._extract_stream_response(chunk):
+                        response_text.append(text)
+                        yield text
+
+                    if chunk.get("done") in ["true", True]:
+                        if chunk.get("done_reason", "stop") != "stop":
+                            _LOGGER.warning("Model response did not end on a stop token (unfinished sentence)")
+                        self.last_usage = self._extract_stream_usage(chunk)
+                        self.last_usage["context_reused"] = "context" in request_params
+                        _LOGGER.debug("Token usage: %s", self.last_usage)
+
+                        if full_prompt is not None and chunk.get("context"):
+                            self._keep_conversation_context(conversation_id, full_prompt, "".join(response_text), chunk["context"])
+                        break
         except asyncio.TimeoutError:
-            return "The generation request timed out! Please check your connection settings, increase the timeout in settings, or decrease the number of exposed entities."
+            self.generation_failures += 1
+            yield "The generation request timed out! Please check your connection settings, increase the timeout in settings, or decrease the number of exposed entities."
         except aiohttp.ClientError as err:
+            self.generation_failures += 1
             _LOGGER.debug(f"Err was: {err}")
             _LOGGER.debug(f"Request was: {request_params}")
-            _LOGGER.debug(f"Result was: {response}")
-            return f"Failed to communicate with the API! {err}"
-        
-        _LOGGER.debug(result)
-
-        return self._extract_response(result)
+            yield f"Failed to communicate with the API! {err}"
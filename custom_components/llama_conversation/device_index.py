@@ -0,0 +1,114 @@
+"""In-memory inverted index of the exposed devices so only the devices that are relevant to a request go into the prompt"""
+from __future__ import annotations
+
+import heapq
+import logging
+import math
+import re
+import threading
+from typing import Any
+
+_LOGGER = logging.getLogger(__name__)
+
+# how much a matching word counts depending on where it was found
+NAME_WEIGHT = 3.0
+AREA_WEIGHT = 2.0
+ENTITY_ID_WEIGHT = 1.0
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+def index_terms(text: str) -> list[str]:
+    """Lower case words with a plural 's' removed so 'lights' matches 'light'"""
+    terms = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class DeviceIndex:
+    """
+    Maps the words in each device's entity id, friendly name, aliases and area name to the devices they appear in.
+    Devices are only re-indexed when they are marked as changed (or appear for the first time), and only if the
+    text that is indexed actually changed.
+    Devices are marked as changed from the event loop while the prompt may be generated in the executor.
+    """
+
+    documents: dict[str, tuple[tuple, dict[str, float]]]
+    postings: dict[str, dict[str, float]]
+    changed: set[str]
+
+    def __init__(self) -> None:
+        self.documents = {}
+        self.postings = {}
+        self.changed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def mark_changed(self, entity_id: str) -> None:
+        self.changed.add(entity_id)
+
+    def mark_all_changed(self) -> None:
+        self.changed.update(list(self.documents))
+
+    def sync(self, entities: dict[str, dict[str, Any]]) -> None:
+        """Bring the index up to date with the exposed entities (as returned by _async_get_exposed_entities)"""
+        with self._lock:
+            for entity_id in [ entity_id for entity_id in self.documents if entity_id not in entities ]:
+                self._remove(entity_id)
+
+            # only take the marks that are seen here; ones added meanwhile are left for the next sync
+            changed = set(self.changed)
+            self.changed.difference_update(changed)
+            for entity_id, attributes in entities.items():
+                if entity_id in changed or entity_id not in self.documents:
+                    self._index(entity_id, attributes)
+
+    def _index(self, entity_id: str, attributes: dict[str, Any]) -> None:
+        signature = (attributes.get("friendly_name"), tuple(sorted(attributes.get("aliases") or ())), attributes.get("area_name"))
+        document = self.documents.get(entity_id)
+        if document and document[0] == signature:
+            return
+
+        if document:
+            self._remove(entity_id)
+
+        friendly_name, aliases, area_name = signature
+        weights: dict[str, float] = {}
+        fields = [ (entity_id, ENTITY_ID_WEIGHT), (area_name or "", AREA_WEIGHT), (friendly_name or "", NAME_WEIGHT) ]
+        fields.extend((alias, NAME_WEIGHT) for alias in aliases)
+        for text, weight in fields:
+            for term in index_terms(text):
+                weights[term] = max(weights.get(term, 0.0), weight)
+
+        self.documents[entity_id] = (signature, weights)
+        for term, weight in weights.items():
+            self.postings.setdefault(term, {})[entity_id] = weight
+
+    def _remove(self, entity_id: str) -> None:
+        _, weights = self.documents.pop(entity_id)
+        for term in weights:
+            posting = self.postings[term]
+            del posting[entity_id]
+            if not posting:
+                del self.postings[term]
+
+    def search(self, query: str, limit: int) -> list[str]:
+        """
+        The entity ids of the devices that best match the query, best match first. Each matching word scores its
+        weight times how rare the word is among the devices. Ties are broken by entity id.
+        """
+        scores: dict[str, float] = {}
+        with self._lock:
+            for term in set(index_terms(query)):
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                rarity = math.log(1 + len(self.documents) / len(posting))
+                for entity_id, weight in posting.items():
+                    scores[entity_id] = scores.get(entity_id, 0.0) + weight * rarity
+
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [ entity_id for entity_id, _ in best ]
@@ -0,0 +1,221 @@
+"""Spreading the requests of a remote backend over several servers, with failover and hedged requests"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Callable
+
+import aiohttp
+
+from .const import (
+    REMOTE_HEALTH_CHECK_TIMEOUT,
+    REMOTE_HEDGE_MIN_SAMPLES,
+    REMOTE_LATENCY_HISTOGRAM_BUCKETS,
+    REMOTE_LATENCY_WINDOW,
+)
+from .http_pool import BackendConnectionPool
+
+_LOGGER = logging.getLogger(__name__)
+
+def parse_endpoint_urls(endpoints: list[str], ssl: bool) -> list[str]:
+    """The base urls of a list of 'host:port' or 'http(s)://host:port' entries"""
+    urls = []
+    for endpoint in endpoints:
+        endpoint = endpoint.strip().rstrip("/")
+        if not endpoint:
+            continue
+        if "://" not in endpoint:
+            endpoint = f"{'https' if ssl else 'http'}://{endpoint}"
+        if endpoint not in urls:
+            urls.append(endpoint)
+    return urls
+
+class BackendEndpoint:
+    """
+    A single server of a backend. Keeps track of how many requests it is working on, whether it is healthy and how
+    long it took to start responding to the most recent requests.
+    """
+
+    def __init__(self, connection_pool: BackendConnectionPool) -> None:
+        self.connection_pool = connection_pool
+        self.in_flight = 0
+        self.healthy = True
+        self.failures = 0
+        self.latencies: deque[float] = deque(maxlen=REMOTE_LATENCY_WINDOW)
+        self.histogram = [0] * (len(REMOTE_LATENCY_HISTOGRAM_BUCKETS) + 1)
+
+    @property
+    def base_url(self) -> str:
+        return self.connection_pool.base_url
+
+    def record_latency(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.histogram[bisect.bisect_left(REMOTE_LATENCY_HISTOGRAM_BUCKETS, seconds)] += 1
+        self.healthy = True
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.healthy = False
+
+    def latency_percentile(self, percentile: float) -> float | None:
+        """The given percentile of the recent time to first response in seconds, or None if too few are known"""
+        if len(self.latencies) < REMOTE_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def histogram_summary(self) -> str:
+        labels = [ f"<={bound:g}s" for bound in REMOTE_LATENCY_HISTOGRAM_BUCKETS ] + [ f">{REMOTE_LATENCY_HISTOGRAM_BUCKETS[-1]:g}s" ]
+        return ", ".join(f"{label}: {count}" for label, count in zip(labels, self.histogram) if count) or "no responses"
+
+class _Attempt:
+    """A request to one endpoint; fetching the first item of the response starts as soon as it is created"""
+
+    def __init__(self, endpoint: BackendEndpoint, response: AsyncGenerator[Any]) -> None:
+        self.endpoint = endpoint
+        self.response = response
+        self.started = time.monotonic()
+        self.closed = False
+        endpoint.in_flight += 1
+        self.first_item = asyncio.create_task(self._async_get_first_item())
+
+    async def _async_get_first_item(self) -> tuple[bool, Any]:
+        try:
+            return True, await anext(self.response)
+        except StopAsyncIteration:
+            return False, None
+
+    async def async_close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.endpoint.in_flight -= 1
+        if not self.first_item.done():
+            self.first_item.cancel()
+        await asyncio.gather(self.first_item, return_exceptions=True)
+        await self.response.aclose()
+
+class EndpointPool:
+    """The servers of a backend, in the order they were configured in"""
+
+    def __init__(self, endpoints: list[BackendEndpoint]) -> None:
+        self.endpoints = endpoints
+
+    def choose(self, exclude: set[BackendEndpoint]) -> BackendEndpoint | None:
+        """The healthy endpoint with the fewest requests in flight, preferring the one that usually responds faster"""
+        candidates = [ endpoint for endpoint in self.endpoints if endpoint not in exclude ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda endpoint: (not endpoint.healthy, endpoint.in_flight, endpoint.latency_percentile(50) or 0.0))
+
+    def _hedge_delay(self, attempt: _Attempt, hedge_percentile: float, tried: set[BackendEndpoint]) -> float | None:
+        if not hedge_percentile or len(tried) == len(self.endpoints):
+            return None
+        delay = attempt.endpoint.latency_percentile(hedge_percentile)
+        if delay is None:
+            return None
+        return max(0.0, delay - (time.monotonic() - attempt.started))
+
+    async def async_stream(self, send_request: Callable[[BackendEndpoint], AsyncGenerator[Any]], hedge_percentile: float = 0) -> AsyncGenerator[Any]:
+        """
+        Send the request to the least loaded endpoint and yield the items of its response.
+        If the endpoint hasn't started responding after the given percentile of its recent response times, the request
+        is also sent to the next endpoint. Whichever responds first is used and the other request is cancelled.
+        Requests that fail before the endpoint starts responding are sent to the next endpoint. Timeouts are not retried
+        because the whole request timeout already passed.
+        """
+        tried: set[BackendEndpoint] = set()
+        attempts: list[_Attempt] = []
+        winner: _Attempt | None = None
+        last_error: BaseException | None = None
+        try:
+            while winner is None:
+                if not attempts:
+                    endpoint = self.choose(tried)
+                    if endpoint is None:
+                        raise last_error or aiohttp.ClientConnectionError("There are no endpoints to send the request to")
+                    tried.add(endpoint)
+                    attempts.append(_Attempt(endpoint, send_request(endpoint)))
+
+                hedge_delay = self._hedge_delay(attempts[0], hedge_percentile, tried) if len(attempts) == 1 else None
+                done, _ = await asyncio.wait([ attempt.first_item for attempt in attempts ], timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    endpoint = self.choose(tried)
+                    _LOGGER.debug("%s did not respond in time, also sending the request to %s", attempts[0].endpoint.base_url, endpoint.base_url)
+                    tried.add(endpoint)
+                    attempts.append(_Attempt(endpoint, send_request(endpoint)))
+                    continue
+
+                for attempt in [ attempt for attempt in attempts if attempt.first_item in done ]:
+                    error = attempt.first_item.exception()
+                    if error is None:
+                        winner = attempt
+                        break
+
+                    attempts.remove(attempt)
+                    await attempt.async_close()
+                    if not isinstance(error, (aiohttp.ClientError, TimeoutError)):
+                        raise error
+
+                    attempt.endpoint.record_failure()
+                    last_error = error
+                    if isinstance(error, TimeoutError) and not attempts:
+                        raise error
+                    _LOGGER.debug("Request to %s failed: %s", attempt.endpoint.base_url, error)
+
+            for attempt in attempts:
+                if attempt is not winner:
+                    _LOGGER.debug("Cancelling the request to %s", attempt.endpoint.base_url)
+                    await attempt.async_close()
+            attempts = [ winner ]
+            winner.endpoint.record_latency(time.monotonic() - winner.started)
+
+            has_item, item = winner.first_item.result()
+            if not has_item:
+                return
+            yield item
+
+            try:
+                async for item in winner.response:
+                    yield item
+            except (aiohttp.ClientError, TimeoutError):
+                winner.endpoint.record_failure()
+                raise
+        finally:
+            for attempt in attempts:
+                await attempt.async_close()
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                self.log_metrics()
+
+    async def async_health_check(self, path: str, headers: dict[str, str]) -> None:
+        """Check every endpoint so ones that went away are skipped and ones that failed are used again once they are back"""
+        async def check(endpoint: BackendEndpoint) -> None:
+            try:
+                async with endpoint.connection_pool.session.get(
+                    f"{endpoint.base_url}{path}",
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=REMOTE_HEALTH_CHECK_TIMEOUT)
+                ) as response:
+                    response.raise_for_status()
+                    await response.read()
+                healthy = True
+            except (aiohttp.ClientError, TimeoutError) as err:
+                _LOGGER.debug("Health check of %s failed: %s", endpoint.base_url, err)
+                healthy = False
+
+            if healthy != endpoint.healthy:
+                _LOGGER.info("%s is %s", endpoint.base_url, "healthy again" if healthy else "unhealthy")
+            endpoint.healthy = healthy
+
+        await asyncio.gather(*[ check(endpoint) for endpoint in self.endpoints ])
+
+    def log_metrics(self) -> None:
+        for endpoint in self.endpoints:
+            _LOGGER.debug(
+                "%s: %s, %d in flight, %d failed; time to first response: %s",
+                endpoint.base_url, "healthy" if endpoint.healthy else "unhealthy", endpoint.in_flight,
+                endpoint.failures, endpoint.histogram_summary()
+            )
@@ -0,0 +1,380 @@
+"""A small GBNF parser and matcher used to find the text that a grammar forces the model to produce next"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Iterable
+
+from .const import NUMERIC_SERVICE_CALL_ARGUMENTS
+
+_LOGGER = logging.getLogger(__name__)
+
+MAX_CODEPOINT = 0x10FFFF
+
+# an element is either ("chars", ((low, high), ...), negated) or ("ref", rule_name)
+Element = tuple
+Frame = tuple[str, int, int] # rule name, alternative, position in the alternative
+Stack = tuple[Frame, ...]
+
+class GrammarParseException(Exception):
+    pass
+
+class GbnfGrammar:
+    """
+    Parses the subset of GBNF that llama.cpp supports: literals, character classes, rule references,
+    groups, alternatives and the *, +, ?, {m,n} repetition operators.
+    Repetitions and groups are turned into generated rules so that every rule is a list of alternatives
+    that are each a flat list of elements.
+    """
+
+    rules: dict[str, list[list[Element]]]
+
+    def __init__(self, grammar: str, root: str = "root") -> None:
+        self.source = grammar
+        self.root = root
+        self.rules = {}
+        self._pos = 0
+        self._generated_rules = 0
+        try:
+            self._parse()
+        except (IndexError, ValueError) as ex:
+            raise GrammarParseException(f"Unexpected end of grammar or invalid number near {self._pos}") from ex
+
+        if root not in self.rules:
+            raise GrammarParseException(f"The grammar does not define the '{root}' rule")
+        for alternatives in self.rules.values():
+            for sequence in alternatives:
+                for element in sequence:
+                    if element[0] == "ref" and element[1] not in self.rules:
+                        raise GrammarParseException(f"Undefined rule '{element[1]}'")
+
+    # parsing
+
+    def _parse(self) -> None:
+        self._skip_space(newline_ok=True)
+        while self._pos < len(self.source):
+            name = self._parse_name()
+            self._skip_space(newline_ok=False)
+            if not self.source.startswith("::=", self._pos):
+                raise GrammarParseException(f"Expected '::=' at {self._pos}")
+            self._pos += 3
+            self._skip_space(newline_ok=True)
+            self.rules[name] = self._parse_alternatives(name, nested=False)
+            self._skip_space(newline_ok=True)
+
+    def _skip_space(self, *, newline_ok: bool) -> None:
+        while self._pos < len(self.source):
+            char = self.source[self._pos]
+            if char == "#":
+                while self._pos < len(self.source) and self.source[self._pos] not in "\r\n":
+                    self._pos += 1
+            elif char in " \t" or (newline_ok and char in "\r\n"):
+                self._pos += 1
+            else:
+                break
+
+    def _parse_name(self) -> str:
+        start = self._pos
+        while self._pos < len(self.source) and (self.source[self._pos].isalnum() or self.source[self._pos] in "-_"):
+            self._pos += 1
+        if start == self._pos:
+            raise GrammarParseException(f"Expected a rule name at {start}")
+        return self.source[start:self._pos]
+
+    def _new_rule_name(self, base_name: str) -> str:
+        self._generated_rules += 1
+        return f"{base_name}_{self._generated_rules}"
+
+    def _new_rule(self, base_name: str, alternatives: list[list[Element]]) -> Element:
+        name = self._new_rule_name(base_name)
+        self.rules[name] = alternatives
+        return ("ref", name)
+
+    def _parse_alternatives(self, rule_name: str, *, nested: bool) -> list[list[Element]]:
+        alternatives = [self._parse_sequence(rule_name, nested=nested)]
+        while self._pos < len(self.source) and self.source[self._pos] == "|":
+            self._pos += 1
+            self._skip_space(newline_ok=True)
+            alternatives.append(self._parse_sequence(rule_name, nested=nested))
+        return alternatives
+
+    def _parse_sequence(self, rule_name: str, *, nested: bool) -> list[Element]:
+        sequence: list[Element] = []
+        last_start = 0 # where the elements of the last item (that a repetition applies to) start
+        while self._pos < len(self.source):
+            char = self.source[self._pos]
+            if char == '"':
+                self._pos += 1
+                last_start = len(sequence)
+                while self.source[self._pos] != '"':
+                    codepoint = self._parse_char()
+                    sequence.append(("chars", ((codepoint, codepoint),), False))
+                self._pos += 1
+            elif char == "[":
+                self._pos += 1
+                negated = self.source[self._pos] == "^"
+                if negated:
+                    self._pos += 1
+                ranges = []
+                while self.source[self._pos] != "]":
+                    low = self._parse_char()
+                    high = low
+                    if self.source[self._pos] == "-" and self.source[self._pos + 1] != "]":
+                        self._pos += 1
+                        high = self._parse_char()
+                    ranges.append((low, high))
+                self._pos += 1
+                last_start = len(sequence)
+                sequence.append(("chars", tuple(ranges), negated))
+            elif char == ".":
+                self._pos += 1
+                last_start = len(sequence)
+                sequence.append(("chars", ((0, MAX_CODEPOINT),), False))
+            elif char == "(":
+                self._pos += 1
+                self._skip_space(newline_ok=True)
+                alternatives = self._parse_alternatives(rule_name, nested=True)
+                if self.source[self._pos] != ")":
+                    raise GrammarParseException(f"Expected ')' at {self._pos}")
+                self._pos += 1
+                last_start = len(sequence)
+                sequence.append(self._new_rule(rule_name, alternatives))
+            elif char.isalnum() or char in "-_":
+                last_start = len(sequence)
+                sequence.append(("ref", self._parse_name()))
+            elif char in "*+?{":
+                if last_start == len(sequence):
+                    raise GrammarParseException(f"Expected an item before '{char}' at {self._pos}")
+                item = sequence[last_start:]
+                del sequence[last_start:]
+                sequence.append(self._repeat(rule_name, item, *self._parse_repetition()))
+            else:
+                break
+
+            self._skip_space(newline_ok=nested)
+
+        return sequence
+
+    def _parse_repetition(self) -> tuple[int, int | None]:
+        char = self.source[self._pos]
+        self._pos += 1
+        if char == "*":
+            return 0, None
+        if char == "+":
+            return 1, None
+        if char == "?":
+            return 0, 1
+
+        end = self.source.index("}", self._pos)
+        bounds = self.source[self._pos:end].split(",")
+        self._pos = end + 1
+        min_times = int(bounds[0].strip())
+        if len(bounds) == 1:
+            return min_times, min_times
+        return min_times, int(bounds[1].strip()) if bounds[1].strip() else None
+
+    def _repeat(self, rule_name: str, item: list[Element], min_times: int, max_times: int | None) -> Element:
+        if max_times is None:
+            # item{m,} ::= item item ... item rest, rest ::= item rest | empty
+            rest_name = self._new_rule_name(rule_name)
+            self.rules[rest_name] = [item + [("ref", rest_name)], []]
+            rest = ("ref", rest_name)
+            return self._new_rule(rule_name, [item * min_times + [rest]])
+
+        # item{m,n} ::= item ... item optional, optional ::= item optional' | empty (nested n - m times)
+        optional: list[Element] = []
+        for _ in range(max_times - min_times):
+            optional = [self._new_rule(rule_name, [item + optional, []])]
+        return self._new_rule(rule_name, [item * min_times + optional])
+
+    def _parse_char(self) -> int:
+        char = self.source[self._pos]
+        if char != "\\":
+            self._pos += 1
+            return ord(char)
+
+        escape = self.source[self._pos + 1]
+        self._pos += 2
+        hex_lengths = { "x": 2, "u": 4, "U": 8 }
+        if escape in hex_lengths:
+            digits = self.source[self._pos:self._pos + hex_lengths[escape]]
+            self._pos += hex_lengths[escape]
+            return int(digits, 16)
+        return ord({ "n": "\n", "r": "\r", "t": "\t" }.get(escape, escape))
+
+    # matching
+
+    def initial_stacks(self) -> frozenset[Stack]:
+        """Parser states before any text has been generated"""
+        stacks = set()
+        for alternative in range(len(self.rules[self.root])):
+            stacks.update(self._expand(((self.root, alternative, 0),)))
+        return frozenset(stacks)
+
+    def _expand(self, stack: Stack) -> Iterable[Stack]:
+        """Follows rule references until the top of the stack is a character element (or the stack is empty when the text can end)"""
+        if not stack:
+            yield stack
+            return
+
+        rule, alternative, position = stack[-1]
+        sequence = self.rules[rule][alternative]
+        if position == len(sequence):
+            yield from self._expand(stack[:-1])
+            return
+
+        element = sequence[position]
+        if element[0] == "chars":
+            yield stack
+            return
+
+        # drop the current frame if the reference is the last element so right recursion doesn't grow the stack
+        rest = stack[:-1] if position + 1 == len(sequence) else stack[:-1] + ((rule, alternative, position + 1),)
+        for referenced_alternative in range(len(self.rules[element[1]])):
+            yield from self._expand(rest + ((element[1], referenced_alternative, 0),))
+
+    def _top(self, stack: Stack) -> Element:
+        rule, alternative, position = stack[-1]
+        return self.rules[rule][alternative][position]
+
+    def advance(self, stacks: frozenset[Stack], text: str) -> frozenset[Stack]:
+        """Parser states after the text; empty if the grammar does not allow it"""
+        for char in text:
+            codepoint = ord(char)
+            next_stacks = set()
+            for stack in stacks:
+                if not stack:
+                    continue
+                _, ranges, negated = self._top(stack)
+                if any(low <= codepoint <= high for low, high in ranges) != negated:
+                    rule, alternative, position = stack[-1]
+                    next_stacks.update(self._expand(stack[:-1] + ((rule, alternative, position + 1),)))
+            stacks = frozenset(next_stacks)
+            if not stacks:
+                break
+        return stacks
+
+    def forced_text(self, stacks: frozenset[Stack], max_length: int) -> str:
+        """The text that every continuation allowed by the grammar has to start with"""
+        forced = []
+        while stacks and len(forced) < max_length:
+            next_char = None
+            for stack in stacks:
+                if not stack:
+                    return "".join(forced) # the text is allowed to end here
+                _, ranges, negated = self._top(stack)
+                if negated or len(ranges) != 1 or ranges[0][0] != ranges[0][1] or next_char not in (None, ranges[0][0]):
+                    return "".join(forced)
+                next_char = ranges[0][0]
+
+            forced.append(chr(next_char))
+            stacks = self.advance(stacks, forced[-1])
+        return "".join(forced)
+
+TOOL_CALL_RULE = "toolcall"
+TOOL_CALL_VALUE_RULES = r'''toolcall-string ::= "\"" ([^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F]))* "\""
+toolcall-number ::= "-"? [0-9]+ ("." [0-9]+)?
+toolcall-boolean ::= "true" | "false"
+toolcall-list ::= "[" (toolcall-string (", " toolcall-string)*)? "]"'''
+
+def gbnf_literal(text: str) -> str:
+    """Quote text as a GBNF string literal"""
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    return f'"{escaped}"'
+
+def gbnf_choice(values: Iterable[str], *, quoted: bool) -> str:
+    """A group that matches exactly one of the values (as JSON strings if quoted)"""
+    alternatives = [ gbnf_literal(json_string(value) if quoted else value) for value in values ]
+    return "(" + " | ".join(alternatives) + ")" if alternatives else gbnf_literal("")
+
+def _rule_name(*parts: str) -> str:
+    return "-".join([TOOL_CALL_RULE, *parts]).replace("_", "-").replace(".", "-")
+
+def home_llm_tool_call_rules(services: dict[str, dict[str, list[str]]], entity_ids: dict[str, list[str]]) -> str:
+    """
+    Rules for the Home-LLM service call format ({"service": "light.turn_on", "target_device": "light.kitchen", ...}).
+    services maps each domain to its services and the arguments that each of them accepts, and
+    entity_ids maps each domain to the exposed entities that services can target.
+    """
+    rules = []
+    calls = []
+    for domain, domain_services in sorted(services.items()):
+        if not entity_ids.get(domain):
+            continue
+
+        target_rule = _rule_name("target", domain)
+        rules.append(f"{target_rule} ::= " + " | ".join(gbnf_literal(json_string(entity_id)) for entity_id in sorted(entity_ids[domain])))
+
+        for service, arguments in sorted(domain_services.items()):
+            call = gbnf_literal('{"service": ' + json_string(f"{domain}.{service}") + ', "target_device": ') + f" {target_rule}"
+            if arguments:
+                argument_rule = _rule_name("args", domain, service)
+                rules.append(f"{argument_rule} ::= " + " | ".join(
+                    gbnf_literal(json_string(argument) + ": ") + (" toolcall-number" if argument in NUMERIC_SERVICE_CALL_ARGUMENTS else " toolcall-string")
+                    for argument in sorted(arguments)
+                ))
+                call += f' ({gbnf_literal(", ")} {argument_rule})*'
+            calls.append(call + " " + gbnf_literal("}"))
+
+    if not calls:
+        return ""
+    return "\n".join([f"{TOOL_CALL_RULE} ::= " + " | ".join(f"({call})" for call in calls), *rules, TOOL_CALL_VALUE_RULES])
+
+def api_tool_call_rules(tools: list[tuple[str, list[dict], dict[str, list[str]]]]) -> str:
+    """
+    Rules for the LLM API tool call format ({"name": "HassTurnOn", "arguments": {...}}).
+    tools are the tool names with their serialized parameters and the only values that are valid for
+    some of the arguments (for example the names of the exposed entities).
+    """
+    rules = []
+    calls = []
+    for name, parameters, argument_choices in sorted(tools, key=lambda tool: tool[0]):
+        call = gbnf_literal('{"name": ' + json_string(name) + ', "arguments": {')
+        argument_alternatives = []
+        for parameter in parameters:
+            parameter_name = str(parameter["name"])
+            if argument_choices.get(parameter_name):
+                value = gbnf_choice(argument_choices[parameter_name], quoted=True)
+                if parameter.get("type") == "list":
+                    value = f'({gbnf_literal("[")} {value} ({gbnf_literal(", ")} {value})* {gbnf_literal("]")} | {value})'
+            elif "enum" in parameter:
+                value = gbnf_choice([str(option) for option in parameter["enum"]], quoted=True)
+            else:
+                value = {
+                    "integer": "toolcall-number",
+                    "float": "toolcall-number",
+                    "number": "toolcall-number",
+                    "boolean": "toolcall-boolean",
+                    "list": "toolcall-list",
+                }.get(parameter.get("type", "string"), "toolcall-string")
+            argument_alternatives.append(gbnf_literal(json_string(parameter_name) + ": ") + " " + value)
+
+        if argument_alternatives:
+            argument_rule = _rule_name("args", name)
+            rules.append(f"{argument_rule} ::= " + " | ".join(argument_alternatives))
+            call += f' ({argument_rule} ({gbnf_literal(", ")} {argument_rule})*)?'
+        calls.append(call + " " + gbnf_literal("}}"))
+
+    if not calls:
+        return ""
+    return "\n".join([f"{TOOL_CALL_RULE} ::= " + " | ".join(f"({call})" for call in calls), *rules, TOOL_CALL_VALUE_RULES])
+
+def json_string(value: str) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+def with_tool_call_rules(base_grammar: str, tool_call_rules: str) -> str | None:
+    """
+    Replaces the single line 'toolcall ::= ...' rule of a grammar file with the generated rules.
+    Returns None if the grammar has no toolcall rule (or nothing could be generated) so the grammar is used as is.
+    """
+    lines = base_grammar.splitlines()
+    for i, line in enumerate(lines):
+        if line.split("::=")[0].strip() == TOOL_CALL_RULE and "::=" in line:
+            break
+    else:
+        return None
+
+    if not tool_call_rules:
+        return None
+
+    return "\n".join(lines[:i] + tool_call_rules.splitlines() + lines[i + 1:]) + "\n"
@@ -0,0 +1,107 @@
+"""Shared HTTP connection pools for the remote backends so requests re-use connections instead of opening new ones"""
+from __future__ import annotations
+
+import logging
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+from homeassistant.core import HomeAssistant
+from homeassistant.util.ssl import client_context
+
+from .const import (
+    REMOTE_CONNECTION_LIMIT,
+    REMOTE_CONNECTION_KEEPALIVE_TIMEOUT,
+    REMOTE_DNS_CACHE_TTL,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_CONNECTION_POOLS = "llama_conversation_connection_pools"
+
+class BackendConnectionPool:
+    """
+    An aiohttp session for a single backend host. Idle connections are kept open for longer than the aiohttp default
+    and DNS lookups are cached, so back to back requests skip the TCP (and TLS) handshake. Counts how many requests
+    had to open a new connection.
+    The session isn't created with async_create_clientsession: that always uses Home Assistant's shared connector, so
+    the connection limit, keep-alive time and DNS cache couldn't be set, and it turns close() into a warning while
+    this pool is closed when the last config entry using it is unloaded.
+    """
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self.users = 0
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.last_request = 0.0
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(
+            limit=REMOTE_CONNECTION_LIMIT,
+            keepalive_timeout=REMOTE_CONNECTION_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=REMOTE_DNS_CACHE_TTL,
+            ssl=client_context(),
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def _on_request_start(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams) -> None:
+        self.requests += 1
+        self.last_request = time.monotonic()
+
+    async def _on_request_end(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams) -> None:
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            self.log_metrics()
+
+    async def _on_connection_create_end(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionCreateEndParams) -> None:
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionReuseconnParams) -> None:
+        self.connections_reused += 1
+
+    def log_metrics(self) -> None:
+        _LOGGER.debug(
+            "%s: %d requests, %d re-used a connection and %d opened a new one",
+            self.base_url, self.requests, self.connections_reused, self.connections_created
+        )
+
+    async def async_keep_warm(self, path: str, headers: dict[str, str], interval: float) -> None:
+        """Make a cheap request if nothing was sent for interval seconds so there is always an open connection"""
+        if time.monotonic() - self.last_request < interval:
+            return
+
+        try:
+            async with self.session.get(f"{self.base_url}{path}", headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                await response.read()
+        except (aiohttp.ClientError, TimeoutError) as err:
+            _LOGGER.debug("Keep warm request to %s failed: %s", self.base_url, err)
+
+def async_get_connection_pool(hass: HomeAssistant, base_url: str) -> BackendConnectionPool:
+    """Get the pool for a backend, creating it if this is the first config entry that uses it"""
+    pools: dict[str, BackendConnectionPool] = hass.data.setdefault(DATA_CONNECTION_POOLS, {})
+    pool = pools.get(base_url)
+    if not pool or pool.session.closed:
+        pool = BackendConnectionPool(base_url)
+        pools[base_url] = pool
+
+    pool.users += 1
+    return pool
+
+async def async_release_connection_pool(hass: HomeAssistant, pool: BackendConnectionPool) -> None:
+    """Close the pool once no config entry uses it anymore"""
+    pool.users -= 1
+    if pool.users > 0:
+        return
+
+    pool.log_metrics()
+    pools: dict[str, BackendConnectionPool] = hass.data.get(DATA_CONNECTION_POOLS, {})
+    if pools.get(pool.base_url) is pool:
+        del pools[pool.base_url]
+    await pool.session.close()
@@ -0,0 +1,303 @@
+"""Saved llama.cpp states so that different prompts can each resume from their own evaluated prefix, in memory and on disk"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, Sequence
+
+_LOGGER = logging.getLogger(__name__)
+
+STATE_FILE_EXTENSION = ".kvstate"
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024
+
+def common_prefix_length(first: Sequence[int], second: Sequence[int]) -> int:
+    """Number of leading tokens that two token sequences have in common"""
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
+
+def llama_state_size(state: Any) -> int:
+    """Approximate number of bytes held by a LlamaState"""
+    size = state.llama_state_size
+    for array in (state.input_ids, state.scores):
+        size += getattr(array, "nbytes", 0)
+    return size
+
+class LlamaStatePool:
+    """
+    LRU pool of llama.cpp states (from Llama.save_state) keyed by the hash of the tokens that were evaluated.
+    Least recently used states are evicted once the total size goes over the byte budget.
+    Not thread safe; callers are expected to run inside a scheduler job.
+    """
+
+    capacity_bytes: int
+    total_bytes: int
+    entries: OrderedDict[int, tuple[tuple[int, ...], Any, int]]
+
+    def __init__(self, capacity_bytes: int) -> None:
+        self.capacity_bytes = capacity_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, tokens: Sequence[int]) -> bool:
+        tokens = tuple(tokens)
+        entry = self.entries.get(hash(tokens))
+        return entry is not None and entry[0] == tokens
+
+    def find(self, tokens: Sequence[int]) -> tuple[Any, int]:
+        """Returns the saved state that shares the longest prefix with the tokens, and the length of that prefix"""
+        best_key = None
+        best_length = 0
+        for key, (prefix, _, _) in self.entries.items():
+            length = common_prefix_length(prefix, tokens)
+            if length > best_length:
+                best_key = key
+                best_length = length
+
+        if best_key is None:
+            return None, 0
+
+        self.entries.move_to_end(best_key)
+        return self.entries[best_key][1], best_length
+
+    def add(self, tokens: Sequence[int], state: Any) -> None:
+        """Store a state for the tokens that were evaluated to produce it"""
+        tokens = tuple(tokens)
+        key = hash(tokens)
+        size = llama_state_size(state)
+
+        if size > self.capacity_bytes:
+            _LOGGER.debug(f"Not caching state for {len(tokens)} tokens because it is larger than the pool ({size / (1024 * 1024):.1f} MB)")
+            return
+
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[2]
+
+        self.entries[key] = (tokens, state, size)
+        self.total_bytes += size
+        _LOGGER.debug(f"Cached state for {len(tokens)} tokens ({size / (1024 * 1024):.1f} MB)")
+        self._evict()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def _evict(self) -> None:
+        while self.entries and self.total_bytes > self.capacity_bytes:
+            tokens, _, size = self.entries.popitem(last=False)[1]
+            self.total_bytes -= size
+            _LOGGER.debug(f"Evicted cached state for {len(tokens)} tokens ({size} bytes)")
+
+def model_fingerprint(model_path: str) -> str:
+    """
+    Identifies a model file without reading all of it: the file size plus a hash of the first and last
+    chunk, which covers the GGUF metadata/vocabulary and the final tensors
+    """
+    size = os.path.getsize(model_path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(model_path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        if size > FINGERPRINT_CHUNK_SIZE:
+            f.seek(max(size - FINGERPRINT_CHUNK_SIZE, FINGERPRINT_CHUNK_SIZE))
+            digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    return digest.hexdigest()
+
+class LlamaDiskStateCache:
+    """
+    Persists llama.cpp states to disk so they survive restarts. Every state is one file made up of a
+    json header (the evaluated tokens and the layout of the arrays) followed by the raw array data.
+    Files are memory mapped when the cache is loaded so only the header is read until a state is used.
+
+    States are stored in a sub-directory named after the version string; directories for any other
+    version (different model file, prompt template, context size, etc.) are deleted on load.
+    """
+
+    directory: str
+    capacity_bytes: int
+    entries: dict[str, tuple[tuple[int, ...], mmap.mmap, dict]]
+
+    def __init__(self, cache_dir: str, version: str, capacity_bytes: int, state_type: type) -> None:
+        self.cache_dir = cache_dir
+        self.version = version
+        self.directory = os.path.join(cache_dir, version)
+        self.capacity_bytes = capacity_bytes
+        self.state_type = state_type
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """Delete caches for other versions and memory map the states for this one"""
+        os.makedirs(self.directory, exist_ok=True)
+
+        for name in os.listdir(self.cache_dir):
+            if name != self.version:
+                _LOGGER.debug(f"Removing outdated state cache {name}")
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if not name.endswith(STATE_FILE_EXTENSION):
+                    continue
+                try:
+                    self._open(name)
+                except Exception:
+                    _LOGGER.warning(f"Removing unreadable state cache file {name}")
+                    self._remove(name)
+
+            self._evict()
+
+        _LOGGER.debug(f"Loaded {len(self.entries)} states from {self.directory}")
+
+    def close(self) -> None:
+        with self.lock:
+            for name in list(self.entries.keys()):
+                self._close(name)
+
+    def __contains__(self, tokens: Sequence[int]) -> bool:
+        return self._file_name(tokens) in self.entries
+
+    def find(self, tokens: Sequence[int]) -> tuple[Any, int]:
+        """Returns the stored state that shares the longest prefix with the tokens, and the length of that prefix"""
+        with self.lock:
+            best_name = None
+            best_length = 0
+            for name, (prefix, _, _) in self.entries.items():
+                length = common_prefix_length(prefix, tokens)
+                if length > best_length:
+                    best_name = name
+                    best_length = length
+
+            if best_name is None:
+                return None, 0
+
+            # file modification time is used to track the least recently used states
+            os.utime(os.path.join(self.directory, best_name))
+            return self._read_state(best_name), best_length
+
+    def add(self, tokens: Sequence[int], state: Any) -> None:
+        """Write a state to disk. Safe to call from any thread"""
+        name = self._file_name(tokens)
+        if llama_state_size(state) > self.capacity_bytes:
+            return
+
+        arrays = {}
+        data = []
+        offset = 0
+        for field, array in (("input_ids", state.input_ids), ("scores", state.scores)):
+            raw = array.tobytes()
+            arrays[field] = { "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset, "length": len(raw) }
+            data.append(raw)
+            offset += len(raw)
+        arrays["llama_state"] = { "offset": offset, "length": state.llama_state_size }
+        data.append(bytes(state.llama_state[:state.llama_state_size]))
+
+        header = json.dumps({
+            "tokens": list(tokens),
+            "n_tokens": state.n_tokens,
+            "seed": state.seed,
+            "llama_state_size": state.llama_state_size,
+            "arrays": arrays,
+        }).encode()
+
+        with self.lock:
+            if name in self.entries:
+                return
+
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(struct.pack("<Q", len(header)))
+                    f.write(header)
+                    for chunk in data:
+                        f.write(chunk)
+                os.replace(path + ".tmp", path)
+                self._open(name)
+            except OSError:
+                _LOGGER.exception("Failed to write state cache file")
+                self._remove(name)
+                return
+
+            self._evict()
+
+    def _file_name(self, tokens: Sequence[int]) -> str:
+        digest = hashlib.sha256(struct.pack(f"<{len(tokens)}i", *tokens))
+        return digest.hexdigest() + STATE_FILE_EXTENSION
+
+    def _open(self, name: str) -> None:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            header_length = struct.unpack_from("<Q", mapped, 0)[0]
+            header = json.loads(mapped[8:8 + header_length])
+            header["data_offset"] = 8 + header_length
+        except Exception:
+            mapped.close()
+            raise
+
+        self.entries[name] = (tuple(header["tokens"]), mapped, header)
+
+    def _read_state(self, name: str) -> Any:
+        import numpy as np # only needed (and installed) when llama-cpp-python is used
+
+        _, mapped, header = self.entries[name]
+        data_offset = header["data_offset"]
+        arrays = header["arrays"]
+
+        def read_array(field: str):
+            layout = arrays[field]
+            array = np.frombuffer(mapped, dtype=np.dtype(layout["dtype"]), count=layout["length"] // np.dtype(layout["dtype"]).itemsize, offset=data_offset + layout["offset"])
+            return array.reshape(layout["shape"])
+
+        llama_state_start = data_offset + arrays["llama_state"]["offset"]
+        return self.state_type(
+            input_ids=read_array("input_ids"),
+            scores=read_array("scores"),
+            n_tokens=header["n_tokens"],
+            llama_state=memoryview(mapped)[llama_state_start:llama_state_start + arrays["llama_state"]["length"]],
+            llama_state_size=header["llama_state_size"],
+            seed=header["seed"],
+        )
+
+    def _close(self, name: str) -> None:
+        _, mapped, _ = self.entries.pop(name)
+        try:
+            mapped.close()
+        except BufferError:
+            pass # a state read from it is still in use; the mapping is released once that is garbage collected
+
+    def _remove(self, name: str) -> None:
+        if name in self.entries:
+            self._close(name)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        files = []
+        total_bytes = 0
+        for name in self.entries.keys():
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+            total_bytes += stat.st_size
+
+        for _, name, size in sorted(files):
+            if total_bytes <= self.capacity_bytes:
+                break
+            _LOGGER.debug(f"Evicting state cache file {name} ({size} bytes)")
+            self._remove(name)
+            total_bytes -= size
@@ -0,0 +1,59 @@
+"""Re-using the model output for requests that are identical to a recent one"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Mapping
+
+_LOGGER = logging.getLogger(__name__)
+
+def normalize_request_text(text: str) -> str:
+    """Lower case with runs of whitespace collapsed and punctuation at the ends removed"""
+    return re.sub(r"\s+", " ", text).strip(" .,!?;:").lower()
+
+def response_cache_key(message_history: list[dict], model: str | None, options: Mapping[str, Any]) -> tuple[str, str, str | None, str]:
+    """
+    The normalized request, a hash of everything before it (the rendered system prompt and earlier turns), the model
+    and a hash of the options (which includes the sampling parameters)
+    """
+    history = hashlib.sha256(json.dumps([ (message["role"], message["message"]) for message in message_history[:-1] ]).encode()).hexdigest()
+    settings = hashlib.sha256(json.dumps(dict(options), sort_keys=True, default=str).encode()).hexdigest()
+    return normalize_request_text(message_history[-1]["message"] or ""), history, model, settings
+
+async def async_replay_response(response: str) -> AsyncGenerator[str]:
+    """A cached response in place of the stream from the backend"""
+    yield response
+
+class ResponseCache:
+    """The most recent model outputs by request; entries expire after ttl seconds"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+
+    def get(self, key: tuple, ttl: float) -> str | None:
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, response: str) -> None:
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def log_metrics(self) -> None:
+        _LOGGER.debug("Response cache: %d hits, %d misses, %d entries", self.hits, self.misses, len(self._entries))
@@ -0,0 +1,126 @@
+"""Priority scheduling of work on a model that can only process one request at a time"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Generator
+
+_LOGGER = logging.getLogger(__name__)
+
+PRIORITY_USER = 0
+PRIORITY_PRIME = 1
+
+class JobCancelledException(Exception):
+    """The job was replaced by a newer job before it got to run"""
+
+class ModelJob:
+    priority: int
+    sequence: int
+    submitted: float
+    cancelled: bool
+
+    def __init__(self, scheduler: ModelScheduler, priority: int, sequence: int) -> None:
+        self.scheduler = scheduler
+        self.priority = priority
+        self.sequence = sequence
+        self.submitted = time.monotonic()
+        self.cancelled = False
+
+    @property
+    def should_yield(self) -> bool:
+        """Long running jobs should check this between steps and stop early if it is set"""
+        return self.cancelled or self.scheduler.has_waiting_job(more_important_than=self.priority)
+
+class ModelScheduler:
+    """
+    Gives out exclusive access to the model. Waiting jobs run in priority order (lower number first) and
+    then in the order they were submitted. Running jobs are never interrupted by the scheduler itself;
+    long running low priority jobs are expected to check ModelJob.should_yield.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._waiting: list[tuple[int, int, ModelJob]] = []
+        self._running: ModelJob | None = None
+        self._sequence = itertools.count()
+
+        self.completed_jobs = 0
+        self.cancelled_jobs = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def has_waiting_job(self, *, more_important_than: int) -> bool:
+        with self._condition:
+            return bool(self._waiting) and self._waiting[0][0] < more_important_than
+
+    @contextmanager
+    def job(self, priority: int, *, replace_queued: bool = False) -> Generator[ModelJob]:
+        """
+        Wait until the model is free and it is this job's turn.
+        If replace_queued is set, any queued or running job with the same priority is cancelled since its result would be stale.
+        Raises JobCancelledException if this job gets replaced while waiting.
+        """
+        with self._condition:
+            if replace_queued:
+                self._cancel_jobs(priority)
+
+            job = ModelJob(self, priority, next(self._sequence))
+            heapq.heappush(self._waiting, (priority, job.sequence, job))
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+
+            while not job.cancelled and (self._running is not None or self._waiting[0][2] is not job):
+                self._condition.wait()
+
+            if job.cancelled:
+                raise JobCancelledException()
+
+            heapq.heappop(self._waiting)
+            self._running = job
+
+            wait_time = time.monotonic() - job.submitted
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            if wait_time > 0.1:
+                _LOGGER.debug(f"Job with priority {priority} waited {wait_time:.2f} sec for the model ({len(self._waiting)} still queued)")
+
+        try:
+            yield job
+        finally:
+            with self._condition:
+                self._running = None
+                self.completed_jobs += 1
+                self._condition.notify_all()
+
+    def _cancel_jobs(self, priority: int) -> None:
+        cancelled = [ job for job_priority, _, job in self._waiting if job_priority == priority ]
+        if self._running and self._running.priority == priority:
+            cancelled.append(self._running)
+
+        for job in cancelled:
+            job.cancelled = True
+            self.cancelled_jobs += 1
+
+        self._waiting = [ item for item in self._waiting if not item[2].cancelled ]
+        heapq.heapify(self._waiting)
+        self._condition.notify_all()
+
+    def metrics(self) -> dict[str, Any]:
+        with self._condition:
+            started_jobs = self.completed_jobs + (1 if self._running else 0)
+            return {
+                "queue_depth": len(self._waiting),
+                "max_queue_depth": self.max_queue_depth,
+                "completed_jobs": self.completed_jobs,
+                "cancelled_jobs": self.cancelled_jobs,
+                "average_wait_time": round(self.total_wait_time / started_jobs, 3) if started_jobs else 0.0,
+                "max_wait_time": round(self.max_wait_time, 3),
+            }
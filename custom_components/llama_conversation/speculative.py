@@ -0,0 +1,157 @@
+"""Draft models for llama-cpp-python's speculative decoding, and a wrapper that measures how many drafted tokens are accepted"""
+from __future__ import annotations
+
+import codecs
+import logging
+from typing import Any
+
+from .grammar import GbnfGrammar
+from .kv_cache import common_prefix_length
+
+_LOGGER = logging.getLogger(__name__)
+
+class SmallModelDraft:
+    """
+    Drafts tokens by greedily sampling from a smaller model that uses the same vocabulary as the main model.
+    The draft model keeps its own context and only evaluates the tokens that changed since the last draft.
+    """
+
+    def __init__(self, draft_llm: Any, num_pred_tokens: int) -> None:
+        self.llm = draft_llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: Any, **kwargs: Any) -> Any:
+        import numpy as np # only needed (and installed) when llama-cpp-python is used
+
+        # always re-evaluate at least the last token so that there are logits to sample from
+        reusable = min(self.llm.n_tokens, len(input_ids) - 1)
+        mismatches = np.nonzero(self.llm.input_ids[:reusable] != input_ids[:reusable])[0]
+        self.llm.n_tokens = int(mismatches[0]) if len(mismatches) else reusable
+        self.llm.eval(input_ids[self.llm.n_tokens:].tolist())
+
+        drafted = []
+        for _ in range(self.num_pred_tokens):
+            token = self.llm.sample(top_k=1, temp=0)
+            if token == self.llm.token_eos() or self.llm.n_tokens >= self.llm.n_ctx() - 1:
+                break
+            drafted.append(token)
+            self.llm.eval([token])
+
+        return np.array(drafted, dtype=np.intc)
+
+class GrammarForcedDraft:
+    """
+    Drafts the text that the grammar forces the model to produce next (JSON keys, punctuation, the shared
+    prefix of the remaining entity ids, etc.) so that it is evaluated in a single batch.
+    The grammar state is kept for every generated token so it only has to advance over new tokens.
+    """
+
+    def __init__(self, max_tokens: int = 32) -> None:
+        self.max_tokens = max_tokens
+        self.llm = None
+        self.grammar = None
+        self.prompt_length = 0
+        self._tokens: list[int] = []
+        self._states: list[tuple[frozenset, bytes]] = []
+
+    def reset(self, llm: Any, grammar: GbnfGrammar | None, prompt_length: int) -> None:
+        """Start a new generation that is constrained by the grammar (or nothing if it is None)"""
+        self.llm = llm
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        self._tokens = []
+        self._states = [(grammar.initial_stacks(), b"")] if grammar else []
+
+    def __call__(self, input_ids: Any, **kwargs: Any) -> Any:
+        import numpy as np # only needed (and installed) when llama-cpp-python is used
+
+        nothing = np.array([], dtype=np.intc)
+        if self.grammar is None:
+            return nothing
+
+        generated = input_ids[self.prompt_length:].tolist()
+        keep = common_prefix_length(self._tokens, generated)
+        del self._tokens[keep:]
+        del self._states[keep + 1:]
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for token in generated[keep:]:
+            stacks, pending = self._states[-1]
+            decoder.setstate((pending, 0))
+            text = decoder.decode(self.llm.detokenize([token]))
+            self._tokens.append(token)
+            self._states.append((self.grammar.advance(stacks, text) if stacks else stacks, decoder.getstate()[0]))
+
+        stacks, pending = self._states[-1]
+        if pending or not stacks:
+            return nothing
+
+        forced_text = self.grammar.forced_text(stacks, self.max_tokens * 4)
+        if not forced_text:
+            return nothing
+
+        # some tokenizers add a space to the start of the text; only draft tokens that decode back to the forced text
+        forced_tokens = self.llm.tokenize(forced_text.encode(), add_bos=False, special=False)[:self.max_tokens]
+        if not forced_text.encode().startswith(self.llm.detokenize(forced_tokens)):
+            return nothing
+
+        return np.array(forced_tokens, dtype=np.intc)
+
+class ChainedDraft:
+    """Asks each draft model in turn and uses the first draft that is not empty"""
+
+    def __init__(self, *draft_models: Any) -> None:
+        self.draft_models = draft_models
+
+    def __call__(self, input_ids: Any, **kwargs: Any) -> Any:
+        for draft_model in self.draft_models:
+            draft = draft_model(input_ids, **kwargs)
+            if len(draft) > 0:
+                break
+        return draft
+
+class DraftAcceptanceCounter:
+    """
+    Wraps a draft model and counts how many of the drafted tokens the main model accepted.
+    Llama.generate passes all of the accepted tokens to the draft model before asking it for the next draft,
+    so each draft is scored on the next call. The last draft of a generation is never scored.
+    """
+
+    def __init__(self, draft_model: Any) -> None:
+        self.draft_model = draft_model
+        self.total_drafted = 0
+        self.total_accepted = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """Start counting a new generation"""
+        self.drafted = 0
+        self.accepted = 0
+        self._last_draft = None
+        self._last_draft_start = 0
+
+    def __call__(self, input_ids: Any, **kwargs: Any) -> Any:
+        if self._last_draft is not None and len(self._last_draft) > 0:
+            actual = input_ids[self._last_draft_start:self._last_draft_start + len(self._last_draft)]
+            accepted = common_prefix_length(self._last_draft.tolist(), actual.tolist())
+            self.drafted += len(self._last_draft)
+            self.accepted += accepted
+            self.total_drafted += len(self._last_draft)
+            self.total_accepted += accepted
+
+        draft = self.draft_model(input_ids, **kwargs)
+        self._last_draft = draft
+        self._last_draft_start = len(input_ids)
+        return draft
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.total_accepted / self.total_drafted if self.total_drafted else 0.0
+
+    def log_generation(self) -> None:
+        if not self.drafted:
+            return
+        _LOGGER.debug(
+            f"Speculative decoding accepted {self.accepted} of {self.drafted} drafted tokens ({self.accepted / self.drafted:.0%}); "
+            f"{self.acceptance_rate:.0%} since the model was loaded"
+        )
@@ -0,0 +1,84 @@
+"""Fitting the exposed devices into the model's context by compacting or leaving out the least important ones"""
+from __future__ import annotations
+
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+_LOGGER = logging.getLogger(__name__)
+
+# used when the backend's tokenizer isn't available; on the low side so the estimate errs towards too many tokens
+CHARACTERS_PER_TOKEN = 3.0
+
+# room left for the role markers that the prompt format adds around each message
+PROMPT_FORMAT_RESERVED_TOKENS = 32
+
+class TokenCounter:
+    """
+    Counts the tokens in a piece of text with the backend's tokenizer, or estimates them from the length of the text
+    if there is no tokenizer. Counts are cached by text so device lines that didn't change are only counted once.
+    """
+
+    def __init__(self, tokenize: Callable[[str], int] | None = None, max_entries: int = 4096) -> None:
+        self.tokenize = tokenize
+        self.max_entries = max_entries
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                return count
+
+        if self.tokenize:
+            count = self.tokenize(text)
+        else:
+            count = math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+        with self._lock:
+            self._counts[text] = count
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_lines(self, text: str) -> int:
+        """
+        Counts a long text (like the system prompt) one line at a time so only the lines that changed since the last
+        call are tokenized. Each line break is counted as a token of its own, so this errs towards too many tokens.
+        """
+        lines = text.split("\n")
+        return sum(self.count(line) for line in lines) + len(lines) - 1
+
+def plan_device_budget(device_costs: list[tuple[str, int, int]], tokens_to_free: int) -> tuple[set[str], set[str]]:
+    """
+    Decide which devices to compact and which to leave out to free up the given number of tokens.
+    device_costs is a list of (entity id, tokens for the full lines, tokens for the compact line), ordered from the
+    least to the most important device. Less important devices are compacted first (aliases removed); if that isn't
+    enough they are left out entirely, again starting with the least important.
+    Returns the entity ids to compact and the entity ids to leave out.
+    """
+    compacted = set()
+    dropped = set()
+
+    for entity_id, full_cost, compact_cost in device_costs:
+        if tokens_to_free <= 0:
+            break
+        if compact_cost < full_cost:
+            compacted.add(entity_id)
+            tokens_to_free -= full_cost - compact_cost
+
+    for entity_id, full_cost, compact_cost in device_costs:
+        if tokens_to_free <= 0:
+            break
+        if entity_id in compacted:
+            compacted.remove(entity_id)
+            tokens_to_free -= compact_cost
+        else:
+            tokens_to_free -= full_cost
+        dropped.add(entity_id)
+
+    return compacted, dropped
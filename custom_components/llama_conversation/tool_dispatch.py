@@ -0,0 +1,65 @@
+"""Concurrent execution of the tool calls that the model generated in a single response"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+_LOGGER = logging.getLogger(__name__)
+
+class ToolCallDispatcher:
+    """
+    Starts tool calls as they are generated. Calls on different targets run at the same time, up to max_parallel
+    calls at once. Calls on the same target run in the order they were generated, and calls without a known
+    target (an area, every light, etc.) wait for all of the calls before them, and all later calls wait for them.
+    If a call fails, the calls that were waiting on it are not made and fail with the same error.
+    """
+
+    def __init__(self, max_parallel: int) -> None:
+        self._semaphore = asyncio.Semaphore(max(1, max_parallel))
+        self._calls: list[asyncio.Future] = []
+        self._last_call_by_target: dict[str, asyncio.Future] = {}
+        self._barrier: asyncio.Future | None = None
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def dispatch(self, target: str | None, call: Callable[[], Awaitable[Any]]) -> None:
+        """Start a tool call once the calls that it depends on are done"""
+        if target is None:
+            depends_on = list(self._calls)
+        else:
+            depends_on = [ previous for previous in (self._barrier, self._last_call_by_target.get(target)) if previous ]
+
+        async def run() -> Any:
+            for previous in depends_on:
+                await previous
+            async with self._semaphore:
+                return await call()
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._add(target, task)
+
+    def fail(self, error: Exception) -> None:
+        """Record a tool call that could not be made at all. Calls generated after it are not made either"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(error)
+        self._add(None, future)
+
+    def _add(self, target: str | None, call: asyncio.Future) -> None:
+        self._calls.append(call)
+        if target is None:
+            self._barrier = call
+            self._last_call_by_target.clear()
+        else:
+            self._last_call_by_target[target] = call
+
+    async def async_results(self) -> list[Any]:
+        """Wait for every call. Returns the result or the exception of each call in the order they were generated"""
+        return await asyncio.gather(*self._calls, return_exceptions=True)
+
+    async def async_cancel(self) -> None:
+        """Cancel the calls that haven't finished yet and wait for them to stop"""
+        for call in self._calls:
+            call.cancel()
+        await asyncio.gather(*self._calls, return_exceptions=True)
@@ -1,10 +1,15 @@
+import codecs
 import time
 import os
+import functools
+import itertools
+import json
 import re
 import sys
 import platform
 import logging
 import multiprocessing
+from typing import Any, AsyncGenerator, AsyncIterable
 import voluptuous as vol
 import webcolors
 from webcolors import CSS3
@@ -19,6 +24,10 @@ from homeassistant.util.package import install_package, is_installed
 from .const import (
     INTEGRATION_VERSION,
     EMBEDDED_LLAMA_CPP_PYTHON_VERSION,
+    CURRENT_DATE_PROMPT,
+    DEFAULT_PROMPT_BASE,
+    ALLOWED_SERVICE_CALL_ARGUMENTS,
+    NUMERIC_SERVICE_CALL_ARGUMENTS,
 )
 
 _LOGGER = logging.getLogger(__name__)
@@ -34,16 +43,60 @@ class MissingQuantizationException(Exception):
         self.missing_quant = missing_quant
         self.available_quants = available_quants
 
+class NearestColorIndex:
+    """
+    Finds the named color closest to an RGB value (squared euclidean distance). The RGB cube is split into buckets
+    and each bucket keeps the few colors that can be the closest to any point inside it, so a lookup only measures
+    the distance to those. Buckets are filled the first time they are used.
+    When several colors are equally close, the one that comes last in the list wins.
+    """
+
+    def __init__(self, colors: list[tuple[str, tuple[int, int, int]]], bucket_size: int = 16):
+        self.colors = [ (name, tuple(int(c) for c in rgb)) for name, rgb in colors ]
+        self.bucket_size = bucket_size
+        self.buckets: dict[tuple[int, int, int], list[tuple[str, tuple[int, int, int]]]] = {}
+
+    def _bucket_candidates(self, bucket: tuple[int, int, int]) -> list[tuple[str, tuple[int, int, int]]]:
+        low = [ b * self.bucket_size for b in bucket ]
+        high = [ min(l + self.bucket_size, 255) for l in low ]
+
+        bounds = []
+        for name, rgb in self.colors:
+            nearest = sum((c - min(max(c, l), h)) ** 2 for c, l, h in zip(rgb, low, high))
+            farthest = sum(max(c - l, h - c) ** 2 for c, l, h in zip(rgb, low, high))
+            bounds.append((nearest, farthest))
+
+        # a color can only be the closest if it can be closer than the farthest distance of every other color
+        best_farthest = min(farthest for _, farthest in bounds)
+        return [ color for color, (nearest, _) in zip(self.colors, bounds) if nearest <= best_farthest ]
+
+    def nearest(self, requested_color) -> str:
+        r, g, b = requested_color[0], requested_color[1], requested_color[2]
+        if 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
+            bucket = (int(r) // self.bucket_size, int(g) // self.bucket_size, int(b) // self.bucket_size)
+            candidates = self.buckets.get(bucket)
+            if candidates is None:
+                candidates = self.buckets[bucket] = self._bucket_candidates(bucket)
+        else:
+            candidates = self.colors
+
+        best_name = None
+        best_distance = None
+        for name, (r_c, g_c, b_c) in candidates:
+            distance = (r_c - r) ** 2 + (g_c - g) ** 2 + (b_c - b) ** 2
+            if best_distance is None or distance <= best_distance:
+                best_name = name
+                best_distance = distance
+        return best_name
+
+CSS3_COLOR_INDEX = NearestColorIndex(list(CSS3_NAME_TO_RGB.items()))
+
+@functools.lru_cache(maxsize=1024)
+def _closest_color(requested_color: tuple) -> str:
+    return CSS3_COLOR_INDEX.nearest(requested_color)
+
 def closest_color(requested_color):
-    min_colors = {}
-    
-    for name, rgb in CSS3_NAME_TO_RGB.items():
-        r_c, g_c, b_c = rgb
-        rd = (r_c - requested_color[0]) ** 2
-        gd = (g_c - requested_color[1]) ** 2
-        bd = (b_c - requested_color[2]) ** 2
-        min_colors[(rd + gd + bd)] = name
-    return min_colors[min(min_colors.keys())]
+    return _closest_color(tuple(requested_color))
 
 def flatten_vol_schema(schema):
     flattened = []
@@ -98,6 +151,332 @@ def custom_custom_serializer(value):
     
     return cv.custom_serializer(value)
 
+ICL_SECTION_START = "{% for item in response_examples %}"
+
+@functools.lru_cache(maxsize=16)
+def order_prompt_by_volatility(prompt_template: str) -> str:
+    """
+    Re-arranges a system prompt template so the parts that change between requests come last. The persona, tools
+    and devices stay at the start followed by the current date and then the in context learning examples, so a
+    backend that caches the prompt prefix only has to re-process the end of it.
+    Only the date and example sections from the default prompts are recognized; everything else keeps its order.
+    """
+    remaining = prompt_template
+    icl_section = ""
+    icl_start = remaining.find(ICL_SECTION_START)
+    if icl_start >= 0:
+        icl_section = remaining[icl_start:]
+        remaining = remaining[:icl_start]
+
+    date_section = ""
+    for date_prompt in CURRENT_DATE_PROMPT.values():
+        if date_prompt in remaining:
+            remaining = remaining.replace(date_prompt + "\n", "", 1) if date_prompt + "\n" in remaining else remaining.replace(date_prompt, "", 1)
+            date_section = date_prompt
+            break
+
+    if not date_section:
+        return prompt_template
+
+    result = remaining.rstrip("\n") + "\n" + date_section
+    if icl_section:
+        result = result + "\n" + icl_section
+    return result
+
+# the device listing from DEFAULT_PROMPT_BASE; '<area>' is replaced with the selected language's word for area when
+# the prompt is set up so it matches any text there
+DEFAULT_DEVICE_SECTION_START = "{% for device in devices | selectattr('area_id', 'none'): %}"
+NATIVE_DEVICE_SECTION_VARIABLE = "native_device_section"
+_default_device_section_before_area, _default_device_section_after_area = \
+    DEFAULT_PROMPT_BASE[DEFAULT_PROMPT_BASE.index(DEFAULT_DEVICE_SECTION_START):].split("<area>")
+DEFAULT_DEVICE_SECTION_PATTERN = re.compile(
+    re.escape(_default_device_section_before_area) + r"([^\n{}]*)" + re.escape(_default_device_section_after_area)
+)
+
+def replace_default_device_section(prompt_template: str) -> tuple[str, str | None]:
+    """
+    If the prompt template lists the devices the same way as DEFAULT_PROMPT_BASE, replaces that listing with a variable
+    that render_default_device_section() fills in, since looping over every device in Jinja is the slowest part of
+    rendering the prompt. Returns the new template and the word the listing uses for area (None if there is no listing).
+    """
+    match = DEFAULT_DEVICE_SECTION_PATTERN.search(prompt_template)
+    if not match:
+        return prompt_template, None
+
+    return prompt_template[:match.start()] + "{{ " + NATIVE_DEVICE_SECTION_VARIABLE + " }}" + prompt_template[match.end():], match.group(1)
+
+def render_default_device_section(devices: list[dict], area_label: str) -> str:
+    """
+    Renders the device listing from DEFAULT_PROMPT_BASE exactly the way Jinja does: devices without an area first, then
+    the devices in each area sorted by area name (ignoring case, like the groupby filter does).
+    """
+    result = []
+    for device in devices:
+        if device["area_id"] is None:
+            attributes = "".join(f";{attribute}" for attribute in device["attributes"])
+            result.append(f"\n{device['entity_id']} '{device['name']}' = {device['state']}{attributes}\n")
+    result.append("\n")
+
+    def area_key(device: dict) -> Any:
+        area_name = device["area_name"]
+        return area_name.lower() if isinstance(area_name, str) else area_name
+
+    devices_in_areas = sorted((device for device in devices if device["area_id"] is not None), key=area_key)
+    for _, area_devices in itertools.groupby(devices_in_areas, key=area_key):
+        area_devices = list(area_devices)
+        result.append(f"\n## {area_label}: {area_devices[0]['area_name']}\n")
+        for device in area_devices:
+            attributes = ";".join(str(attribute) for attribute in device["attributes"])
+            result.append(f"\n{device['entity_id']} '{device['name']}' = {device['state']};{attributes}\n")
+        result.append("\n")
+
+    return "".join(result)
+
+def regex_literal_prefix(pattern: str) -> str:
+    """Returns the literal text that every match of the regex has to start with. Empty if it can't be determined"""
+    if "|" in pattern:
+        return ""
+
+    escapes = { "n": "\n", "t": "\t", "r": "\r" }
+    prefix = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            if escaped in escapes:
+                literal = escapes[escaped]
+            elif escaped.isalnum():
+                break # character class like \S or \d
+            else:
+                literal = escaped
+            i = i + 2
+        elif char in ".^$*+?{}[]()\\":
+            break
+        else:
+            literal = char
+            i = i + 1
+
+        # a quantifier makes the previous character optional
+        if i < len(pattern) and pattern[i] in "*?{":
+            break
+        prefix = prefix + literal
+
+    return prefix
+
+HOME_LLM_TOOL_CALL_STRING_KEYS = frozenset(["service", "target_device", "to_say"] + [
+    argument for argument in ALLOWED_SERVICE_CALL_ARGUMENTS if argument not in NUMERIC_SERVICE_CALL_ARGUMENTS
+])
+HOME_LLM_TOOL_CALL_NUMBER_KEYS = frozenset(NUMERIC_SERVICE_CALL_ARGUMENTS)
+
+def validate_home_llm_tool_call(tool_call: Any) -> dict:
+    """
+    Checks a Home-LLM service call ({"service": ..., "target_device": ..., <service arguments>}) without
+    building a vol.Schema. Raises vol.Invalid with the same messages as the equivalent schema.
+    Numeric arguments are converted to floats in place.
+    """
+    if not isinstance(tool_call, dict):
+        raise vol.Invalid("expected a dictionary")
+
+    for key in ("service", "target_device"):
+        if key not in tool_call:
+            raise vol.Invalid(f"required key not provided @ data['{key}']")
+
+    for key, value in tool_call.items():
+        if key in HOME_LLM_TOOL_CALL_STRING_KEYS:
+            if not isinstance(value, str):
+                raise vol.Invalid(f"expected str for dictionary value @ data['{key}']")
+        elif key in HOME_LLM_TOOL_CALL_NUMBER_KEYS:
+            try:
+                tool_call[key] = float(value)
+            except (TypeError, ValueError):
+                raise vol.Invalid(f"expected float for dictionary value @ data['{key}']") from None
+        else:
+            raise vol.Invalid(f"extra keys not allowed @ data['{key}']")
+
+    return tool_call
+
+def validate_llm_api_tool_call(tool_call: Any) -> dict:
+    """Checks a tool call for any other LLM API ({"name": ..., "arguments": {...}}) without building a vol.Schema"""
+    if not isinstance(tool_call, dict):
+        raise vol.Invalid("expected a dictionary")
+    if not isinstance(tool_call.get("name"), str):
+        raise vol.Invalid("expected str for dictionary value @ data['name']" if "name" in tool_call else "required key not provided @ data['name']")
+    if not isinstance(tool_call.get("arguments"), dict):
+        raise vol.Invalid("expected dict for dictionary value @ data['arguments']" if "arguments" in tool_call else "required key not provided @ data['arguments']")
+    for key in tool_call:
+        if key not in ("name", "arguments"):
+            raise vol.Invalid(f"extra keys not allowed @ data['{key}']")
+
+    return tool_call
+
+def is_json_object(text: str) -> bool:
+    """Whether the text is a complete json object, i.e. the closing brace of a tool call has been generated"""
+    try:
+        return isinstance(json.loads(text), dict)
+    except ValueError:
+        return False
+
+class JsonStreamParser:
+    """
+    Incrementally parses a streamed HTTP response body into json objects, either one per line (newline delimited json)
+    or one per server-sent event. Bytes are fed in as they arrive, so there is no limit on the length of a line and
+    nothing waits for the rest of the body.
+    """
+
+    def __init__(self, server_sent_events: bool) -> None:
+        self.server_sent_events = server_sent_events
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._event_data: list[str] = []
+
+    def feed(self, data: bytes) -> list[Any]:
+        """Add bytes from the response and return the objects that are now complete"""
+        self._buffer += self._decoder.decode(data)
+        if "\n" not in self._buffer:
+            return []
+
+        *lines, self._buffer = self._buffer.split("\n")
+        return self._parse_lines(lines)
+
+    def finish(self) -> list[Any]:
+        """The response ended; return the objects that were not terminated by a newline"""
+        lines = [ self._buffer + self._decoder.decode(b"", final=True), "" ]
+        self._buffer = ""
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines: list[str]) -> list[Any]:
+        result = []
+        for line in lines:
+            if self.done:
+                break
+
+            line = line.rstrip("\r")
+            if not self.server_sent_events:
+                if line.strip():
+                    result.append(json.loads(line))
+                continue
+
+            # an empty line ends the event; other fields (event, id, retry) and comments are ignored
+            if not line:
+                if self._event_data:
+                    data = "\n".join(self._event_data)
+                    self._event_data = []
+                    if data.strip() == "[DONE]":
+                        self.done = True
+                    else:
+                        result.append(json.loads(data))
+            elif line.startswith("data:"):
+                self._event_data.append(line.removeprefix("data:").removeprefix(" "))
+
+        return result
+
+async def async_iterate_json_stream(content: AsyncIterable[bytes], server_sent_events: bool) -> AsyncGenerator[Any]:
+    """Yield each json object from a streamed response body (aiohttp's response.content.iter_any()) as soon as it is complete"""
+    parser = JsonStreamParser(server_sent_events)
+    async for data in content:
+        for chunk in parser.feed(data):
+            yield chunk
+        if parser.done:
+            return
+
+    for chunk in parser.finish():
+        yield chunk
+
+class ToolCallStreamSplitter:
+    """
+    Incrementally separates the text that should be spoken from tool call blocks and thinking blocks
+    while a response is being streamed. Any text that could be the start of a block is held back until
+    it is known whether it is part of one.
+    """
+
+    def __init__(self, service_call_pattern: re.Pattern, think_prefix: str = "", think_suffix: str = "", end_of_text: str = ""):
+        self.service_call_pattern = service_call_pattern
+        self.tool_call_prefix = regex_literal_prefix(service_call_pattern.pattern)
+        self.think_prefix = think_prefix
+        self.think_suffix = think_suffix
+        self.end_of_text = end_of_text
+        self.markers = [ marker for marker in (self.tool_call_prefix, think_prefix, end_of_text) if marker ]
+        self.buffer = ""
+        self.in_think_block = False
+
+    def feed(self, text: str) -> tuple[str, list[str]]:
+        """Add newly generated text. Returns the text that is now safe to speak and any tool call blocks that were completed"""
+        self.buffer = self.buffer + text
+        return self._process(final=False)
+
+    def finish(self) -> tuple[str, list[str]]:
+        """Flush whatever is left once the response is complete"""
+        return self._process(final=True)
+
+    def _held_back_length(self) -> int:
+        """Length of the longest suffix of the buffer that could still turn into one of the markers"""
+        for length in range(min(len(self.buffer), max(len(marker) for marker in self.markers)), 0, -1):
+            suffix = self.buffer[-length:]
+            if any(marker.startswith(suffix) for marker in self.markers):
+                return length
+        return 0
+
+    def _process(self, *, final: bool) -> tuple[str, list[str]]:
+        to_say = ""
+        blocks = []
+        while self.buffer:
+            if self.in_think_block:
+                end = self.buffer.find(self.think_suffix)
+                if end < 0:
+                    if final:
+                        self.buffer = ""
+                    break
+                self.buffer = self.buffer[end + len(self.think_suffix):]
+                self.in_think_block = False
+                continue
+
+            if not self.tool_call_prefix:
+                # the start of a tool call can't be detected so nothing can be spoken until the response is complete
+                if final:
+                    to_say = to_say + self.service_call_pattern.sub("", self.buffer)
+                    blocks.extend(self.service_call_pattern.findall(self.buffer))
+                    self.buffer = ""
+                break
+
+            found = [ (self.buffer.find(marker), marker) for marker in self.markers if marker in self.buffer ]
+            if not found:
+                held_back = 0 if final else self._held_back_length()
+                to_say = to_say + self.buffer[:len(self.buffer) - held_back]
+                self.buffer = self.buffer[len(self.buffer) - held_back:]
+                break
+
+            position, marker = min(found, key=lambda item: item[0])
+            to_say = to_say + self.buffer[:position]
+            self.buffer = self.buffer[position:]
+
+            if marker == self.end_of_text:
+                self.buffer = self.buffer[len(marker):]
+                continue
+
+            if marker == self.think_prefix and marker != self.tool_call_prefix:
+                self.buffer = self.buffer[len(marker):]
+                self.in_think_block = True
+                continue
+
+            # only accept the match before the response is complete if it is a complete json object; text following a
+            # partial match doesn't mean the block is done (a greedy pattern may still grow, a lazy one may stop early)
+            match = self.service_call_pattern.match(self.buffer)
+            if match:
+                block = match.group(1) if self.service_call_pattern.groups else match.group(0)
+                if final or is_json_object(block):
+                    blocks.append(block)
+                    self.buffer = self.buffer[match.end():]
+                    continue
+
+            if final:
+                # unterminated tool call; it is never spoken
+                self.buffer = ""
+            break
+
+        return to_say, blocks
+
 def download_model_from_hf(model_name: str, quantization_type: str, storage_folder: str):
     try:
         from huggingface_hub import hf_hub_download, HfFileSystem
@@ -54,15 +54,47 @@ pile_of_system_prompts = None
 pile_of_hallucinated_service_names = None
 and_words = None
 
+class NearestColorIndex:
+    """
+    Same lookup as closest_color in the integration's utils.py: the RGB cube is split into buckets that each keep
+    the colors that could be the closest to a point inside them. Ties go to the color that comes last.
+    """
+    def __init__(self, colors: list[tuple[str, tuple[int, int, int]]], bucket_size: int = 16):
+        self.colors = colors
+        self.bucket_size = bucket_size
+        self.buckets = {}
+
+    def _bucket_candidates(self, bucket):
+        low = [ b * self.bucket_size for b in bucket ]
+        high = [ min(l + self.bucket_size, 255) for l in low ]
+        bounds = [
+            (sum((c - min(max(c, l), h)) ** 2 for c, l, h in zip(rgb, low, high)), sum(max(c - l, h - c) ** 2 for c, l, h in zip(rgb, low, high)))
+            for _, rgb in self.colors
+        ]
+        best_farthest = min(farthest for _, farthest in bounds)
+        return [ color for color, (nearest, _) in zip(self.colors, bounds) if nearest <= best_farthest ]
+
+    def nearest(self, requested_color):
+        r, g, b = requested_color[0], requested_color[1], requested_color[2]
+        if 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
+            bucket = (int(r) // self.bucket_size, int(g) // self.bucket_size, int(b) // self.bucket_size)
+            if bucket not in self.buckets:
+                self.buckets[bucket] = self._bucket_candidates(bucket)
+            candidates = self.buckets[bucket]
+        else:
+            candidates = self.colors
+
+        best_name, best_distance = None, None
+        for name, (r_c, g_c, b_c) in candidates:
+            distance = (r_c - r) ** 2 + (g_c - g) ** 2 + (b_c - b) ** 2
+            if best_distance is None or distance <= best_distance:
+                best_name, best_distance = name, distance
+        return best_name
+
+CSS3_COLOR_INDEX = NearestColorIndex([ (name, tuple(webcolors.hex_to_rgb(key))) for key, name in webcolors.CSS3_HEX_TO_NAMES.items() ])
+
 def closest_color(requested_color):
-    min_colors = {}
-    for key, name in webcolors.CSS3_HEX_TO_NAMES.items():
-        r_c, g_c, b_c = webcolors.hex_to_rgb(key)
-        rd = (r_c - requested_color[0]) ** 2
-        gd = (g_c - requested_color[1]) ** 2
-        bd = (b_c - requested_color[2]) ** 2
-        min_colors[(rd + gd + bd)] = name
-    return min_colors[min(min_colors.keys())]
+    return CSS3_COLOR_INDEX.nearest(requested_color)
 
 def generate_random_datetime():
     start_date = datetime(2022, 1, 1)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to render the default system prompt for different numbers of devices:
+ - "uncached": a new template is created (and parsed + compiled) for every render
+ - "cached": the template is created once and rendered every time
+ - "native": the cached template with the device listing rendered in Python instead of Jinja
+
+python3 scripts/benchmark_prompt_render.py
+python3 scripts/benchmark_prompt_render.py --devices 100 500 2000 --repeat 20
+"""
+
+import argparse, asyncio, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import template
+
+from custom_components.llama_conversation.const import DEFAULT_PROMPT, PERSONA_PROMPTS, CURRENT_DATE_PROMPT, \
+    DEVICES_PROMPT, TOOLS_PROMPT, AREA_PROMPT
+from custom_components.llama_conversation.utils import replace_default_device_section, render_default_device_section, \
+    NATIVE_DEVICE_SECTION_VARIABLE
+
+AREAS = [ "Kitchen", "Living Room", "Bedroom", "Office", "Garage", "Basement", "Attic", "Hallway" ]
+DOMAINS = [ "light", "switch", "fan", "cover", "sensor", "media_player", "climate" ]
+
+def generate_devices(count: int) -> list[dict]:
+    random.seed(count)
+    devices = []
+    for i in range(count):
+        domain = random.choice(DOMAINS)
+        area_name = random.choice(AREAS + [ None ])
+        device = {
+            "entity_id": f"{domain}.device_{i}",
+            "name": f"Device {i}",
+            "state": random.choice([ "on", "off", "21.5 °C" ]),
+            "attributes": random.sample([ "80%", "warmwhite (255, 200, 150)", "vol=30", "45%" ], k=random.randint(0, 2)),
+            "area_name": area_name,
+            "area_id": area_name.lower().replace(" ", "_") if area_name else None,
+            "is_alias": False,
+        }
+        devices.append(device)
+        if random.random() < 0.2:
+            devices.append({ **device, "name": f"Alias {i}", "is_alias": True })
+    return devices
+
+def time_renders(render, repeat: int) -> float:
+    """The fastest render time in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+async def run_benchmark(device_counts: list[int], repeat: int):
+    hass = HomeAssistant(tempfile.mkdtemp())
+
+    prompt = DEFAULT_PROMPT.replace("<persona>", PERSONA_PROMPTS["en"]).replace("<current_date>", CURRENT_DATE_PROMPT["en"]) \
+        .replace("<devices>", DEVICES_PROMPT["en"]).replace("<tools>", TOOLS_PROMPT["en"]).replace("<area>", AREA_PROMPT["en"])
+    native_prompt, area_label = replace_default_device_section(prompt)
+    assert area_label is not None, "the device listing of the default prompt was not recognized"
+
+    cached_template = template.Template(prompt, hass)
+    native_template = template.Template(native_prompt, hass)
+
+    print(f"{'devices':>8} {'uncached (ms)':>14} {'cached (ms)':>12} {'native (ms)':>12}")
+    for count in device_counts:
+        render_variables = { "devices": generate_devices(count), "tools": [ "HassTurnOn()", "HassTurnOff()" ], "response_examples": [] }
+
+        def render_native():
+            return native_template.async_render(
+                { **render_variables, NATIVE_DEVICE_SECTION_VARIABLE: render_default_device_section(render_variables["devices"], area_label) },
+                parse_result=False,
+            )
+
+        expected = cached_template.async_render(render_variables, parse_result=False)
+        assert render_native() == expected, "the native device listing does not match the template"
+
+        uncached = time_renders(lambda: template.Template(prompt, hass).async_render(render_variables, parse_result=False), repeat)
+        cached = time_renders(lambda: cached_template.async_render(render_variables, parse_result=False), repeat)
+        native = time_renders(render_native, repeat)
+        print(f"{count:>8} {uncached:>14.2f} {cached:>12.2f} {native:>12.2f}")
+
+    await hass.async_stop(force=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rendering the default system prompt")
+    parser.add_argument("--devices", type=int, nargs="+", default=[ 100, 500, 2000 ], help="The numbers of devices to render")
+    parser.add_argument("--repeat", type=int, default=10, help="How many times to render each prompt; the fastest time is reported")
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.devices, args.repeat))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Measures how many prompt tokens each exposed device takes with each device list format:
+ - "full": one line per device and alias, as in the `formatted_devices` variable
+ - "default prompt": the device listing of the default system prompt with the full format
+ - "compact": devices grouped by area and domain with the aliases on the device's line (used for both of the above)
+
+Tokens are counted with the tokenizer of a GGUF model if one is given (requires llama-cpp-python), otherwise they are
+estimated from the length of the text.
+
+python3 scripts/measure_device_encodings.py
+python3 scripts/measure_device_encodings.py --devices 50 200 1000 --model /path/to/model.gguf
+"""
+
+import argparse, os, random, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from custom_components.llama_conversation.const import DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE, DEVICE_ENCODING_FULL, \
+    DEVICE_ENCODING_COMPACT
+from custom_components.llama_conversation.conversation import LocalLLMAgent
+from custom_components.llama_conversation.token_budget import TokenCounter
+from custom_components.llama_conversation.utils import render_default_device_section
+
+AREAS = [ "Kitchen", "Living Room", "Bedroom", "Office", "Garage", "Basement", "Attic", "Hallway" ]
+DOMAINS = [ "light", "switch", "fan", "cover", "sensor", "media_player", "climate" ]
+
+def generate_entities(count: int) -> dict[str, dict]:
+    """Exposed entities in the form returned by _async_get_exposed_entities"""
+    random.seed(count)
+    entities = {}
+    for i in range(count):
+        domain = random.choice(DOMAINS)
+        area_name = random.choice(AREAS + [ None ])
+        attributes = {
+            "state": random.choice([ "on", "off", "21.5 °C" ]),
+            "friendly_name": f"{area_name or 'Outdoor'} {domain.replace('_', ' ')} {i}",
+        }
+        if area_name:
+            attributes["area_name"] = area_name
+            attributes["area_id"] = area_name.lower().replace(" ", "_")
+        if domain == "light":
+            attributes["brightness"] = random.choice([ 255, 128 ])
+            attributes["rgb_color"] = random.choice([ (255, 255, 255), (255, 200, 150) ])
+        elif domain == "media_player":
+            attributes["volume_level"] = 0.3
+        if random.random() < 0.2:
+            attributes["aliases"] = [ f"Alias {i}" ]
+        entities[f"{domain}.device_{i}"] = attributes
+    return entities
+
+def measure(formatter: LocalLLMAgent, token_counter: TokenCounter, entities: dict[str, dict]) -> dict[str, float]:
+    """The average number of tokens per device with each format"""
+    result = {}
+    for encoding in (DEVICE_ENCODING_FULL, DEVICE_ENCODING_COMPACT):
+        device_lines = []
+        devices = []
+        for name, attributes in entities.items():
+            formatted_device, device_entries = formatter._format_device(name, attributes, DEFAULT_EXTRA_ATTRIBUTES_TO_EXPOSE, encoding)
+            device_lines.append((name, formatted_device))
+            devices.extend(device_entries)
+
+        result[encoding] = token_counter.count(formatter._join_device_lines(entities, device_lines, encoding)) / len(entities)
+        if encoding == DEVICE_ENCODING_FULL:
+            result["default prompt"] = token_counter.count(render_default_device_section(devices, "Area")) / len(entities)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the prompt tokens per device for each device list format")
+    parser.add_argument("--devices", type=int, nargs="+", default=[ 50, 200, 1000 ], help="The numbers of devices to measure")
+    parser.add_argument("--model", help="A GGUF model whose tokenizer is used to count the tokens")
+    args = parser.parse_args()
+
+    tokenize = None
+    if args.model:
+        from llama_cpp import Llama
+        llm = Llama(model_path=args.model, vocab_only=True, verbose=False)
+        tokenize = lambda text: len(llm.tokenize(text.encode(), add_bos=False))
+    token_counter = TokenCounter(tokenize)
+
+    # the device formatting doesn't use any of the agent's state
+    formatter = object.__new__(LocalLLMAgent)
+
+    print(f"{'devices':>8} {'full':>8} {'default prompt':>15} {'compact':>8} {'saved':>7}")
+    for count in args.devices:
+        tokens = measure(formatter, token_counter, generate_entities(count))
+        saved = 1 - tokens[DEVICE_ENCODING_COMPACT] / tokens["default prompt"]
+        print(f"{count:>8} {tokens[DEVICE_ENCODING_FULL]:>8.1f} {tokens['default prompt']:>15.1f} {tokens[DEVICE_ENCODING_COMPACT]:>8.1f} {saved:>7.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from custom_components.llama_conversation.conversation import LlamaCppAgent, OllamaAPIAgent
+from custom_components.llama_conversation.token_budget import PROMPT_FORMAT_RESERVED_TOKENS
+from custom_components.llama_conversation.const import (
+    CONF_CHAT_MODEL,
+    CONF_CONTEXT_LENGTH,
+    CONF_DEVICE_RETRIEVAL,
+    CONF_FIT_DEVICES_TO_CONTEXT,
+    CONF_MAX_TOKENS,
+    CONF_PROMPT,
+    CONF_SERVICE_CALL_REGEX,
+    CONF_REFRESH_SYSTEM_PROMPT,
+    CONF_REMEMBER_CONVERSATION,
+    CONF_RESPONSE_CACHE,
+    CONF_TEMPERATURE,
+    DEFAULT_PROMPT_BASE,
+    DEFAULT_SERVICE_CALL_REGEX,
+    DEFAULT_OPTIONS,
+)
+
+from homeassistant.components import conversation
+from homeassistant.components.conversation import ConversationInput
+from homeassistant.const import (
+    CONF_HOST,
+    CONF_PORT,
+    CONF_SSL,
+    CONF_LLM_HASS_API
+)
+from homeassistant.helpers import chat_session, intent
+from homeassistant.helpers.llm import LLM_API_ASSIST, APIInstance
+
+class MockConfigEntry:
+    def __init__(self, entry_id='test_entry_id', data={}, options={}):
+        self.entry_id = entry_id
+        self.title = "test"
+        self.data = dict(data)
+        self.options = dict(options)
+
+@pytest.fixture
+def config_entry():
+    yield MockConfigEntry(
+        data={
+            CONF_CHAT_MODEL: "model",
+            CONF_HOST: "localhost",
+            CONF_PORT: "11434",
+            CONF_SSL: False,
+        },
+        options={
+            **DEFAULT_OPTIONS,
+            CONF_LLM_HASS_API: LLM_API_ASSIST,
+            CONF_PROMPT: DEFAULT_PROMPT_BASE,
+            CONF_SERVICE_CALL_REGEX: DEFAULT_SERVICE_CALL_REGEX,
+        }
+    )
+
+@pytest.fixture
+def agent_fixture(config_entry, hass, enable_custom_integrations):
+    """An agent whose backend response is replaced by the responses the test sets; returns the tool call mock too"""
+    with patch.object(OllamaAPIAgent, '_load_icl_examples'), \
+         patch.object(OllamaAPIAgent, 'entry', new_callable=PropertyMock) as entry_mock, \
+         patch.object(OllamaAPIAgent, '_async_get_exposed_entities') as get_exposed_entities_mock, \
+         patch.object(APIInstance, 'async_call_tool') as call_tool_mock:
+        entry_mock.return_value = config_entry
+        get_exposed_entities_mock.return_value = (
+            {
+                "light.kitchen_light": { "state": "on", "friendly_name": "Kitchen Light" },
+                "light.office_lamp": { "state": "on", "friendly_name": "Office Lamp" },
+                "fan.bedroom": { "state": "on", "friendly_name": "Bedroom Fan" },
+            },
+            ["light", "fan"]
+        )
+        call_tool_mock.return_value = { "result": "success" }
+
+        yield OllamaAPIAgent(hass, config_entry), call_tool_mock
+
+def tool_call(name: str, target: str) -> str:
+    return "<functioncall> " + json.dumps({ "name": name, "arguments": { "name": target } })
+
+async def test_response_is_streamed_into_the_chat_log(agent_fixture, hass):
+    agent, _ = agent_fixture
+    deltas = []
+    deltas_before_last_chunk = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        yield "Hello"
+        yield " there, "
+        deltas_before_last_chunk.extend(deltas)
+        yield "how can I help?"
+    agent._async_generate_stream = generate_stream
+
+    with chat_session.async_get_chat_session(hass, "conversation") as session, \
+         conversation.async_get_chat_log(hass, session, chat_log_delta_listener=lambda _, delta: deltas.append(delta)) as chat_log:
+        result = await agent.async_process(ConversationInput("hello", MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    assert result.response.speech["plain"]["speech"] == "Hello there, how can I help?"
+    assert { "role": "assistant" } in deltas_before_last_chunk
+    assert { "content": "Hello" } in deltas_before_last_chunk
+    assert "".join(delta.get("content", "") for delta in deltas) == "Hello there, how can I help?"
+
+    # the streamed message is kept in the chat log
+    assert isinstance(chat_log.content[-1], conversation.AssistantContent)
+    assert chat_log.content[-1].content == "Hello there, how can I help?"
+    assert [ type(content) for content in chat_log.content ].count(conversation.AssistantContent) == 1
+
+async def test_tool_calls_are_not_spoken(agent_fixture, hass):
+    agent, call_tool_mock = agent_fixture
+    deltas = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        yield "Turning it off. "
+        yield tool_call("HassTurnOff", "Kitchen Light")
+    agent._async_generate_stream = generate_stream
+
+    with chat_session.async_get_chat_session(hass, "conversation") as session, \
+         conversation.async_get_chat_log(hass, session, chat_log_delta_listener=lambda _, delta: deltas.append(delta)) as chat_log:
+        result = await agent.async_process(ConversationInput("turn off the kitchen light", MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    assert result.response.speech["plain"]["speech"] == "Turning it off."
+    assert "functioncall" not in "".join(delta.get("content", "") for delta in deltas)
+    assert call_tool_mock.call_count == 1
+
+    # the model sees the response it generated on the next turn, including the tool call
+    assert "functioncall" in chat_log.content[-1].content
+
+async def test_streamed_content_without_remembering_the_conversation(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_REMEMBER_CONVERSATION] = False
+    conversations = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        conversations.append(list(conversation))
+        yield "ok"
+    agent._async_generate_stream = generate_stream
+
+    for text in [ "first", "second" ]:
+        await agent.async_process(ConversationInput(text, MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    # earlier turns are not sent to the model
+    assert [ message["role"] for message in conversations[1] ] == [ "system", "user" ]
+    assert conversations[1][-1]["message"] == "second"
+
+async def test_tool_calls_on_different_devices_run_in_parallel(agent_fixture, hass):
+    agent, call_tool_mock = agent_fixture
+    running = []
+    max_running = 0
+
+    async def call_tool(tool_input):
+        nonlocal max_running
+        running.append(tool_input.tool_args["name"])
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(tool_input.tool_args["name"])
+        return { "result": "success" }
+    call_tool_mock.side_effect = call_tool
+
+    async def generate_stream(conversation, conversation_id=None):
+        yield tool_call("HassTurnOff", "Kitchen Light") + "\n"
+        yield tool_call("HassTurnOff", "Office Lamp") + "\n"
+        yield tool_call("HassTurnOn", "Kitchen Light") + "\n"
+    agent._async_generate_stream = generate_stream
+
+    result = await agent.async_process(ConversationInput("turn off the lights", MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    assert result.response.response_type == intent.IntentResponseType.ACTION_DONE
+    assert [ (call.args[0].tool_name, call.args[0].tool_args["name"]) for call in call_tool_mock.call_args_list ] == [
+        ("HassTurnOff", "Kitchen Light"), ("HassTurnOff", "Office Lamp"), ("HassTurnOn", "Kitchen Light")
+    ]
+    assert max_running == 2
+
+async def test_failed_tool_call_is_reported(agent_fixture, hass):
+    agent, call_tool_mock = agent_fixture
+
+    async def generate_stream(conversation, conversation_id=None):
+        yield tool_call("HassTurnOff", "Kitchen Light") + "\n"
+        yield "<functioncall> {\"name\": \"HassTurnOff\"}\n"
+    agent._async_generate_stream = generate_stream
+
+    result = await agent.async_process(ConversationInput("turn off the lights", MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    assert result.response.response_type == intent.IntentResponseType.ERROR
+    assert result.response.error_code == intent.IntentResponseErrorCode.NO_INTENT_MATCH
+    assert call_tool_mock.call_count == 1
+
+async def test_identical_requests_reuse_the_response(agent_fixture, hass):
+    agent, call_tool_mock = agent_fixture
+    agent.entry.options[CONF_REMEMBER_CONVERSATION] = False
+    agent.entry.options[CONF_RESPONSE_CACHE] = True
+    agent.entry.options[CONF_TEMPERATURE] = 0.1
+    generated = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        generated.append(conversation[-1]["message"])
+        yield "Turning it off. " + tool_call("HassTurnOff", "Kitchen Light")
+    agent._async_generate_stream = generate_stream
+
+    results = []
+    for text in [ "Turn off the kitchen light", "turn off the kitchen light!", "turn off the office lamp" ]:
+        results.append(await agent.async_process(ConversationInput(text, MagicMock(), "conversation", None, "en", agent_id="agent")))
+
+    # the second request is answered from the cache, but its tool call is still made
+    assert generated == [ "Turn off the kitchen light", "turn off the office lamp" ]
+    assert [ result.response.speech["plain"]["speech"] for result in results ] == [ "Turning it off." ] * 3
+    assert call_tool_mock.call_count == 3
+    assert (agent.response_cache.hits, agent.response_cache.misses) == (1, 2)
+
+async def test_responses_are_not_cached_when_the_backend_fails(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_REMEMBER_CONVERSATION] = False
+    agent.entry.options[CONF_RESPONSE_CACHE] = True
+    agent.entry.options[CONF_TEMPERATURE] = 0.1
+    generated = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        generated.append(conversation[-1]["message"])
+        agent.generation_failures += 1
+        yield "Failed to communicate with the API!"
+    agent._async_generate_stream = generate_stream
+
+    for _ in range(2):
+        await agent.async_process(ConversationInput("hello", MagicMock(), "conversation", None, "en", agent_id="agent"))
+    assert generated == [ "hello", "hello" ]
+
+async def test_responses_are_not_cached_at_high_temperatures(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_REMEMBER_CONVERSATION] = False
+    agent.entry.options[CONF_RESPONSE_CACHE] = True
+    agent.entry.options[CONF_TEMPERATURE] = 1.0
+    generated = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        generated.append(conversation[-1]["message"])
+        yield "Hi!"
+    agent._async_generate_stream = generate_stream
+
+    for _ in range(2):
+        await agent.async_process(ConversationInput("hello", MagicMock(), "conversation", None, "en", agent_id="agent"))
+    assert generated == [ "hello", "hello" ]
+
+async def test_devices_are_fitted_into_the_context(agent_fixture, hass):
+    agent, _ = agent_fixture
+    full_prompt = await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, [])
+    conversation = [ { "role": "user", "message": "turn off the kitchen light" } ]
+    needed_tokens = agent.token_counter.count_lines(full_prompt) + agent.token_counter.count_lines(conversation[0]["message"]) + \
+        agent.entry.options[CONF_MAX_TOKENS] + PROMPT_FORMAT_RESERVED_TOKENS
+
+    agent.entry.options[CONF_FIT_DEVICES_TO_CONTEXT] = True
+    agent.entry.options[CONF_CONTEXT_LENGTH] = needed_tokens - 1
+
+    executor_jobs = []
+    async_add_executor_job = hass.async_add_executor_job
+    def record_executor_job(target, *args):
+        executor_jobs.append(target.__name__)
+        return async_add_executor_job(target, *args)
+
+    with patch.object(hass, "async_add_executor_job", side_effect=record_executor_job):
+        prompt = await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, conversation)
+
+    # the least important device is left out (they are all on and in no area, so it is the first by entity id)
+    assert "fan.bedroom" in full_prompt and "fan.bedroom" not in prompt
+    assert "light.kitchen_light" in prompt
+
+    # only counting the tokens happens in the executor; the entities and the template are handled on the event loop
+    assert executor_jobs == [ "_tokens_over_context", "_plan_device_budget" ]
+
+    # it fits with a bigger context
+    agent.entry.options[CONF_CONTEXT_LENGTH] = needed_tokens
+    assert await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, conversation) == full_prompt
+
+async def test_relevant_devices_reuse_the_line_cache(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_DEVICE_RETRIEVAL] = True
+
+    with patch.object(OllamaAPIAgent, "_format_device", side_effect=agent._format_device) as format_device_mock:
+        kitchen_prompt = await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, [], user_prompt="kitchen")
+        assert "light.kitchen_light" in kitchen_prompt and "fan.bedroom" not in kitchen_prompt
+
+        # every exposed device was formatted once and stays cached, not just the relevant ones
+        assert format_device_mock.call_count == 3
+        assert set(agent.device_line_cache) == { "light.kitchen_light", "light.office_lamp", "fan.bedroom" }
+
+        bedroom_prompt = await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, [], user_prompt="bedroom")
+        assert "fan.bedroom" in bedroom_prompt and "light.kitchen_light" not in bedroom_prompt
+
+        # nothing matches, so every device is exposed
+        full_prompt = await agent._async_generate_system_prompt(DEFAULT_PROMPT_BASE, None, [], user_prompt="hello")
+        assert all(name in full_prompt for name in agent.device_line_cache)
+
+        assert format_device_mock.call_count == 3
+
+async def test_prompt_is_not_primed_with_relevant_devices(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_DEVICE_RETRIEVAL] = True
+    agent.last_updated_entities = {}
+    agent.cache_refresh_after_cooldown = False
+    agent.last_cache_prime = 0
+    agent._cache_prompt = MagicMock()
+
+    # priming only happens with llama.cpp, which doesn't need a model file to decide not to prime
+    with patch.object(OllamaAPIAgent, "_async_generate_system_prompt") as generate_system_prompt_mock:
+        await LlamaCppAgent._async_cache_prompt(agent, "light.kitchen_light", None, None)
+
+    # the entity is still tracked so the devices are ordered by when they changed
+    assert "light.kitchen_light" in agent.last_updated_entities
+    generate_system_prompt_mock.assert_not_called()
+    agent._cache_prompt.assert_not_called()
+
+async def test_relevant_devices_are_picked_every_turn(agent_fixture, hass):
+    agent, _ = agent_fixture
+    agent.entry.options[CONF_DEVICE_RETRIEVAL] = True
+    agent.entry.options[CONF_REFRESH_SYSTEM_PROMPT] = False
+    system_prompts = []
+
+    async def generate_stream(conversation, conversation_id=None):
+        system_prompts.append(conversation[0]["message"])
+        yield "ok"
+    agent._async_generate_stream = generate_stream
+
+    with chat_session.async_get_chat_session(hass, "conversation") as session, \
+         conversation.async_get_chat_log(hass, session):
+        for text in [ "turn on the kitchen light", "turn on the bedroom fan" ]:
+            await agent.async_process(ConversationInput(text, MagicMock(), "conversation", None, "en", agent_id="agent"))
+
+    # the system prompt is refreshed even though it is off, since the devices depend on the request
+    assert "light.kitchen_light" in system_prompts[0] and "fan.bedroom" not in system_prompts[0]
+    assert "fan.bedroom" in system_prompts[1] and "light.kitchen_light" not in system_prompts[1]
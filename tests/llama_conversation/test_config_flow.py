@@ -22,15 +22,22 @@ from custom_components.llama_conversation.const import (
     CONF_MIN_P,
     CONF_TYPICAL_P,
     CONF_REQUEST_TIMEOUT,
+    CONF_REMOTE_KEEP_WARM_INTERVAL,
+    CONF_REMOTE_ADDITIONAL_ENDPOINTS,
+    CONF_REMOTE_HEDGE_PERCENTILE,
     CONF_BACKEND_TYPE,
     CONF_DOWNLOADED_MODEL_FILE,
     CONF_EXTRA_ATTRIBUTES_TO_EXPOSE,
     CONF_PROMPT_TEMPLATE,
     CONF_TOOL_FORMAT,
     CONF_TOOL_MULTI_TURN_CHAT,
+    CONF_MAX_PARALLEL_TOOL_CALLS,
+    CONF_TOOL_CALL_TIMEOUT,
     CONF_ENABLE_FLASH_ATTENTION,
     CONF_USE_GBNF_GRAMMAR,
     CONF_GBNF_GRAMMAR_FILE,
+    CONF_GBNF_BATCH_FORCED_TOKENS,
+    CONF_GBNF_DYNAMIC_GRAMMAR,
     CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES,
     CONF_IN_CONTEXT_EXAMPLES_FILE,
     CONF_NUM_IN_CONTEXT_EXAMPLES,
@@ -40,14 +47,28 @@ from custom_components.llama_conversation.const import (
     CONF_REFRESH_SYSTEM_PROMPT,
     CONF_REMEMBER_CONVERSATION,
     CONF_REMEMBER_NUM_INTERACTIONS,
+    CONF_OPTIMIZE_PROMPT_LAYOUT,
+    CONF_DEVICE_ENCODING,
+    CONF_DEVICE_RETRIEVAL,
+    CONF_DEVICE_RETRIEVAL_TOP_K,
+    CONF_RESPONSE_CACHE,
+    CONF_RESPONSE_CACHE_TTL,
+    CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
     CONF_PROMPT_CACHING_ENABLED,
     CONF_PROMPT_CACHING_INTERVAL,
+    CONF_PROMPT_CACHING_POOL_SIZE,
+    CONF_PROMPT_CACHING_DISK_SIZE,
+    CONF_SPECULATIVE_DECODING,
+    CONF_SPECULATIVE_NUM_TOKENS,
+    CONF_DRAFT_MODEL_FILE,
     CONF_SERVICE_CALL_REGEX,
     CONF_REMOTE_USE_CHAT_ENDPOINT,
     CONF_TEXT_GEN_WEBUI_CHAT_MODE,
     CONF_OLLAMA_KEEP_ALIVE_MIN,
     CONF_OLLAMA_JSON_MODE,
+    CONF_OLLAMA_REUSE_CONTEXT,
     CONF_CONTEXT_LENGTH,
+    CONF_FIT_DEVICES_TO_CONTEXT,
     CONF_BATCH_SIZE,
     CONF_THREAD_COUNT,
     CONF_BATCH_THREAD_COUNT,
@@ -297,54 +318,61 @@ def test_validate_options_schema(hass: HomeAssistant):
 
     universal_options = [
         CONF_LLM_HASS_API, CONF_PROMPT, CONF_PROMPT_TEMPLATE, CONF_TOOL_FORMAT, CONF_TOOL_MULTI_TURN_CHAT,
+        CONF_MAX_PARALLEL_TOOL_CALLS, CONF_TOOL_CALL_TIMEOUT,
         CONF_USE_IN_CONTEXT_LEARNING_EXAMPLES, CONF_IN_CONTEXT_EXAMPLES_FILE, CONF_NUM_IN_CONTEXT_EXAMPLES,
         CONF_MAX_TOKENS, CONF_EXTRA_ATTRIBUTES_TO_EXPOSE,
         CONF_SERVICE_CALL_REGEX, CONF_REFRESH_SYSTEM_PROMPT, CONF_REMEMBER_CONVERSATION, CONF_REMEMBER_NUM_INTERACTIONS,
+        CONF_OPTIMIZE_PROMPT_LAYOUT, CONF_DETERMINISTIC_IN_CONTEXT_EXAMPLES,
+        CONF_DEVICE_RETRIEVAL, CONF_DEVICE_RETRIEVAL_TOP_K, CONF_DEVICE_ENCODING, CONF_RESPONSE_CACHE, CONF_RESPONSE_CACHE_TTL,
     ]
 
     options_llama_hf = local_llama_config_option_schema(hass, None, BACKEND_TYPE_LLAMA_HF)
     assert set(options_llama_hf.keys()) == set(universal_options + [
         CONF_TOP_K, CONF_TEMPERATURE, CONF_TOP_P, CONF_MIN_P, CONF_TYPICAL_P, # supports all sampling parameters
         CONF_BATCH_SIZE, CONF_THREAD_COUNT, CONF_BATCH_THREAD_COUNT, CONF_ENABLE_FLASH_ATTENTION, # llama.cpp specific
-        CONF_CONTEXT_LENGTH, # supports context length
-        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, # supports GBNF
-        CONF_PROMPT_CACHING_ENABLED, CONF_PROMPT_CACHING_INTERVAL # supports prompt caching
+        CONF_CONTEXT_LENGTH, CONF_FIT_DEVICES_TO_CONTEXT, # supports context length
+        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, CONF_GBNF_DYNAMIC_GRAMMAR, CONF_GBNF_BATCH_FORCED_TOKENS, # supports GBNF
+        CONF_PROMPT_CACHING_ENABLED, CONF_PROMPT_CACHING_INTERVAL, CONF_PROMPT_CACHING_POOL_SIZE, CONF_PROMPT_CACHING_DISK_SIZE, # supports prompt caching
+        CONF_SPECULATIVE_DECODING, CONF_SPECULATIVE_NUM_TOKENS, CONF_DRAFT_MODEL_FILE, # supports speculative decoding
     ])
 
     options_llama_existing = local_llama_config_option_schema(hass, None, BACKEND_TYPE_LLAMA_EXISTING)
     assert set(options_llama_existing.keys()) == set(universal_options + [
         CONF_TOP_K, CONF_TEMPERATURE, CONF_TOP_P, CONF_MIN_P, CONF_TYPICAL_P, # supports all sampling parameters
         CONF_BATCH_SIZE, CONF_THREAD_COUNT, CONF_BATCH_THREAD_COUNT, CONF_ENABLE_FLASH_ATTENTION, # llama.cpp specific
-        CONF_CONTEXT_LENGTH, # supports context length
-        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, # supports GBNF
-        CONF_PROMPT_CACHING_ENABLED, CONF_PROMPT_CACHING_INTERVAL # supports prompt caching
+        CONF_CONTEXT_LENGTH, CONF_FIT_DEVICES_TO_CONTEXT, # supports context length
+        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, CONF_GBNF_DYNAMIC_GRAMMAR, CONF_GBNF_BATCH_FORCED_TOKENS, # supports GBNF
+        CONF_PROMPT_CACHING_ENABLED, CONF_PROMPT_CACHING_INTERVAL, CONF_PROMPT_CACHING_POOL_SIZE, CONF_PROMPT_CACHING_DISK_SIZE, # supports prompt caching
+        CONF_SPECULATIVE_DECODING, CONF_SPECULATIVE_NUM_TOKENS, CONF_DRAFT_MODEL_FILE, # supports speculative decoding
     ])
 
     options_ollama = local_llama_config_option_schema(hass, None, BACKEND_TYPE_OLLAMA)
     assert set(options_ollama.keys()) == set(universal_options + [
         CONF_TOP_K, CONF_TEMPERATURE, CONF_TOP_P, CONF_TYPICAL_P, # supports top_k temperature, top_p and typical_p samplers
-        CONF_OLLAMA_KEEP_ALIVE_MIN, CONF_OLLAMA_JSON_MODE, # ollama specific
-        CONF_CONTEXT_LENGTH, # supports context length
-        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, # is a remote backend
+        CONF_OLLAMA_KEEP_ALIVE_MIN, CONF_OLLAMA_JSON_MODE, CONF_OLLAMA_REUSE_CONTEXT, # ollama specific
+        CONF_CONTEXT_LENGTH, CONF_FIT_DEVICES_TO_CONTEXT, # supports context length
+        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, CONF_REMOTE_KEEP_WARM_INTERVAL, # is a remote backend
+        CONF_REMOTE_ADDITIONAL_ENDPOINTS, CONF_REMOTE_HEDGE_PERCENTILE, # can use more than one endpoint
     ])
 
     options_text_gen_webui = local_llama_config_option_schema(hass, None, BACKEND_TYPE_TEXT_GEN_WEBUI)
     assert set(options_text_gen_webui.keys()) == set(universal_options + [
         CONF_TOP_K, CONF_TEMPERATURE, CONF_TOP_P, CONF_MIN_P, CONF_TYPICAL_P, # supports all sampling parameters
         CONF_TEXT_GEN_WEBUI_CHAT_MODE, CONF_TEXT_GEN_WEBUI_PRESET, # text-gen-webui specific
-        CONF_CONTEXT_LENGTH, # supports context length
-        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, # is a remote backend
+        CONF_CONTEXT_LENGTH, CONF_FIT_DEVICES_TO_CONTEXT, # supports context length
+        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, CONF_REMOTE_KEEP_WARM_INTERVAL, # is a remote backend
     ])
 
     options_generic_openai = local_llama_config_option_schema(hass, None, BACKEND_TYPE_GENERIC_OPENAI)
     assert set(options_generic_openai.keys()) == set(universal_options + [
         CONF_TEMPERATURE, CONF_TOP_P, # only supports top_p and temperature sampling
-        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, # is a remote backend
+        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, CONF_REMOTE_KEEP_WARM_INTERVAL, # is a remote backend
+        CONF_REMOTE_ADDITIONAL_ENDPOINTS, CONF_REMOTE_HEDGE_PERCENTILE, # can use more than one endpoint
     ])
 
     options_llama_cpp_python_server = local_llama_config_option_schema(hass, None, BACKEND_TYPE_LLAMA_CPP_PYTHON_SERVER)
     assert set(options_llama_cpp_python_server.keys()) == set(universal_options + [
         CONF_TOP_K, CONF_TEMPERATURE, CONF_TOP_P, # supports top_k, temperature, and top p sampling
-        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, # supports GBNF
-        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, # is a remote backend
+        CONF_USE_GBNF_GRAMMAR, CONF_GBNF_GRAMMAR_FILE, CONF_GBNF_DYNAMIC_GRAMMAR, # supports GBNF
+        CONF_REMOTE_USE_CHAT_ENDPOINT, CONF_REQUEST_TIMEOUT, CONF_REMOTE_KEEP_WARM_INTERVAL, # is a remote backend
     ])
\ No newline at end of file
@@ -0,0 +1,60 @@
+from custom_components.llama_conversation.device_index import DeviceIndex, index_terms
+
+ENTITIES = {
+    "light.kitchen_ceiling": { "friendly_name": "Ceiling Light", "area_name": "Kitchen" },
+    "light.office_lamp": { "friendly_name": "Desk Lamp", "area_name": "Office", "aliases": [ "Reading Light" ] },
+    "fan.bedroom": { "friendly_name": "Bedroom Fan", "area_name": "Bedroom" },
+    "switch.kitchen_kettle": { "friendly_name": "Kettle", "area_name": "Kitchen" },
+}
+
+def test_index_terms():
+    assert index_terms("Turn off the kitchen LIGHTS, please!") == [ "turn", "off", "the", "kitchen", "light", "please" ]
+    assert index_terms("light.glass_door") == [ "light", "glass", "door" ]
+
+def test_search_ranks_by_weight_and_rarity():
+    index = DeviceIndex()
+    index.sync(ENTITIES)
+    assert len(index) == 4
+
+    assert index.search("turn on the kettle", 10) == [ "switch.kitchen_kettle" ]
+    assert index.search("kitchen lights", 10)[0] == "light.kitchen_ceiling"
+    assert index.search("reading light", 10)[0] == "light.office_lamp"
+    assert index.search("kitchen", 1) == [ "light.kitchen_ceiling" ]
+    assert index.search("garage", 10) == []
+
+def test_sync_reindexes_changed_devices():
+    index = DeviceIndex()
+    index.sync(ENTITIES)
+
+    renamed = dict(ENTITIES)
+    renamed["fan.bedroom"] = { "friendly_name": "Ceiling Fan", "area_name": "Bedroom" }
+
+    # changes aren't picked up until the device is marked as changed
+    index.sync(renamed)
+    assert "fan.bedroom" not in index.search("ceiling", 10)
+
+    index.mark_changed("fan.bedroom")
+    index.sync(renamed)
+    assert "fan.bedroom" in index.search("ceiling", 10)
+    assert index.changed == set()
+
+    # devices that aren't exposed anymore are removed
+    del renamed["switch.kitchen_kettle"]
+    index.sync(renamed)
+    assert index.search("kettle", 10) == []
+    assert "kettle" not in index.postings
+
+def test_marks_added_during_sync_are_kept():
+    class Entities(dict):
+        """Marks a device as changed while the index is synced, like a state change from the event loop would"""
+        def items(self):
+            index.mark_changed("fan.bedroom")
+            return super().items()
+
+    index = DeviceIndex()
+    index.sync(ENTITIES)
+    index.sync(Entities(ENTITIES))
+    assert index.changed == { "fan.bedroom" }
+
+    index.mark_all_changed()
+    assert index.changed == set(ENTITIES)
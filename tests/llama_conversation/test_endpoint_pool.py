@@ -0,0 +1,101 @@
+import asyncio
+import aiohttp
+import pytest
+from types import SimpleNamespace
+
+from custom_components.llama_conversation.const import REMOTE_HEDGE_MIN_SAMPLES
+from custom_components.llama_conversation.endpoint_pool import BackendEndpoint, EndpointPool, parse_endpoint_urls
+
+def make_pool(*base_urls: str) -> EndpointPool:
+    return EndpointPool([ BackendEndpoint(SimpleNamespace(base_url=base_url)) for base_url in base_urls ])
+
+class Server:
+    """How one endpoint responds: the items it streams, an error to fail with, or a delay before it starts"""
+    def __init__(self, items=(), error: BaseException | None = None, delay: float = 0):
+        self.items = list(items)
+        self.error = error
+        self.delay = delay
+        self.requests = 0
+        self.closed = False
+
+async def stream(pool: EndpointPool, servers: dict[str, Server], hedge_percentile: float = 0) -> list:
+    async def send_request(endpoint: BackendEndpoint):
+        server = servers[endpoint.base_url]
+        server.requests += 1
+        try:
+            await asyncio.sleep(server.delay)
+            if server.error:
+                raise server.error
+            for item in server.items:
+                yield item
+        finally:
+            server.closed = True
+
+    return [ item async for item in pool.async_stream(send_request, hedge_percentile) ]
+
+def test_parse_endpoint_urls():
+    assert parse_endpoint_urls([ "a:1", " https://b:2/ ", "", "http://a:1" ], ssl=False) == [ "http://a:1", "https://b:2" ]
+    assert parse_endpoint_urls([ "a:1" ], ssl=True) == [ "https://a:1" ]
+
+async def test_fails_over_to_the_next_endpoint():
+    pool = make_pool("http://a", "http://b")
+    servers = { "http://a": Server(error=aiohttp.ClientConnectionError()), "http://b": Server([ 1, 2 ]) }
+
+    assert await stream(pool, servers) == [ 1, 2 ]
+    assert not pool.endpoints[0].healthy and pool.endpoints[0].failures == 1
+    assert pool.endpoints[1].healthy and len(pool.endpoints[1].latencies) == 1
+    assert [ endpoint.in_flight for endpoint in pool.endpoints ] == [ 0, 0 ]
+
+    # the unhealthy endpoint is only used once the healthy ones are busy or have failed
+    assert pool.choose(set()) is pool.endpoints[1]
+
+async def test_raises_the_last_error_when_every_endpoint_fails():
+    pool = make_pool("http://a", "http://b")
+    error = aiohttp.ClientConnectionError("b is down")
+    servers = { "http://a": Server(error=aiohttp.ClientConnectionError("a is down")), "http://b": Server(error=error) }
+
+    with pytest.raises(aiohttp.ClientConnectionError) as ex:
+        await stream(pool, servers)
+    assert ex.value is error
+
+async def test_other_errors_are_not_retried():
+    pool = make_pool("http://a", "http://b")
+    servers = { "http://a": Server(error=ValueError()), "http://b": Server([ 1 ]) }
+
+    with pytest.raises(ValueError):
+        await stream(pool, servers)
+    assert servers["http://b"].requests == 0
+
+async def test_empty_pool_raises_a_connection_error():
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await stream(make_pool(), {})
+
+async def test_hedged_request_uses_the_first_response():
+    pool = make_pool("http://a", "http://b")
+    for _ in range(REMOTE_HEDGE_MIN_SAMPLES):
+        pool.endpoints[0].record_latency(0.01)
+        pool.endpoints[1].record_latency(0.02)
+    servers = { "http://a": Server([ "slow" ], delay=5), "http://b": Server([ "fast" ]) }
+
+    assert await stream(pool, servers, hedge_percentile=90) == [ "fast" ]
+    assert servers["http://a"].requests == 1 and servers["http://a"].closed
+    assert [ endpoint.in_flight for endpoint in pool.endpoints ] == [ 0, 0 ]
+
+async def test_no_hedging_without_enough_samples():
+    pool = make_pool("http://a", "http://b")
+    servers = { "http://a": Server([ "slow" ], delay=0.05), "http://b": Server([ "fast" ]) }
+
+    assert await stream(pool, servers, hedge_percentile=90) == [ "slow" ]
+    assert servers["http://b"].requests == 0
+
+async def test_choose_prefers_idle_and_faster_endpoints():
+    pool = make_pool("http://a", "http://b")
+    for _ in range(REMOTE_HEDGE_MIN_SAMPLES):
+        pool.endpoints[0].record_latency(1)
+        pool.endpoints[1].record_latency(0.1)
+    assert pool.choose(set()) is pool.endpoints[1]
+
+    pool.endpoints[1].in_flight = 1
+    assert pool.choose(set()) is pool.endpoints[0]
+    assert pool.choose({ pool.endpoints[0], pool.endpoints[1] }) is None
+    assert pool.endpoints[0].histogram_summary() == "<=1s: 10"
@@ -0,0 +1,101 @@
+import os
+import pytest
+
+from custom_components.llama_conversation.grammar import GbnfGrammar, GrammarParseException, home_llm_tool_call_rules, \
+    api_tool_call_rules, with_tool_call_rules, gbnf_literal
+
+GRAMMAR_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "custom_components", "llama_conversation")
+
+def read_grammar(name: str) -> str:
+    with open(os.path.join(GRAMMAR_DIR, name)) as f:
+        return f.read()
+
+def matches(grammar: GbnfGrammar, text: str) -> bool:
+    """The whole text is allowed by the grammar"""
+    return () in grammar.advance(grammar.initial_stacks(), text)
+
+def test_parse_and_match():
+    grammar = GbnfGrammar(r'''
+root ::= greeting (" " name){1,2} "!"?
+greeting ::= "hi" | "hello"
+name ::= [A-Z] [a-z]*
+''')
+    assert matches(grammar, "hi Bob")
+    assert matches(grammar, "hello Bob Smith!")
+    assert not matches(grammar, "hello")
+    assert not matches(grammar, "hi Bob Jim Smith")
+    assert not grammar.advance(grammar.initial_stacks(), "hey")
+
+def test_negated_classes_and_escapes():
+    grammar = GbnfGrammar(r'root ::= "\"" [^"\n]* "\"" "\x41"')
+    assert matches(grammar, '"any text"A')
+    assert not matches(grammar, '"two\nlines"A')
+
+def test_parse_errors():
+    with pytest.raises(GrammarParseException):
+        GbnfGrammar('root ::= missing')
+    with pytest.raises(GrammarParseException):
+        GbnfGrammar('other ::= "a"')
+    with pytest.raises(GrammarParseException):
+        GbnfGrammar('root ::= "a')
+
+def test_forced_text():
+    grammar = GbnfGrammar(r'root ::= "{\"service\": \"" ("light.turn_on" | "light.turn_off") "\"}"')
+    stacks = grammar.initial_stacks()
+    assert grammar.forced_text(stacks, 100) == '{"service": "light.turn_o'
+    assert grammar.forced_text(stacks, 5) == '{"ser'
+
+    stacks = grammar.advance(stacks, '{"service": "light.turn_of')
+    assert grammar.forced_text(stacks, 100) == 'f"}'
+
+    # nothing is forced where the text may end
+    stacks = grammar.advance(stacks, 'f"}')
+    assert grammar.forced_text(stacks, 100) == ""
+
+def test_bundled_grammars_parse():
+    assert matches(GbnfGrammar(read_grammar("json.gbnf")), '{"a": [1, "b", true]}')
+    assert matches(GbnfGrammar(read_grammar("output.gbnf")), 'ok\n```homeassistant\n{"service": "light.turn_on"}\n```')
+
+def test_home_llm_tool_call_rules():
+    rules = home_llm_tool_call_rules(
+        { "light": { "turn_on": [ "brightness", "rgb_color" ], "turn_off": [] }, "fan": { "turn_on": [] } },
+        { "light": [ "light.kitchen", "light.office" ] }
+    )
+    grammar = GbnfGrammar(with_tool_call_rules(read_grammar("output.gbnf"), rules))
+
+    assert matches(grammar, 'ok\n```homeassistant\n{"service": "light.turn_off", "target_device": "light.kitchen"}\n```')
+    assert matches(grammar, 'ok\n```homeassistant\n{"service": "light.turn_on", "target_device": "light.office", "brightness": 50, "rgb_color": "red"}\n```')
+    assert not matches(grammar, 'ok\n```homeassistant\n{"service": "light.turn_off", "target_device": "light.garage"}\n```')
+    assert not matches(grammar, 'ok\n```homeassistant\n{"service": "light.turn_on", "target_device": "light.office", "brightness": "high"}\n```')
+
+    # the fan domain has no exposed entities so it can't be called
+    assert "fan" not in rules
+    assert home_llm_tool_call_rules({ "fan": { "turn_on": [] } }, {}) == ""
+
+def test_api_tool_call_rules():
+    rules = api_tool_call_rules([
+        ("HassTurnOn", [ { "name": "name" }, { "name": "area", "type": "list" } ], { "name": [ "Kitchen Light" ], "area": [ "Kitchen", "Office" ] }),
+        ("HassSetMode", [ { "name": "mode", "enum": [ "auto", "cool" ] }, { "name": "level", "type": "integer" } ], {}),
+        ("GetTime", [], {}),
+    ])
+    grammar = GbnfGrammar(rules, root="toolcall")
+
+    assert matches(grammar, '{"name": "HassTurnOn", "arguments": {"name": "Kitchen Light"}}')
+    assert matches(grammar, '{"name": "HassTurnOn", "arguments": {"area": ["Kitchen", "Office"]}}')
+    assert matches(grammar, '{"name": "HassTurnOn", "arguments": {"area": "Office"}}')
+    assert matches(grammar, '{"name": "HassSetMode", "arguments": {"mode": "cool", "level": -2}}')
+    assert matches(grammar, '{"name": "GetTime", "arguments": {}}')
+    assert not matches(grammar, '{"name": "HassTurnOn", "arguments": {"name": "Garage Door"}}')
+    assert not matches(grammar, '{"name": "HassSetMode", "arguments": {"mode": "heat"}}')
+    assert not matches(grammar, '{"name": "HassTurnOff", "arguments": {}}')
+
+def test_with_tool_call_rules():
+    assert with_tool_call_rules(read_grammar("json.gbnf"), 'toolcall ::= "{}"') is None
+    assert with_tool_call_rules(read_grammar("output.gbnf"), "") is None
+
+    grammar = with_tool_call_rules("root ::= toolcall\ntoolcall ::= object\nobject ::= \"{}\"", 'toolcall ::= "[]"')
+    assert grammar == 'root ::= toolcall\ntoolcall ::= "[]"\nobject ::= "{}"\n'
+
+def test_gbnf_literal():
+    grammar = GbnfGrammar("root ::= " + gbnf_literal('say "hi"\n\\'))
+    assert matches(grammar, 'say "hi"\n\\')
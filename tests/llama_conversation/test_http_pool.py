@@ -0,0 +1,61 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from custom_components.llama_conversation.http_pool import async_get_connection_pool, async_release_connection_pool, DATA_CONNECTION_POOLS
+
+@pytest.fixture
+async def server(socket_enabled):
+    async def models(request):
+        return web.json_response({ "data": [] })
+
+    app = web.Application()
+    app.router.add_get("/models", models)
+    server = TestServer(app)
+    await server.start_server()
+    yield server
+    await server.close()
+
+def base_url(server: TestServer) -> str:
+    return str(server.make_url("")).rstrip("/")
+
+async def test_pool_is_shared_and_closed_by_the_last_user(hass, server):
+    pool = async_get_connection_pool(hass, base_url(server))
+    assert async_get_connection_pool(hass, base_url(server)) is pool
+    assert pool.users == 2
+
+    await async_release_connection_pool(hass, pool)
+    assert not pool.session.closed
+
+    await async_release_connection_pool(hass, pool)
+    assert pool.session.closed
+    assert base_url(server) not in hass.data[DATA_CONNECTION_POOLS]
+
+    # a new pool is created for the next user
+    new_pool = async_get_connection_pool(hass, base_url(server))
+    assert new_pool is not pool
+    await async_release_connection_pool(hass, new_pool)
+
+async def test_requests_reuse_connections(hass, server):
+    pool = async_get_connection_pool(hass, base_url(server))
+    for _ in range(3):
+        async with pool.session.get(f"{pool.base_url}/models") as response:
+            await response.read()
+
+    assert pool.requests == 3
+    assert pool.connections_created == 1
+    assert pool.connections_reused == 2
+    await async_release_connection_pool(hass, pool)
+
+async def test_keep_warm_only_when_idle(hass, server):
+    pool = async_get_connection_pool(hass, base_url(server))
+    await pool.async_keep_warm("/models", {}, interval=60)
+    assert pool.requests == 1
+
+    # a request was just made
+    await pool.async_keep_warm("/models", {}, interval=60)
+    assert pool.requests == 1
+
+    await pool.async_keep_warm("/models", {}, interval=0)
+    assert pool.requests == 2
+    await async_release_connection_pool(hass, pool)
@@ -0,0 +1,127 @@
+import os
+import numpy as np
+
+from custom_components.llama_conversation.kv_cache import LlamaStatePool, LlamaDiskStateCache, STATE_FILE_EXTENSION, \
+    common_prefix_length, llama_state_size
+
+class LlamaState:
+    """Has the same fields as llama_cpp.LlamaState"""
+    def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+
+def make_state(tokens: list[int], state_size: int = 100) -> LlamaState:
+    return LlamaState(
+        input_ids=np.array(tokens, dtype=np.intc),
+        scores=np.zeros((len(tokens), 4), dtype=np.single),
+        n_tokens=len(tokens),
+        llama_state=bytes(range(256)) * (state_size // 256 + 1),
+        llama_state_size=state_size,
+        seed=1234,
+    )
+
+def test_common_prefix_length():
+    assert common_prefix_length([1, 2, 3], [1, 2, 4]) == 2
+    assert common_prefix_length([1, 2], [1, 2, 3]) == 2
+    assert common_prefix_length([], [1]) == 0
+    assert common_prefix_length([5], [1]) == 0
+
+def test_state_pool_finds_longest_prefix():
+    pool = LlamaStatePool(10000)
+    short = make_state([1, 2])
+    long = make_state([1, 2, 3, 4])
+    pool.add([1, 2], short)
+    pool.add([1, 2, 3, 4], long)
+
+    assert [1, 2] in pool
+    assert [1, 2, 3] not in pool
+    assert pool.find([1, 2, 3, 5]) == (long, 3)
+    assert pool.find([1, 9])[1] == 1
+    assert pool.find([9]) == (None, 0)
+
+def test_state_pool_evicts_least_recently_used():
+    state_size = llama_state_size(make_state([1]))
+    pool = LlamaStatePool(state_size * 2)
+    pool.add([1], make_state([1]))
+    pool.add([2], make_state([2]))
+
+    # using [1] makes [2] the least recently used
+    pool.find([1])
+    pool.add([3], make_state([3]))
+
+    assert len(pool) == 2
+    assert [1] in pool and [3] in pool and [2] not in pool
+    assert pool.total_bytes == state_size * 2
+
+def test_state_pool_replaces_and_skips_oversized_states():
+    state_size = llama_state_size(make_state([1]))
+    pool = LlamaStatePool(state_size)
+    pool.add([1], make_state([1]))
+    replacement = make_state([1])
+    pool.add([1], replacement)
+    assert len(pool) == 1 and pool.total_bytes == state_size
+    assert pool.find([1]) == (replacement, 1)
+
+    pool.add([1, 2, 3], make_state([1, 2, 3], state_size=10000))
+    assert [1, 2, 3] not in pool
+
+    pool.clear()
+    assert len(pool) == 0 and pool.total_bytes == 0
+
+def test_disk_state_cache_round_trip(tmp_path):
+    cache = LlamaDiskStateCache(str(tmp_path), "version", 1024 * 1024, LlamaState)
+    cache.load()
+    state = make_state([1, 2, 3])
+    cache.add([1, 2, 3], state)
+    assert [1, 2, 3] in cache
+    cache.close()
+
+    # states are read back from disk after a restart
+    reloaded = LlamaDiskStateCache(str(tmp_path), "version", 1024 * 1024, LlamaState)
+    reloaded.load()
+    restored, length = reloaded.find([1, 2, 3, 4])
+    assert length == 3
+    assert restored.n_tokens == 3 and restored.seed == 1234
+    assert list(restored.input_ids) == [1, 2, 3]
+    assert restored.scores.shape == state.scores.shape
+    assert bytes(restored.llama_state) == state.llama_state[:state.llama_state_size]
+    assert reloaded.find([9]) == (None, 0)
+    del restored
+    reloaded.close()
+
+def test_disk_state_cache_removes_other_versions(tmp_path):
+    old = LlamaDiskStateCache(str(tmp_path), "old", 1024 * 1024, LlamaState)
+    old.load()
+    old.add([1], make_state([1]))
+    old.close()
+
+    new = LlamaDiskStateCache(str(tmp_path), "new", 1024 * 1024, LlamaState)
+    new.load()
+    assert [1] not in new
+    assert os.listdir(tmp_path) == ["new"]
+    new.close()
+
+def test_disk_state_cache_evicts_and_skips_unreadable_files(tmp_path):
+    cache = LlamaDiskStateCache(str(tmp_path), "version", 1024 * 1024, LlamaState)
+    cache.load()
+    cache.add([1], make_state([1]))
+    file_size = os.path.getsize(os.path.join(cache.directory, cache._file_name([1])))
+    cache.close()
+
+    with open(os.path.join(cache.directory, "broken" + STATE_FILE_EXTENSION), "wb") as f:
+        f.write(b"not a state")
+
+    # room for one state; the least recently used one is evicted when another is added
+    cache = LlamaDiskStateCache(str(tmp_path), "version", file_size, LlamaState)
+    cache.load()
+    assert len(cache.entries) == 1
+    assert not os.path.exists(os.path.join(cache.directory, "broken" + STATE_FILE_EXTENSION))
+
+    os.utime(os.path.join(cache.directory, cache._file_name([1])), (0, 0))
+    cache.add([2], make_state([2]))
+    assert [2] in cache and [1] not in cache
+    cache.close()
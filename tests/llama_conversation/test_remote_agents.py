@@ -0,0 +1,232 @@
+import json
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from unittest.mock import patch, PropertyMock
+
+from custom_components.llama_conversation.conversation import OllamaAPIAgent, GenericOpenAIAPIAgent
+from custom_components.llama_conversation.const import (
+    CONF_CHAT_MODEL,
+    CONF_PROMPT,
+    CONF_PROMPT_TEMPLATE,
+    CONF_REMOTE_USE_CHAT_ENDPOINT,
+    CONF_REMEMBER_CONVERSATION,
+    CONF_OLLAMA_REUSE_CONTEXT,
+    CONF_SERVICE_CALL_REGEX,
+    DEFAULT_PROMPT_BASE,
+    DEFAULT_OPTIONS,
+    PROMPT_TEMPLATE_CHATML,
+    PROMPT_TEMPLATE_LLAMA3,
+)
+
+from homeassistant.const import (
+    CONF_HOST,
+    CONF_PORT,
+    CONF_SSL,
+)
+
+class MockConfigEntry:
+    def __init__(self, entry_id='test_entry_id', data={}, options={}):
+        self.entry_id = entry_id
+        self.title = "test"
+        self.data = dict(data)
+        self.options = dict(options)
+        self.unload_callbacks = []
+
+    def async_on_unload(self, func):
+        self.unload_callbacks.append(func)
+
+    async def async_unload(self):
+        for func in self.unload_callbacks:
+            await func()
+
+@pytest.fixture
+async def backend_server(socket_enabled):
+    """A local server that the remote backends send their requests to; tests add the routes they need"""
+    app = web.Application()
+    server = TestServer(app)
+    yield app, server
+    await server.close()
+
+def make_config_entry(server: TestServer, **options) -> MockConfigEntry:
+    return MockConfigEntry(
+        data={
+            CONF_CHAT_MODEL: "model",
+            CONF_HOST: server.host,
+            CONF_PORT: str(server.port),
+            CONF_SSL: False,
+        },
+        options={
+            **DEFAULT_OPTIONS,
+            CONF_PROMPT: DEFAULT_PROMPT_BASE,
+            CONF_SERVICE_CALL_REGEX: r"({[\S \t]*})",
+            **options,
+        }
+    )
+
+@pytest.fixture
+async def ollama_agent(backend_server, hass, enable_custom_integrations):
+    """An Ollama agent using the /api/generate endpoint; requests to it are recorded in the returned list"""
+    app, server = backend_server
+    requests = []
+    responses = []
+
+    async def tags(request):
+        return web.json_response({ "models": [ { "name": "model:latest" } ] })
+
+    async def generate(request):
+        body = await request.json()
+        requests.append(body)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for text in responses.pop(0):
+            await response.write((json.dumps({ "response": text, "done": False }) + "\n").encode())
+        await response.write((json.dumps({ "response": "", "done": True, "context": [ len(requests) ] }) + "\n").encode())
+        return response
+
+    app.router.add_get("/api/tags", tags)
+    app.router.add_post("/api/generate", generate)
+    await server.start_server()
+
+    config_entry = make_config_entry(
+        server,
+        **{
+            CONF_REMOTE_USE_CHAT_ENDPOINT: False,
+            CONF_OLLAMA_REUSE_CONTEXT: True,
+            CONF_REMEMBER_CONVERSATION: True,
+            CONF_PROMPT_TEMPLATE: PROMPT_TEMPLATE_LLAMA3,
+        }
+    )
+    with patch.object(OllamaAPIAgent, '_load_icl_examples'), \
+         patch.object(OllamaAPIAgent, 'entry', new_callable=PropertyMock) as entry_mock:
+        entry_mock.return_value = config_entry
+        agent = OllamaAPIAgent(hass, config_entry)
+        await agent._async_load_model(config_entry)
+        yield agent, requests, responses
+        await config_entry.async_unload()
+
+async def test_ollama_context_reuse(ollama_agent):
+    agent, requests, responses = ollama_agent
+    turn_1 = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    responses.append([ "Hi", " there" ])
+    assert "".join([ text async for text in agent._async_generate_stream(turn_1, "conversation") ]) == "Hi there"
+    assert "context" not in requests[0]
+    assert requests[0]["raw"] is True
+
+    # the next turn only sends what was added since the last response, along with the returned context
+    turn_2 = turn_1 + [ { "role": "assistant", "message": "Hi there" }, { "role": "user", "message": "again" } ]
+    responses.append([ "ok" ])
+    assert "".join([ text async for text in agent._async_generate_stream(turn_2, "conversation") ]) == "ok"
+    assert requests[1]["context"] == [ 1 ]
+    assert requests[0]["prompt"] + "Hi there" + requests[1]["prompt"] == agent._format_prompt(turn_2)
+    assert agent.last_usage["context_reused"] is True
+
+    # ollama only uses the context if it applies a template, so one that passes the prompt through is sent instead of raw
+    assert requests[1]["raw"] is False
+    assert requests[1]["template"] == "{{ .Prompt }}"
+
+async def test_ollama_context_changed_history(ollama_agent):
+    agent, requests, responses = ollama_agent
+    turn_1 = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    responses.append([ "Hi" ])
+    [ text async for text in agent._async_generate_stream(turn_1, "conversation") ]
+
+    # a refreshed system prompt means the context doesn't match the start of the prompt anymore
+    turn_2 = [ { "role": "system", "message": "new system prompt" } ] + turn_1[1:] + \
+        [ { "role": "assistant", "message": "Hi" }, { "role": "user", "message": "again" } ]
+    responses.append([ "ok" ])
+    [ text async for text in agent._async_generate_stream(turn_2, "conversation") ]
+    assert "context" not in requests[1]
+    assert requests[1]["prompt"] == agent._format_prompt(turn_2)
+    assert requests[1]["raw"] is True
+
+async def test_ollama_context_reuse_with_chatml(ollama_agent):
+    agent, requests, responses = ollama_agent
+    agent.entry.options[CONF_PROMPT_TEMPLATE] = PROMPT_TEMPLATE_CHATML
+    turn_1 = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    responses.append([ "Hi" ])
+    [ text async for text in agent._async_generate_stream(turn_1, "conversation") ]
+
+    # the generation prompt doesn't end in the line break that the assistant prefix has; the context is still re-used
+    # and only the rest of the next prompt is sent
+    turn_2 = turn_1 + [ { "role": "assistant", "message": "Hi" }, { "role": "user", "message": "again" } ]
+    responses.append([ "ok" ])
+    [ text async for text in agent._async_generate_stream(turn_2, "conversation") ]
+    assert requests[1]["context"] == [ 1 ]
+    assert requests[0]["prompt"] + "\nHi" + requests[1]["prompt"] == agent._format_prompt(turn_2)
+
+async def test_ollama_context_not_reused_if_response_is_changed(ollama_agent):
+    agent, requests, responses = ollama_agent
+    turn_1 = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    responses.append([ "<think>greet</think>", "Hi" ])
+    [ text async for text in agent._async_generate_stream(turn_1, "conversation") ]
+
+    # the think block was removed before the response was added to the conversation
+    turn_2 = turn_1 + [ { "role": "assistant", "message": "Hi" }, { "role": "user", "message": "again" } ]
+    responses.append([ "ok" ])
+    [ text async for text in agent._async_generate_stream(turn_2, "conversation") ]
+    assert "context" not in requests[1]
+    assert requests[1]["prompt"] == agent._format_prompt(turn_2)
+
+@pytest.fixture
+async def openai_agent(backend_server, hass, enable_custom_integrations):
+    """A generic OpenAI agent using the chat completions endpoint; requests to it are recorded in the returned list"""
+    app, server = backend_server
+    requests = []
+    server_options = { "reject_stream_options": False }
+
+    async def chat_completions(request):
+        body = await request.json()
+        requests.append(body)
+        if "stream_options" in body and server_options["reject_stream_options"]:
+            return web.json_response({ "error": "Unrecognized request argument supplied: stream_options" }, status=422)
+
+        response = web.StreamResponse(headers={ "Content-Type": "text/event-stream" })
+        await response.prepare(request)
+        events = [ { "choices": [ { "delta": { "content": text }, "finish_reason": None } ] } for text in [ "Hel", "lo ☃" ] ]
+        if "stream_options" in body:
+            events.append({ "choices": [], "usage": { "prompt_tokens": 10, "completion_tokens": 2 } })
+        payload = "".join(f"data: {json.dumps(event)}\n\n" for event in events).encode() + b"data: [DONE]\n\n"
+
+        # split the events across writes (and a multi-byte character) like a slow network would
+        for i in range(0, len(payload), 7):
+            await response.write(payload[i:i + 7])
+        return response
+
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    await server.start_server()
+
+    config_entry = make_config_entry(server, **{ CONF_REMOTE_USE_CHAT_ENDPOINT: True })
+    with patch.object(GenericOpenAIAPIAgent, '_load_icl_examples'), \
+         patch.object(GenericOpenAIAPIAgent, 'entry', new_callable=PropertyMock) as entry_mock:
+        entry_mock.return_value = config_entry
+        agent = GenericOpenAIAPIAgent(hass, config_entry)
+        await agent._async_load_model(config_entry)
+        yield agent, requests, server_options
+        await config_entry.async_unload()
+
+async def test_openai_streamed_response(openai_agent):
+    agent, requests, _ = openai_agent
+    conversation = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    assert [ text async for text in agent._async_generate_stream(conversation) ] == [ "Hel", "lo ☃" ]
+    assert requests[0]["stream"] is True
+    assert requests[0]["stream_options"] == { "include_usage": True }
+    assert agent.last_usage == { "prompt_tokens": 10, "completion_tokens": 2 }
+
+async def test_openai_stream_options_rejected(openai_agent):
+    agent, requests, server_options = openai_agent
+    server_options["reject_stream_options"] = True
+    conversation = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "hello" } ]
+
+    # the request is sent again without stream_options, and later requests leave it out from the start
+    assert await agent._async_generate(conversation) == "Hello ☃"
+    assert [ "stream_options" in request for request in requests ] == [ True, False ]
+
+    assert await agent._async_generate(conversation) == "Hello ☃"
+    assert [ "stream_options" in request for request in requests ] == [ True, False, False ]
+    assert agent.last_usage is None
@@ -0,0 +1,36 @@
+from custom_components.llama_conversation.response_cache import ResponseCache, async_replay_response, normalize_request_text, \
+    response_cache_key
+
+HISTORY = [ { "role": "system", "message": "system prompt" }, { "role": "user", "message": "Turn on the kitchen light." } ]
+
+def test_normalize_request_text():
+    assert normalize_request_text("  Turn on the\tKitchen   light?! ") == "turn on the kitchen light"
+    assert normalize_request_text("What's 1.5 + 2?") == "what's 1.5 + 2"
+
+def test_response_cache_key():
+    key = response_cache_key(HISTORY, "model", { "temperature": 0.1 })
+    same_request = [ HISTORY[0], { "role": "user", "message": "turn on the kitchen light" } ]
+    assert response_cache_key(same_request, "model", { "temperature": 0.1 }) == key
+
+    # anything else that goes into the prompt or changes how it is generated is part of the key
+    assert response_cache_key([ { "role": "system", "message": "kitchen light is on" }, HISTORY[1] ], "model", { "temperature": 0.1 }) != key
+    assert response_cache_key(HISTORY, "other model", { "temperature": 0.1 }) != key
+    assert response_cache_key(HISTORY, "model", { "temperature": 0.2 }) != key
+
+def test_response_cache_expires_and_evicts():
+    cache = ResponseCache(max_entries=2)
+    cache.put(("a",), "response a")
+    cache.put(("b",), "response b")
+    assert cache.get(("a",), ttl=60) == "response a"
+
+    # b is the least recently used
+    cache.put(("c",), "response c")
+    assert cache.get(("b",), ttl=60) is None
+    assert cache.get(("c",), ttl=60) == "response c"
+
+    assert cache.get(("a",), ttl=0) is None
+    assert cache.get(("a",), ttl=60) is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+async def test_replay_response():
+    assert [ text async for text in async_replay_response("cached") ] == [ "cached" ]
@@ -0,0 +1,99 @@
+import threading
+import time
+import pytest
+
+from custom_components.llama_conversation.scheduler import ModelScheduler, JobCancelledException, PRIORITY_USER, PRIORITY_PRIME
+
+def start_job(scheduler: ModelScheduler, priority: int, order: list, **kwargs) -> threading.Thread:
+    """Runs a job in another thread and records the priority when it gets the model (or the exception)"""
+    def run():
+        try:
+            with scheduler.job(priority, **kwargs):
+                order.append(priority)
+        except JobCancelledException:
+            order.append("cancelled")
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def wait_for_queue_depth(scheduler: ModelScheduler, depth: int):
+    deadline = time.monotonic() + 5
+    while scheduler.queue_depth != depth:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_waiting_jobs_run_by_priority():
+    scheduler = ModelScheduler()
+    order = []
+
+    with scheduler.job(PRIORITY_USER):
+        threads = [ start_job(scheduler, PRIORITY_PRIME, order) ]
+        wait_for_queue_depth(scheduler, 1)
+        threads.append(start_job(scheduler, PRIORITY_USER, order))
+        wait_for_queue_depth(scheduler, 2)
+
+    for thread in threads:
+        thread.join()
+
+    # the user request was submitted last but goes first
+    assert order == [ PRIORITY_USER, PRIORITY_PRIME ]
+
+    metrics = scheduler.metrics()
+    assert metrics["completed_jobs"] == 3
+    assert metrics["max_queue_depth"] == 2
+    assert metrics["queue_depth"] == 0
+
+def test_replace_queued_cancels_jobs_with_the_same_priority():
+    scheduler = ModelScheduler()
+    order = []
+
+    with scheduler.job(PRIORITY_USER):
+        stale = start_job(scheduler, PRIORITY_PRIME, order)
+        wait_for_queue_depth(scheduler, 1)
+        newer = start_job(scheduler, PRIORITY_PRIME, order, replace_queued=True)
+        stale.join()
+        wait_for_queue_depth(scheduler, 1)
+
+    newer.join()
+    assert order == [ "cancelled", PRIORITY_PRIME ]
+    assert scheduler.metrics()["cancelled_jobs"] == 1
+
+def test_running_job_should_yield_to_more_important_jobs():
+    scheduler = ModelScheduler()
+    order = []
+
+    with scheduler.job(PRIORITY_PRIME) as job:
+        assert not job.should_yield
+        thread = start_job(scheduler, PRIORITY_PRIME, order)
+        wait_for_queue_depth(scheduler, 1)
+        assert not job.should_yield
+
+        thread_2 = start_job(scheduler, PRIORITY_USER, order)
+        wait_for_queue_depth(scheduler, 2)
+        assert job.should_yield
+
+    thread.join()
+    thread_2.join()
+
+def test_replaced_running_job_should_yield():
+    scheduler = ModelScheduler()
+    order = []
+
+    with scheduler.job(PRIORITY_PRIME) as job:
+        thread = start_job(scheduler, PRIORITY_PRIME, order, replace_queued=True)
+        wait_for_queue_depth(scheduler, 1)
+        assert job.cancelled and job.should_yield
+
+    thread.join()
+    assert order == [ PRIORITY_PRIME ]
+
+def test_job_releases_the_model_on_error():
+    scheduler = ModelScheduler()
+
+    with pytest.raises(ValueError):
+        with scheduler.job(PRIORITY_USER):
+            raise ValueError()
+
+    with scheduler.job(PRIORITY_USER):
+        pass
+    assert scheduler.metrics()["completed_jobs"] == 2
@@ -0,0 +1,50 @@
+from custom_components.llama_conversation.token_budget import TokenCounter, plan_device_budget
+
+def test_token_counter_caches_counts():
+    tokenized = []
+    def tokenize(text: str) -> int:
+        tokenized.append(text)
+        return len(text.split())
+
+    counter = TokenCounter(tokenize, max_entries=2)
+    assert counter.count("turn on the light") == 4
+    assert counter.count("turn on the light") == 4
+    assert tokenized == [ "turn on the light" ]
+
+    # the least recently used count is dropped
+    counter.count("a")
+    counter.count("turn on the light")
+    counter.count("b c")
+    counter.count("a")
+    assert tokenized == [ "turn on the light", "a", "b c", "a" ]
+
+def test_token_counter_estimates_without_a_tokenizer():
+    counter = TokenCounter()
+    assert counter.count("") == 0
+    assert counter.count("abc") == 1
+    assert counter.count("abcd") == 2
+
+def test_count_lines_only_tokenizes_changed_lines():
+    tokenized = []
+    def tokenize(text: str) -> int:
+        tokenized.append(text)
+        return len(text.split())
+
+    counter = TokenCounter(tokenize)
+    assert counter.count_lines("light.kitchen on\nfan.bedroom off") == 5
+    tokenized.clear()
+
+    assert counter.count_lines("light.kitchen off\nfan.bedroom off") == 5
+    assert tokenized == [ "light.kitchen off" ]
+
+def test_plan_device_budget_compacts_before_dropping():
+    devices = [ ("light.least", 10, 4), ("light.middle", 10, 10), ("light.most", 10, 4) ]
+
+    assert plan_device_budget(devices, 0) == (set(), set())
+    assert plan_device_budget(devices, 5) == ({ "light.least" }, set())
+    assert plan_device_budget(devices, 12) == ({ "light.least", "light.most" }, set())
+
+    # once every device is compacted, the least important ones are left out
+    assert plan_device_budget(devices, 13) == ({ "light.most" }, { "light.least" })
+    assert plan_device_budget(devices, 25) == ({ "light.most" }, { "light.least", "light.middle" })
+    assert plan_device_budget(devices, 27) == (set(), { "light.least", "light.middle", "light.most" })
@@ -0,0 +1,111 @@
+import asyncio
+
+from custom_components.llama_conversation.tool_dispatch import ToolCallDispatcher
+
+class ToolCalls:
+    """Tool calls that wait until the test releases them, recording when each one starts and finishes"""
+    def __init__(self):
+        self.events = []
+        self.release = {}
+
+    def call(self, name: str, error: Exception | None = None):
+        self.release[name] = asyncio.Event()
+        async def run():
+            self.events.append(f"start {name}")
+            await self.release[name].wait()
+            self.events.append(f"end {name}")
+            if error:
+                raise error
+            return name
+        return run
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+async def test_calls_on_different_targets_run_in_parallel():
+    dispatcher = ToolCallDispatcher(max_parallel=4)
+    calls = ToolCalls()
+    dispatcher.dispatch("light.kitchen", calls.call("a"))
+    dispatcher.dispatch("light.office", calls.call("b"))
+    dispatcher.dispatch("light.kitchen", calls.call("c"))
+    await settle()
+
+    # the second call on the kitchen light waits for the first one
+    assert calls.events == [ "start a", "start b" ]
+
+    calls.release["b"].set()
+    calls.release["a"].set()
+    await settle()
+    assert calls.events[-1] == "start c"
+
+    calls.release["c"].set()
+    assert await dispatcher.async_results() == [ "a", "b", "c" ]
+    assert len(dispatcher) == 3
+
+async def test_calls_without_a_target_are_a_barrier():
+    dispatcher = ToolCallDispatcher(max_parallel=4)
+    calls = ToolCalls()
+    dispatcher.dispatch("light.kitchen", calls.call("a"))
+    dispatcher.dispatch(None, calls.call("area"))
+    dispatcher.dispatch("light.office", calls.call("b"))
+    await settle()
+    assert calls.events == [ "start a" ]
+
+    calls.release["a"].set()
+    await settle()
+    assert calls.events == [ "start a", "end a", "start area" ]
+
+    calls.release["area"].set()
+    calls.release["b"].set()
+    assert await dispatcher.async_results() == [ "a", "area", "b" ]
+    assert calls.events[-2:] == [ "start b", "end b" ]
+
+async def test_max_parallel_calls():
+    dispatcher = ToolCallDispatcher(max_parallel=1)
+    calls = ToolCalls()
+    dispatcher.dispatch("light.kitchen", calls.call("a"))
+    dispatcher.dispatch("light.office", calls.call("b"))
+    await settle()
+    assert calls.events == [ "start a" ]
+
+    calls.release["a"].set()
+    calls.release["b"].set()
+    assert await dispatcher.async_results() == [ "a", "b" ]
+
+async def test_failures_are_passed_on_to_dependent_calls():
+    dispatcher = ToolCallDispatcher(max_parallel=4)
+    calls = ToolCalls()
+    error = ValueError("failed")
+    dispatcher.dispatch("light.kitchen", calls.call("a", error))
+    dispatcher.dispatch("light.kitchen", calls.call("b"))
+    dispatcher.dispatch("light.office", calls.call("c"))
+    for name in calls.release:
+        calls.release[name].set()
+
+    results = await dispatcher.async_results()
+    assert results[0] is error and results[1] is error and results[2] == "c"
+    assert "start b" not in calls.events
+
+async def test_invalid_calls_stop_later_calls():
+    dispatcher = ToolCallDispatcher(max_parallel=4)
+    calls = ToolCalls()
+    error = ValueError("invalid")
+    dispatcher.dispatch("light.kitchen", calls.call("a"))
+    dispatcher.fail(error)
+    dispatcher.dispatch("light.office", calls.call("b"))
+    calls.release["a"].set()
+
+    assert await dispatcher.async_results() == [ "a", error, error ]
+    assert "start b" not in calls.events
+
+async def test_cancel_outstanding_calls():
+    dispatcher = ToolCallDispatcher(max_parallel=4)
+    calls = ToolCalls()
+    dispatcher.dispatch("light.kitchen", calls.call("a"))
+    dispatcher.dispatch("light.kitchen", calls.call("b"))
+    await settle()
+
+    await dispatcher.async_cancel()
+    assert calls.events == [ "start a" ]
+    assert all(isinstance(result, asyncio.CancelledError) for result in await dispatcher.async_results())
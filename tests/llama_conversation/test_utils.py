@@ -0,0 +1,201 @@
+import random
+import re
+import pytest
+import voluptuous as vol
+
+from custom_components.llama_conversation.const import DEFAULT_SERVICE_CALL_REGEX, FINE_TUNED_SERVICE_CALL_REGEX
+from custom_components.llama_conversation.utils import ToolCallStreamSplitter, regex_literal_prefix, \
+    validate_home_llm_tool_call, validate_llm_api_tool_call, NearestColorIndex, closest_color, CSS3_NAME_TO_RGB, JsonStreamParser, \
+    async_iterate_json_stream
+
+# the schemas that the validators replace
+HOME_LLM_TOOL_CALL_SCHEMA = vol.Schema({
+    vol.Required('service'): str,
+    vol.Required('target_device'): str,
+    vol.Optional('to_say'): str,
+    vol.Optional('rgb_color'): str,
+    vol.Optional('brightness'): vol.Coerce(float),
+    vol.Optional('temperature'): vol.Coerce(float),
+    vol.Optional('humidity'): vol.Coerce(float),
+    vol.Optional('fan_mode'): str,
+    vol.Optional('hvac_mode'): str,
+    vol.Optional('preset_mode'): str,
+    vol.Optional('duration'): str,
+    vol.Optional('item'): str,
+})
+LLM_API_TOOL_CALL_SCHEMA = vol.Schema({
+    vol.Required("name"): str,
+    vol.Required("arguments"): dict,
+})
+
+def split_stream(splitter: ToolCallStreamSplitter, chunks: list[str]) -> tuple[list[str], list[str]]:
+    """What gets spoken after each chunk, and the tool call blocks in the order they were completed"""
+    spoken = []
+    blocks = []
+    for chunk in chunks:
+        to_say, new_blocks = splitter.feed(chunk)
+        spoken.append(to_say)
+        blocks.extend(new_blocks)
+    to_say, new_blocks = splitter.finish()
+    spoken.append(to_say)
+    blocks.extend(new_blocks)
+    return spoken, blocks
+
+def test_regex_literal_prefix():
+    assert regex_literal_prefix(DEFAULT_SERVICE_CALL_REGEX) == "<functioncall> "
+    assert regex_literal_prefix(FINE_TUNED_SERVICE_CALL_REGEX) == "```homeassistant\n"
+    assert regex_literal_prefix(r"\{.*\}") == "{"
+    assert regex_literal_prefix(r"ab?c") == "a"
+    assert regex_literal_prefix(r"a|b") == ""
+
+def test_splitter_holds_back_a_possible_tool_call_prefix():
+    splitter = ToolCallStreamSplitter(re.compile(DEFAULT_SERVICE_CALL_REGEX))
+    spoken, blocks = split_stream(splitter, [ "Turning on ", "the light <func", "tion", "call> {\"name\": ", "\"HassTurnOn\"}", " done" ])
+
+    assert spoken[:3] == [ "Turning on ", "the light ", "" ]
+    assert "".join(spoken) == "Turning on the light  done"
+    assert blocks == [ '{"name": "HassTurnOn"}' ]
+
+def test_splitter_releases_text_that_is_not_a_tool_call():
+    splitter = ToolCallStreamSplitter(re.compile(DEFAULT_SERVICE_CALL_REGEX))
+    spoken, blocks = split_stream(splitter, [ "a <fun", "ny> thing" ])
+    assert spoken == [ "a ", "<funny> thing", "" ]
+    assert blocks == []
+
+def test_splitter_waits_for_a_complete_json_object():
+    splitter = ToolCallStreamSplitter(re.compile(DEFAULT_SERVICE_CALL_REGEX))
+
+    # the greedy pattern already matches but the object isn't closed yet
+    assert splitter.feed('<functioncall> {"name": "HassTurnOn", "arguments": {}') == ("", [])
+    assert splitter.feed('}\n') == ("\n", [ '{"name": "HassTurnOn", "arguments": {}}' ])
+    assert splitter.finish() == ("", [])
+
+def test_splitter_lazy_pattern_blocks():
+    splitter = ToolCallStreamSplitter(re.compile(FINE_TUNED_SERVICE_CALL_REGEX))
+    spoken, blocks = split_stream(splitter, [
+        "ok\n```home", "assistant\n{\"service\": \"light.turn_on\"}", "\n```\n", "```homeassistant\n{\"service\": ", "\"fan.turn_off\"}```"
+    ])
+    assert "".join(spoken) == "ok\n\n"
+    assert blocks == [ '{"service": "light.turn_on"}\n', '{"service": "fan.turn_off"}' ]
+
+def test_splitter_drops_unterminated_tool_calls_and_think_blocks():
+    splitter = ToolCallStreamSplitter(re.compile(DEFAULT_SERVICE_CALL_REGEX), think_prefix="<think>", think_suffix="</think>", end_of_text="<|eot|>")
+    spoken, blocks = split_stream(splitter, [ "<th", "ink>hmm</thi", "nk>Sure.", "<|eot|>", " <functioncall> {\"name\": " ])
+    assert "".join(spoken) == "Sure. "
+    assert blocks == []
+
+def test_splitter_without_a_literal_prefix_waits_for_the_whole_response():
+    splitter = ToolCallStreamSplitter(re.compile(r"(\{.*?\}|\[.*?\])"))
+    assert splitter.feed("ok ") == ("", [])
+    assert splitter.feed("[1]") == ("", [])
+    assert splitter.finish() == ("ok ", [ "[1]" ])
+
+def validate_like_schema(validator, schema, tool_call):
+    """Both reject the tool call with the same message or both accept it with the same result"""
+    try:
+        expected = schema(dict(tool_call) if isinstance(tool_call, dict) else tool_call)
+    except vol.Invalid as ex:
+        with pytest.raises(vol.Invalid) as validator_ex:
+            validator(tool_call)
+        assert str(validator_ex.value) == str(ex)
+        return
+
+    assert validator(tool_call) == expected
+
+@pytest.mark.parametrize("tool_call", [
+    { "service": "light.turn_on", "target_device": "light.kitchen" },
+    { "service": "light.turn_on", "target_device": "light.kitchen", "brightness": "128", "rgb_color": "(255, 0, 0)" },
+    { "service": "climate.set_temperature", "target_device": "climate.home", "temperature": 21, "to_say": "Done." },
+    { "service": "light.turn_on", "target_device": "light.kitchen", "brightness": "high" },
+    { "service": "light.turn_on", "target_device": "light.kitchen", "brightness": None },
+    { "service": "light.turn_on", "target_device": 5 },
+    { "service": "light.turn_on" },
+    { "target_device": "light.kitchen" },
+    { "service": "light.turn_on", "target_device": "light.kitchen", "color": "red" },
+    [ "light.turn_on" ],
+])
+def test_validate_home_llm_tool_call(tool_call):
+    validate_like_schema(validate_home_llm_tool_call, HOME_LLM_TOOL_CALL_SCHEMA, tool_call)
+
+@pytest.mark.parametrize("tool_call", [
+    { "name": "HassTurnOn", "arguments": { "name": "Kitchen Light" } },
+    { "name": "HassTurnOn", "arguments": {} },
+    { "name": "HassTurnOn" },
+    { "arguments": {} },
+    { "name": 1, "arguments": {} },
+    { "name": "HassTurnOn", "arguments": [] },
+    { "name": "HassTurnOn", "arguments": {}, "extra": 1 },
+    "HassTurnOn",
+])
+def test_validate_llm_api_tool_call(tool_call):
+    validate_like_schema(validate_llm_api_tool_call, LLM_API_TOOL_CALL_SCHEMA, tool_call)
+
+def test_validate_home_llm_tool_call_converts_numbers_in_place():
+    tool_call = { "service": "light.turn_on", "target_device": "light.kitchen", "brightness": "0.5" }
+    assert validate_home_llm_tool_call(tool_call) is tool_call
+    assert tool_call["brightness"] == 0.5
+
+def closest_color_by_scanning(colors, requested_color) -> str:
+    """Measures the distance to every color; ties go to the color that comes last like the index"""
+    distances = [ (sum((c - r) ** 2 for c, r in zip(rgb, requested_color)), i, name) for i, (name, rgb) in enumerate(colors) ]
+    return max(distances, key=lambda item: (-item[0], item[1]))[2]
+
+def test_nearest_color_index_matches_a_full_scan():
+    colors = list(CSS3_NAME_TO_RGB.items())
+    index = NearestColorIndex(colors)
+    rng = random.Random(0)
+
+    requested_colors = [ (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)) for _ in range(2000) ]
+    requested_colors += [ (r, g, b) for r in (0, 15, 16, 255) for g in (0, 127, 255) for b in (0, 128, 255) ]
+    requested_colors += [ (12.5, 200.25, 99.9), (300, -5, 128) ]
+    for requested_color in requested_colors:
+        assert index.nearest(requested_color) == closest_color_by_scanning(colors, requested_color), requested_color
+
+def test_nearest_color_ties_go_to_the_last_color():
+    index = NearestColorIndex([ ("first", (0, 0, 0)), ("second", (2, 0, 0)) ])
+    assert index.nearest((1, 0, 0)) == "second"
+    assert index.nearest((0, 0, 0)) == "first"
+
+def test_closest_color():
+    assert closest_color((255, 0, 0)) == "red"
+    assert closest_color([ 250, 250, 250 ]) == closest_color_by_scanning(list(CSS3_NAME_TO_RGB.items()), (250, 250, 250))
+
+def feed_in_pieces(parser: JsonStreamParser, body: bytes, piece_size: int) -> list:
+    result = []
+    for i in range(0, len(body), piece_size):
+        result.extend(parser.feed(body[i:i + piece_size]))
+    return result + parser.finish()
+
+@pytest.mark.parametrize("piece_size", [ 1, 3, 1000 ])
+def test_json_stream_parser_newline_delimited(piece_size):
+    body = '{"response": "café"}\n\n{"response": "☃", "done": true}'.encode()
+    assert feed_in_pieces(JsonStreamParser(server_sent_events=False), body, piece_size) == [
+        { "response": "café" }, { "response": "☃", "done": True }
+    ]
+
+@pytest.mark.parametrize("piece_size", [ 1, 5, 1000 ])
+def test_json_stream_parser_server_sent_events(piece_size):
+    body = (
+        ': keep alive\r\n\r\n'
+        'event: message\r\ndata: {"a": 1}\r\n\r\n'
+        'data: {"b":\ndata: 2}\n\n'
+        'data: [DONE]\n\n'
+        'data: {"after": "done"}\n\n'
+    ).encode()
+    parser = JsonStreamParser(server_sent_events=True)
+    assert feed_in_pieces(parser, body, piece_size) == [ { "a": 1 }, { "b": 2 } ]
+    assert parser.done
+
+def test_json_stream_parser_returns_objects_as_soon_as_they_are_complete():
+    parser = JsonStreamParser(server_sent_events=False)
+    assert parser.feed(b'{"a": 1}\n{"b"') == [ { "a": 1 } ]
+    assert parser.feed(b': 2}') == []
+    assert parser.finish() == [ { "b": 2 } ]
+
+async def test_async_iterate_json_stream_stops_at_done():
+    async def content():
+        yield b'data: {"a": 1}\n\ndata: [DO'
+        yield b'NE]\n\n'
+        raise AssertionError("the rest of the response should not be read")
+
+    assert [ chunk async for chunk in async_iterate_json_stream(content(), server_sent_events=True) ] == [ { "a": 1 } ]